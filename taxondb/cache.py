@@ -0,0 +1,120 @@
+# =============================================================================
+# Confidential and Proprietary
+# Unauthorized copying of this file via any medium is strictly prohibited
+# Copyright (C) Aperiomics, Inc., 2019
+# Written by Alvin Chen <ychen@aperiomics.com>
+# ==============================================================================
+
+import collections
+import threading
+import time
+
+CacheInfo = collections.namedtuple('CacheInfo',
+                                   ['hits', 'misses', 'evictions', 'expired', 'maxsize',
+                                    'currsize', 'ttl'])
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Mapping with a bounded number of entries. The least recently used entry is evicted first
+    when the cache is full. All operations hold a lock, so the cache can be shared between
+    threads.
+
+    Args:
+        maxsize: maximum number of entries, `None` for unbounded cache
+        ttl: seconds an entry stays valid after it is put, `None` for no expiry
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._expires = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data and not self._is_expired(key)
+
+    def _is_expired(self, key):
+        if self.ttl is None or self._expires[key] > time.monotonic():
+            return False
+        del self._data[key]
+        del self._expires[key]
+        self.expired += 1
+        return True
+
+    def _lookup(self, key):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            self.misses += 1
+            return _MISSING
+        if self._is_expired(key):
+            self.misses += 1
+            return _MISSING
+        self.hits += 1
+        return self._data[key]
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+        return default if value is _MISSING else value
+
+    def put(self, key, value):
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.ttl is not None:
+            self._expires[key] = time.monotonic() + self.ttl
+        if self.maxsize is not None:
+            while len(self._data) > self.maxsize:
+                old_key, _ = self._data.popitem(last=False)
+                self._expires.pop(old_key, None)
+                self.evictions += 1
+
+    def get_many(self, keys):
+        """Look up multiple keys at once.
+
+        Return:
+            Tuple of dictionary of the cached entries and list of missing keys
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                value = self._lookup(key)
+                if value is _MISSING:
+                    missing.append(key)
+                else:
+                    found[key] = value
+        return found, missing
+
+    def put_many(self, items: dict):
+        with self._lock:
+            for key, value in items.items():
+                self._put(key, value)
+
+    def info(self):
+        """Return hit, miss, eviction and expiry counters together with the cache size"""
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, self.expired, self.maxsize,
+                             len(self._data), self.ttl)
+
+    def clear(self):
+        """Remove all entries, the counters are kept"""
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
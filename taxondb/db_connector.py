@@ -8,9 +8,12 @@
 import os
 import logging
 import pip
+from urllib.parse import quote
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.ext.declarative import declarative_base
 
 from . import exceptions
@@ -32,6 +35,7 @@ class DBConfigure:
         self.password = ""
         self.path = ""
         self.encoding = ""
+        self.read_only = False
 
     @property
     def type(self):
@@ -100,7 +104,12 @@ class DBConfigure:
             if not os.path.isfile(self.path):
                 raise exceptions.DBConfigureError("Cannot find database file %s" % self.path)
 
-            if os.path.isabs(self.path):
+            if self.read_only:
+                # immutable: the file is never written while open, SQLite skips locking and
+                # change detection
+                conn_url = 'sqlite:///file:%s?mode=ro&immutable=1&uri=true' \
+                    % quote(os.path.abspath(self.path))
+            elif os.path.isabs(self.path):
                 conn_url = 'sqlite:////%s' % self.path
             else:
                 conn_url = 'sqlite:///%s' % self.path
@@ -122,16 +131,32 @@ class DBConfigure:
 
 class DBConnector:
 
+    # applied to every connection of a read-only SQLite database. Pages are read through the
+    # memory map shared by all connections, so the private page cache of each pooled
+    # connection is kept small.
+    read_only_pragmas = {
+        "mmap_size": 2 ** 34,
+        "cache_size": -8192,  # KiB, 8 MiB per connection
+        "temp_store": "MEMORY",
+    }
+    read_only_pool_size = 8
+    prewarm_block_size = 2 ** 22
+
     def __init__(self):
         self._engine = None
         self._Session = None
         self._session = None
         self._db_config = None
         self._is_connected = False
+        self._thread_safe = False
 
     def __del__(self):
         self.close()
 
+    @property
+    def db_config(self):
+        return self._db_config
+
     def get_engine(self):
         if self._is_connected:
             return self._engine
@@ -141,11 +166,21 @@ class DBConnector:
     @property
     def session(self):
         if self._is_connected:
+            if self._thread_safe:
+                # session of the calling thread
+                return self._Session()
             return self._session
         else:
             raise exceptions.DBConnectionError('Database has not been connected yet.')
 
-    def connect(self, db_config: DBConfigure):
+    def connect(self, db_config: DBConfigure, thread_safe: bool = False):
+        """Connect to the database
+
+        Args:
+            db_config: database configuration
+            thread_safe: give each thread its own session, so the connector can be shared
+                between threads
+        """
         self._db_config = db_config
         try:
             self._db_config.check_configs()
@@ -155,9 +190,24 @@ class DBConnector:
 
         conn_url = self._db_config.get_conn_url()
 
-        self._engine = create_engine(conn_url)
-        self._Session = sessionmaker(bind=self._engine)
-        self._session = self._Session()
+        self._thread_safe = thread_safe
+        read_only = db_config.type == 'sqlite' and db_config.read_only
+        engine_args = {}
+        if db_config.type == 'sqlite' and (thread_safe or read_only):
+            engine_args['connect_args'] = {'check_same_thread': False}
+        if read_only:
+            # connections, and their page caches, are kept and reused instead of reopened
+            engine_args.update(poolclass=QueuePool, pool_size=self.read_only_pool_size)
+
+        self._engine = create_engine(conn_url, **engine_args)
+        if read_only:
+            event.listen(self._engine, 'connect', _pragma_setter(self.read_only_pragmas))
+
+        if thread_safe:
+            self._Session = scoped_session(sessionmaker(bind=self._engine))
+        else:
+            self._Session = sessionmaker(bind=self._engine)
+            self._session = self._Session()
 
         self._is_connected = True
         return True
@@ -165,20 +215,67 @@ class DBConnector:
     def is_connected(self):
         return self._is_connected
 
+    def prewarm(self):
+        """Read the SQLite database file once, so that it is in the OS page cache which the
+        memory-mapped connections read from, and open a pooled connection."""
+        if self._db_config.type != 'sqlite':
+            return False
+        n_bytes = 0
+        with open(self._db_config.path, 'rb') as fh:
+            for block in iter(lambda: fh.read(self.prewarm_block_size), b''):
+                n_bytes += len(block)
+        self.get_engine().execute("SELECT count(*) FROM sqlite_master").fetchall()
+        logging.debug("Prewarmed %s bytes of %s" % (n_bytes, self._db_config.path))
+        return True
+
     def get_new_session(self):
         return self._Session()
 
-    def create_table(self, table_class, overwrite=False):
+    def create_table(self, table_class, overwrite=False, indexes=True):
+        """Create table of the model class
+
+        Args:
+            table_class: model class of the table
+            overwrite: drop the table first if it already exists
+            indexes: create the indexes of the table as well. Bulk loads create the indexes by
+                `create_indexes` after the data is written instead.
+        """
         if not overwrite:
             if self.get_engine().dialect.has_table(self.get_engine(), table_class.__tablename__):
                 logging.warning("Table %s already exists. Use 'overwrite=True' to create new table."
                                 % table_class.__tablename__)
                 return False
         self.get_engine().execute("DROP TABLE IF EXISTS %s" % table_class.__tablename__)
-        Base.metadata.tables[table_class.__tablename__].create(bind=self._engine)
+        table = Base.metadata.tables[table_class.__tablename__]
+        if indexes:
+            table.create(bind=self._engine)
+        else:
+            self.get_engine().execute(CreateTable(table))
         logging.debug("Create table %s" % table_class.__tablename__)
         return True
 
+    def create_indexes(self, table_class):
+        for index in Base.metadata.tables[table_class.__tablename__].indexes:
+            index.create(bind=self._engine)
+        logging.debug("Create indexes of table %s" % table_class.__tablename__)
+        return True
+
     def close(self):
-        self._session.close()
+        if not self._is_connected:
+            return
+        if self._thread_safe:
+            self._Session.remove()
+        else:
+            self._session.close()
         self._engine.dispose()
+        self._is_connected = False
+
+
+def _pragma_setter(pragmas: dict):
+    """Connection event listener applying SQLite pragmas to each new connection"""
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.close()
+    return set_pragmas
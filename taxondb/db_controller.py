@@ -7,14 +7,53 @@
 import logging
 
 import os
+import time
+import sqlite3
+import tempfile
 import collections
+import string
+import threading
+import numpy as np
 import sqlalchemy as sa
 import pandas as pd
+from sqlalchemy.schema import CreateTable
 
 from .db_connector import DBConnector, DBConfigure
 from . import exceptions
-from .file import S3File, download_file, extract_file_from_tar
-from .models import TaxonNodes, TaxonNames
+from .cache import LRUCache
+from .file import S3File, fetch_cached_file, extract_file_from_tar, iter_tar_members
+from .models import TaxonNodes, TaxonNames, TaxonLineage, TaxonMerged, TaxonDeleted, TaxonSynonyms
+from .models import TaxonRanks, TaxonNodesCompact, TaxonNamesCompact
+from .snapshot import Snapshot, SnapshotNames, source_description
+from .taxdump import read_dump, DEFAULT_CHUNK_SIZE
+from .tree import TaxonomyTree, build_merged_index, remap_merged
+from .fuzzy import trigrams, trigram_query, trigram_similarity, select_trigrams, length_bounds
+from .fuzzy import similarity
+
+
+_NOCASE_TABLE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def _nocase(text: str):
+    """Fold the text like the SQLite NOCASE collation, which lower-cases ASCII letters only"""
+    return text.translate(_NOCASE_TABLE)
+
+
+def _nocase_prefix_range(prefix: str):
+    """Bounds of the NOCASE ordered names starting with the prefix, as tuple of the inclusive
+    lower and the exclusive upper bound. The upper bound is the folded prefix with its last
+    character bumped to the next character which exists after folding."""
+    prefix = _nocase(prefix)
+    code = ord(prefix[-1]) + 1
+    if ord('A') <= code <= ord('Z'):
+        code = ord('Z') + 1
+    return prefix, prefix[:-1] + chr(code)
+
+
+def _has_table(cursor, table_name: str):
+    """Whether the table exists in the main schema of the DB-API sqlite cursor"""
+    return cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                          (table_name,)).fetchone() is not None
 
 
 class SqliteDBController(object):
@@ -22,6 +61,8 @@ class SqliteDBController(object):
     Base class for database connection and control
     """
 
+    copy_chunk_size = 50000
+
     def __init__(self):
         self.db_config = None
         self.db_connector = None
@@ -52,7 +93,9 @@ class SqliteDBController(object):
             return self._file_path
 
     def connect(self, file_path: str, is_new_db: bool = False, is_s3: bool = False,
-                s3_bucket: str = ''):
+                s3_bucket: str = '', thread_safe: bool = False, read_only: bool = False,
+                prewarm: bool = False, s3_cache_dir: str = None, s3_cache_size: int = None,
+                s3_options: dict = None):
         """Connect to sqlite database
 
         Args:
@@ -62,6 +105,17 @@ class SqliteDBController(object):
             is_s3: if the database file is local or on S3
             s3_bucket: S3 bucket name. If not provided, it will use environment variable
                 AWS_STORAGE_BUCKET_NAME. Required when `is_s3=True`
+            thread_safe: queries of each thread go through its own session, so the controller
+                can be shared between threads
+            read_only: serve an immutable database, opened read-only with memory-mapped I/O,
+                a large page cache and pooled connections. The file must not be modified while
+                it is connected.
+            prewarm: load the database file into the page cache at connect time
+            s3_cache_dir: local cache directory of S3 files shared between processes. The file
+                is only downloaded when the S3 object has changed since it was cached.
+            s3_cache_size: disk budget of `s3_cache_dir` in bytes
+            s3_options: other keyword arguments of `S3File`, e.g. transfer and compression
+                options
         """
         self._is_new_db = is_new_db
         self._is_s3 = is_s3
@@ -69,7 +123,9 @@ class SqliteDBController(object):
         self._file_path = file_path
 
         if is_s3:
-            self._s3_file = S3File(s3_file=file_path, is_new_db=is_new_db, s3_bucket=s3_bucket)
+            self._s3_file = S3File(s3_file=file_path, is_new_db=is_new_db, s3_bucket=s3_bucket,
+                                   cache_dir=s3_cache_dir, cache_size=s3_cache_size,
+                                   read_only=read_only, **(s3_options or {}))
         else:
             if is_new_db:
                 if not os.path.isfile(self._file_path):
@@ -79,8 +135,11 @@ class SqliteDBController(object):
         self.db_config = DBConfigure()
         self.db_config.type = 'sqlite'
         self.db_config.path = self.db_path
+        self.db_config.read_only = read_only
         self.db_connector = DBConnector()
-        self.db_connector.connect(self.db_config)
+        self.db_connector.connect(self.db_config, thread_safe=thread_safe)
+        if prewarm:
+            self.db_connector.prewarm()
 
         return True
 
@@ -90,27 +149,111 @@ class SqliteDBController(object):
         else:
             return self.db_connector.is_connected
 
-    def copy_table(self, source_db_connector: DBConnector, table_name):
+    def copy_table(self, source_db_connector: DBConnector, table_name, native: bool = True,
+                   chunk_size: int = None):
+        """Copy table from the source database, replacing the table of the same name
+
+        Args:
+            source_db_connector: connector of the source database
+            table_name: name of the table
+            native: when the source is a SQLite file as well, attach it and copy the rows
+                with a single `INSERT INTO ... SELECT` inside SQLite
+            chunk_size: number of rows streamed at a time otherwise, default to
+                `copy_chunk_size`
+        """
 
         if not self.is_connected():
             raise exceptions.DBConnectionError("Target database has not been connected!")
 
-        if not source_db_connector.is_connected:
+        if not source_db_connector.is_connected():
             raise exceptions.DBConnectionError("Source database has not been connected!")
 
         meta = sa.MetaData(source_db_connector.get_engine())
         table = sa.Table(table_name, meta, autoload=True)
 
-        self.db_connector.get_engine().execute("DROP TABLE IF EXISTS " + table_name)
-        table.create(self.db_connector.get_engine())
+        engine = self.db_connector.get_engine()
+        engine.execute("DROP TABLE IF EXISTS " + table_name)
+        # indexes are created after the rows are written
+        engine.execute(CreateTable(table))
+
+        source_path = self._attachable_path(source_db_connector)
+        if native and source_path is not None:
+            n_rows = self._copy_table_attached(source_path, table)
+        else:
+            n_rows = self._copy_table_chunked(source_db_connector, table,
+                                              chunk_size or self.copy_chunk_size)
 
-        rows = source_db_connector.get_engine().execute(table.select()).fetchall()
-        with self.db_connector.get_engine().begin() as con:
-            con.execute(table.insert(), rows)
+        for index in table.indexes:
+            index.create(bind=engine)
+        logging.debug("Copied %s rows of table %s" % (n_rows, table_name))
 
         return True
 
+    def _attachable_path(self, source_db_connector: DBConnector):
+        """Path of the source database file if both databases are SQLite files"""
+        db_config = source_db_connector.db_config
+        if self.db_config.type != 'sqlite' or db_config.type != 'sqlite':
+            return None
+        if not db_config.path or not os.path.isfile(db_config.path):
+            return None
+        return os.path.abspath(db_config.path)
+
+    def _copy_table_attached(self, source_path: str, table):
+        with self.db_connector.get_engine().connect() as con:
+            # ATTACH is not allowed inside a transaction
+            con.execute("ATTACH DATABASE ? AS copy_source", source_path)
+            try:
+                with con.begin():
+                    result = con.execute('INSERT INTO main."%s" SELECT * FROM copy_source."%s"'
+                                         % (table.name, table.name))
+                    n_rows = result.rowcount
+            finally:
+                con.execute("DETACH DATABASE copy_source")
+        return n_rows
+
+    def _copy_table_chunked(self, source_db_connector: DBConnector, table, chunk_size: int):
+        n_rows = 0
+        source = source_db_connector.get_engine().execution_options(stream_results=True)
+        with source.connect() as source_con:
+            result = source_con.execute(table.select())
+            with self.db_connector.get_engine().begin() as con:
+                while True:
+                    rows = result.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    con.execute(table.insert(), [dict(row) for row in rows])
+                    n_rows += len(rows)
+            result.close()
+        return n_rows
+
+    def is_compact(self):
+        """Whether the nodes and names are stored in the compact schema"""
+        engine = self.db_connector.get_engine()
+        return engine.dialect.has_table(engine, TaxonNodesCompact.__tablename__)
+
+    def _read_taxon_nodes(self):
+        """Read tax_id, parent_tax_id and rank of all nodes. Ranks of the compact schema are
+        read as codes and returned as categorical instead of one string per node."""
+        engine = self.db_connector.get_engine()
+        if not self.is_compact():
+            return pd.read_sql(
+                sa.select([TaxonNodes.tax_id, TaxonNodes.parent_tax_id, TaxonNodes.rank]), engine)
+
+        df_nodes = pd.read_sql(sa.select([TaxonNodesCompact.tax_id,
+                                          TaxonNodesCompact.parent_tax_id,
+                                          TaxonNodesCompact.rank_code]), engine)
+        ranks = pd.read_sql(sa.select([TaxonRanks.code, TaxonRanks.rank]), engine,
+                            index_col='code')['rank']
+        rank_codes = df_nodes.pop('rank_code')
+        present = rank_codes.notnull().to_numpy()
+        positions = np.full(len(rank_codes), -1, dtype=np.int64)
+        positions[present] = ranks.index.get_indexer(rank_codes[present])
+        df_nodes['rank'] = pd.Categorical.from_codes(positions, categories=ranks.to_numpy())
+        return df_nodes
+
     def close(self):
+        # connections are closed first, so that all writes are in the file when the S3 file
+        # checks whether it has been modified
         self.db_connector.close()
         if self._is_s3:
             self._s3_file.close()
@@ -123,62 +266,655 @@ class TaxonomyDBCreator(SqliteDBController):
 
     taxon_file = "ftp://ftp.ncbi.nih.gov/pub/taxonomy/taxdump.tar.gz"
     nodes_columns = ["tax_id", "parent_tax_id", "rank", "embl_code", "division_id",
-                     "inherited_div_flg", "genetic_code_id", "inherited_GC_flag",
+                     "inherited_div_flag", "genetic_code_id", "inherited_GC_flag",
                      "mito_genetic_code_id", "inherited_MGC_flag", "GenBank_hidden_flag",
                      "hidden_subtree_root_flag", "comments"]
     names_columns = ["tax_id", "name_txt", "unique_name", "name_class"]
+    delnodes_columns = ["tax_id"]
+    merged_columns = ["old_tax_id", "new_tax_id"]
+    nodes_dtype = {"tax_id": "int64", "parent_tax_id": "int64", "rank": "category"}
+    names_dtype = {"tax_id": "int64", "name_class": "category"}
+    scientific_name_class = "scientific name"
+    name_index_tables = [
+        (TaxonSynonyms.fts_table, TaxonSynonyms.__tablename__, "unicode61 remove_diacritics 2"),
+        (TaxonNames.trigram_table, TaxonNames.__tablename__, "trigram"),
+    ]
+    delnodes_dtype = {"tax_id": "int64"}
+    merged_dtype = {"old_tax_id": "int64", "new_tax_id": "int64"}
+    chunk_size = DEFAULT_CHUNK_SIZE
+    bulk_load_pragmas = {"journal_mode": "OFF", "synchronous": "OFF", "cache_size": -512000,
+                         "temp_store": "MEMORY"}
+    # views named after the regular tables, whose triggers write through to the compact tables
+    compact_schema_sql = {
+        TaxonNodesCompact.__tablename__: [
+            """CREATE VIEW taxon_nodes AS
+            SELECT n.tax_id AS id, n.tax_id AS tax_id, n.parent_tax_id AS parent_tax_id,
+                r.rank AS rank, n.embl_code AS embl_code,
+                CAST(n.division_id AS TEXT) AS division_id,
+                n.flags & 1 AS inherited_div_flag,
+                CAST(n.genetic_code_id AS TEXT) AS genetic_code_id,
+                CAST((n.flags >> 1) & 1 AS TEXT) AS inherited_GC_flag,
+                CAST(n.mito_genetic_code_id AS TEXT) AS mito_genetic_code_id,
+                CAST((n.flags >> 2) & 1 AS TEXT) AS inherited_MGC_flag,
+                CAST((n.flags >> 3) & 1 AS TEXT) AS GenBank_hidden_flag,
+                CAST((n.flags >> 4) & 1 AS TEXT) AS hidden_subtree_root_flag
+            FROM taxon_nodes_compact n LEFT JOIN taxon_ranks r ON r.code = n.rank_code""",
+            """CREATE TRIGGER taxon_nodes_insert INSTEAD OF INSERT ON taxon_nodes BEGIN
+                INSERT OR IGNORE INTO taxon_ranks (code, rank)
+                VALUES ((SELECT COALESCE(MAX(code) + 1, 0) FROM taxon_ranks), NEW.rank);
+                INSERT INTO taxon_nodes_compact (tax_id, parent_tax_id, rank_code, embl_code,
+                    division_id, genetic_code_id, mito_genetic_code_id, flags)
+                VALUES (NEW.tax_id, NEW.parent_tax_id,
+                    (SELECT code FROM taxon_ranks WHERE rank = NEW.rank), NEW.embl_code,
+                    NEW.division_id, NEW.genetic_code_id, NEW.mito_genetic_code_id,
+                    (COALESCE(CAST(NEW.inherited_div_flag AS INTEGER), 0) != 0)
+                    | ((COALESCE(CAST(NEW.inherited_GC_flag AS INTEGER), 0) != 0) << 1)
+                    | ((COALESCE(CAST(NEW.inherited_MGC_flag AS INTEGER), 0) != 0) << 2)
+                    | ((COALESCE(CAST(NEW.GenBank_hidden_flag AS INTEGER), 0) != 0) << 3)
+                    | ((COALESCE(CAST(NEW.hidden_subtree_root_flag AS INTEGER), 0) != 0) << 4));
+            END""",
+            """CREATE TRIGGER taxon_nodes_update INSTEAD OF UPDATE ON taxon_nodes BEGIN
+                INSERT OR IGNORE INTO taxon_ranks (code, rank)
+                VALUES ((SELECT COALESCE(MAX(code) + 1, 0) FROM taxon_ranks), NEW.rank);
+                UPDATE taxon_nodes_compact SET tax_id = NEW.tax_id,
+                    parent_tax_id = NEW.parent_tax_id,
+                    rank_code = (SELECT code FROM taxon_ranks WHERE rank = NEW.rank),
+                    embl_code = NEW.embl_code, division_id = NEW.division_id,
+                    genetic_code_id = NEW.genetic_code_id,
+                    mito_genetic_code_id = NEW.mito_genetic_code_id,
+                    flags = (COALESCE(CAST(NEW.inherited_div_flag AS INTEGER), 0) != 0)
+                    | ((COALESCE(CAST(NEW.inherited_GC_flag AS INTEGER), 0) != 0) << 1)
+                    | ((COALESCE(CAST(NEW.inherited_MGC_flag AS INTEGER), 0) != 0) << 2)
+                    | ((COALESCE(CAST(NEW.GenBank_hidden_flag AS INTEGER), 0) != 0) << 3)
+                    | ((COALESCE(CAST(NEW.hidden_subtree_root_flag AS INTEGER), 0) != 0) << 4)
+                WHERE tax_id = OLD.tax_id;
+            END""",
+            """CREATE TRIGGER taxon_nodes_delete INSTEAD OF DELETE ON taxon_nodes BEGIN
+                DELETE FROM taxon_nodes_compact WHERE tax_id = OLD.tax_id;
+            END""",
+        ],
+        TaxonNamesCompact.__tablename__: [
+            """CREATE VIEW taxon_names AS
+            SELECT tax_id AS id, tax_id, name_txt, unique_name FROM taxon_names_compact""",
+            """CREATE TRIGGER taxon_names_insert INSTEAD OF INSERT ON taxon_names BEGIN
+                INSERT INTO taxon_names_compact (tax_id, name_txt, unique_name)
+                VALUES (NEW.tax_id, NEW.name_txt, NEW.unique_name);
+            END""",
+            """CREATE TRIGGER taxon_names_update INSTEAD OF UPDATE ON taxon_names BEGIN
+                UPDATE taxon_names_compact SET tax_id = NEW.tax_id, name_txt = NEW.name_txt,
+                    unique_name = NEW.unique_name
+                WHERE tax_id = OLD.tax_id;
+            END""",
+            """CREATE TRIGGER taxon_names_delete INSTEAD OF DELETE ON taxon_names BEGIN
+                DELETE FROM taxon_names_compact WHERE tax_id = OLD.tax_id;
+            END""",
+        ],
+    }
     names_file = "names.dmp"
     nodes_file = "nodes.dmp"
+    delnodes_file = "delnodes.dmp"
+    merged_file = "merged.dmp"
 
     def __init__(self):
         super().__init__()
+        self.load_stats = {}
+        self.update_stats = {}
+        self._archive_path = None
+        self._compact = False
 
-    def create(self):
+    def create(self, archive: str = None, cache_dir: str = None, compact: bool = False):
+        """Create taxonomy tables from the NCBI taxonomy dump
+
+        Args:
+            archive: path of a pre-downloaded taxdump.tar.gz, no network access is needed
+            cache_dir: local directory caching the downloaded archive, default to `taxondb` in
+                the system temporary directory. The archive is fetched once per build and the
+                download is skipped when the cached copy matches the NCBI `.md5` checksum.
+            compact: store nodes and names in the compact schema: `tax_id` is the rowid of
+                `taxon_nodes_compact` and `taxon_names_compact`, without surrogate ids and
+                their indexes, ranks are codes of `taxon_ranks` and the flags of a node are
+                packed into one integer. `taxon_nodes` and `taxon_names` are views of the
+                compact tables, so readers and `update` work on both schemas.
+        """
+        if not self.is_connected():
+            raise exceptions.DBConnectionError('Controller has not been connected yet.')
+
+        self._archive_path = self._fetch_archive(archive, cache_dir)
+        self._compact = compact
+        self._drop_schema_objects([TaxonNodes.__tablename__, TaxonNames.__tablename__,
+                                   TaxonNodesCompact.__tablename__,
+                                   TaxonNamesCompact.__tablename__, TaxonRanks.__tablename__])
+
+        # all dump files are parsed in one sequential pass over the archive
+        loaders = {self.names_file: self._create_names_data,
+                   self.nodes_file: self._create_nodes_data,
+                   self.delnodes_file: self._create_delnodes_data,
+                   self.merged_file: self._create_merged_data}
+        loaded = set()
+        for file_name, fh in iter_tar_members(self._archive_path, list(loaders), missing_ok=True):
+            loaders[file_name](fh)
+            loaded.add(file_name)
+        for file_name in (self.names_file, self.nodes_file):
+            if file_name not in loaded:
+                raise KeyError("Cannot find target %s in tar file" % file_name)
+        self._create_lineage_data()
+
+    def update(self, archive: str = None, cache_dir: str = None):
+        """Update existing taxonomy tables from a new NCBI taxonomy dump
+
+        The new dump is diffed against the existing tables, nodes in `delnodes.dmp` and the old
+        ids of `merged.dmp` are removed, and only inserted, changed and deleted rows are
+        written, in a single transaction. `taxon_deleted`, `taxon_merged` and `taxon_synonyms`,
+        together with its full text index, are updated the same way.
+
+        Args:
+            archive: path of a pre-downloaded taxdump.tar.gz, no network access is needed
+            cache_dir: local directory caching the downloaded archive
+
+        Returns:
+            dictionary of table name to counts of inserted, updated and deleted rows
+        """
         if not self.is_connected():
             raise exceptions.DBConnectionError('Controller has not been connected yet.')
 
-        self._create_names_data()
-        self._create_nodes_data()
+        engine = self.db_connector.get_engine()
+        for table_class in (TaxonNodes, TaxonNames):
+            if not engine.dialect.has_table(engine, table_class.__tablename__):
+                raise exceptions.TaxonomyDataError(
+                    "Table %s not found, use create() to build the database first."
+                    % table_class.__tablename__)
+        for table_class in (TaxonLineage, TaxonDeleted, TaxonMerged, TaxonSynonyms):
+            if not engine.dialect.has_table(engine, table_class.__tablename__):
+                self.db_connector.create_table(table_class)
+        name_index_tables = self._supported_name_index_tables()
+        if not all(engine.dialect.has_table(engine, fts_table)
+                   for fts_table, _, _ in name_index_tables):
+            self._create_name_index(name_index_tables)
+
+        self._archive_path = self._fetch_archive(archive, cache_dir)
+        targets = [self.names_file, self.nodes_file, self.delnodes_file, self.merged_file]
+        frames = {}
+        for file_name, fh in iter_tar_members(self._archive_path, targets, missing_ok=True):
+            chunks = list(self._read_taxon_data(file_name, fh))
+            frames[file_name] = pd.concat(chunks, ignore_index=True) if chunks else None
+        for file_name in (self.nodes_file, self.names_file):
+            if frames.get(file_name) is None:
+                raise exceptions.TaxonomyDataError("No records found in %s" % file_name)
+
+        removed_ids = set()
+        for file_name, col in [(self.delnodes_file, 'tax_id'), (self.merged_file, 'old_tax_id')]:
+            if frames.get(file_name) is not None:
+                removed_ids.update(frames[file_name][col])
+
+        df_nodes = frames[self.nodes_file]
+        df_nodes = df_nodes.loc[~df_nodes['tax_id'].isin(removed_ids)]
+        df_synonyms = frames[self.names_file]
+        df_synonyms = df_synonyms.loc[~df_synonyms['tax_id'].isin(removed_ids)]
+        df_names = df_synonyms.loc[df_synonyms['name_class'] == self.scientific_name_class]
+        df_lineage = self._build_lineage_data(df_nodes,
+                                              df_names.set_index('tax_id')['name_txt'])
+
+        # diffs are computed first, so the write lock is only held for the changed rows
+        diffs = [(table_class, self._diff_taxon_data(data_frame, table_class))
+                 for table_class, data_frame in [(TaxonNodes, df_nodes),
+                                                 (TaxonNames, df_names),
+                                                 (TaxonLineage, df_lineage)]]
+        for table_class, file_name, columns in [
+                (TaxonDeleted, self.delnodes_file, self.delnodes_columns),
+                (TaxonMerged, self.merged_file, self.merged_columns)]:
+            data_frame = frames.get(file_name)
+            if data_frame is None:
+                data_frame = pd.DataFrame({col: pd.Series(dtype='int64') for col in columns})
+            diffs.append((table_class, self._diff_taxon_data(data_frame, table_class,
+                                                             key=columns[0])))
+        synonym_diff = self._diff_synonym_data(df_synonyms)
+
+        stats = {}
+        raw_conn = engine.raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            for table_class, diff in diffs:
+                apply_diff = self._apply_names_diff if table_class is TaxonNames \
+                    else self._apply_taxon_diff
+                stats[table_class.__tablename__] = apply_diff(cursor, table_class, *diff)
+            stats[TaxonSynonyms.__tablename__] = self._apply_synonym_diff(cursor, *synonym_diff)
+            raw_conn.commit()
+        except Exception as e:
+            raw_conn.rollback()
+            logging.error("TaxonomyCreator: DB connection error: %s" % e)
+            raise e
+        finally:
+            raw_conn.close()
+
+        for table_name, counts in stats.items():
+            logging.debug("TaxonomyCreator: %s: %s inserted, %s updated, %s deleted"
+                          % (table_name, counts['inserted'], counts['updated'],
+                             counts['deleted']))
+        self.update_stats = stats
+        return stats
+
+    def _diff_taxon_data(self, data_frame, table_class, key='tax_id'):
+        """Compare new rows against the existing table by the key column
+
+        Returns:
+            Tuple of deleted keys, data frame of inserted rows and data frame of updated rows
+        """
+        columns = [col.name for col in table_class.__table__.columns if col.name != 'id']
+        df_old = pd.read_sql(sa.select([table_class.__table__.c[col] for col in columns]),
+                             self.db_connector.get_engine())
+        df_old = self._normalize_taxon_data(df_old, table_class).set_index(key)
+        df_new = self._normalize_taxon_data(data_frame[columns], table_class).set_index(key)
+
+        deleted = df_old.index.difference(df_new.index)
+        inserted = df_new.index.difference(df_old.index)
+        common = df_old.index.intersection(df_new.index)
+        if df_new.columns.empty:
+            return deleted, df_new.loc[inserted], df_new.loc[common[:0]]
+        old_hash = pd.util.hash_pandas_object(df_old.loc[common], index=False).to_numpy()
+        new_hash = pd.util.hash_pandas_object(df_new.loc[common], index=False).to_numpy()
+        updated = common[old_hash != new_hash]
+
+        return deleted, df_new.loc[inserted], df_new.loc[updated]
+
+    def _diff_synonym_data(self, data_frame):
+        """Compare new names against `taxon_synonyms`. Names have no natural key, so whole rows
+        are compared and a changed name is a deletion plus an insertion.
+
+        Returns:
+            Tuple of ids of the deleted rows and data frame of inserted rows
+        """
+        columns = [col.name for col in TaxonSynonyms.__table__.columns if col.name != 'id']
+        df_old = pd.read_sql(sa.select([TaxonSynonyms.__table__.c[col]
+                                        for col in ['id'] + columns]),
+                             self.db_connector.get_engine())
+        df_old = self._normalize_taxon_data(df_old, TaxonSynonyms)
+        df_new = self._normalize_taxon_data(data_frame[columns], TaxonSynonyms)
+
+        old_hash = pd.util.hash_pandas_object(df_old[columns], index=False).to_numpy()
+        new_hash = pd.util.hash_pandas_object(df_new, index=False).to_numpy()
+        deleted = df_old['id'].to_numpy()[~np.isin(old_hash, new_hash)]
+        return deleted, df_new.loc[~np.isin(new_hash, old_hash)]
+
+    @staticmethod
+    def _apply_synonym_diff(cursor, deleted, inserted):
+        table_name = TaxonSynonyms.__tablename__
+        fts_table = TaxonSynonyms.fts_table
+        deleted_ids = [(int(row_id),) for row_id in deleted]
+
+        # rows leave the external content index before they leave the table
+        indexed = _has_table(cursor, fts_table)
+        if indexed:
+            cursor.executemany("INSERT INTO {0}({0}, rowid, name_txt) SELECT 'delete', id, "
+                               "name_txt FROM {1} WHERE id = ?".format(fts_table, table_name),
+                               deleted_ids)
+        cursor.executemany("DELETE FROM %s WHERE id = ?" % table_name, deleted_ids)
+
+        max_id = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM %s" % table_name).fetchone()[0]
+        columns = list(inserted.columns)
+        cursor.executemany("INSERT INTO %s (%s) VALUES (%s)"
+                           % (table_name, ", ".join(columns), ", ".join(["?"] * len(columns))),
+                           inserted.astype(object).itertuples(index=False, name=None))
+        if indexed:
+            cursor.execute("INSERT INTO %s (rowid, name_txt) SELECT id, name_txt FROM %s "
+                           "WHERE id > ?" % (fts_table, table_name), (max_id,))
+
+        return {'inserted': len(inserted), 'updated': 0, 'deleted': len(deleted_ids)}
+
+    @staticmethod
+    def _normalize_taxon_data(data_frame, table_class):
+        """Convert columns to comparable types: integer columns to float with NaN, other
+        columns to objects with None.
+        """
+        data_frame = data_frame.copy()
+        for col in data_frame.columns:
+            if col in ('tax_id', 'old_tax_id'):
+                continue
+            if isinstance(table_class.__table__.c[col].type, sa.Integer):
+                data_frame[col] = pd.to_numeric(data_frame[col], errors='coerce').astype('float64')
+            else:
+                values = data_frame[col].astype(object)
+                data_frame[col] = values.where(values.notnull(), None)
+        return data_frame
+
+    @staticmethod
+    def _apply_taxon_diff(cursor, table_class, deleted, inserted, updated):
+        table_name = table_class.__tablename__
+        key = inserted.index.name
+        columns = list(inserted.columns)
+
+        def _records(data_frame):
+            values = [[None if pd.isnull(v) else int(v) for v in data_frame[col]]
+                      if data_frame[col].dtype == np.float64 else list(data_frame[col])
+                      for col in columns]
+            return list(zip(*values, data_frame.index.tolist()))
+
+        cursor.executemany("DELETE FROM %s WHERE %s = ?" % (table_name, key),
+                           [(int(tid),) for tid in deleted])
+        placeholders = ", ".join(["?"] * (len(columns) + 1))
+        cursor.executemany("INSERT INTO %s (%s) VALUES (%s)"
+                           % (table_name, ", ".join(columns + [key]), placeholders),
+                           _records(inserted))
+        if columns:
+            cursor.executemany("UPDATE %s SET %s WHERE %s = ?"
+                               % (table_name, ", ".join("%s = ?" % col for col in columns), key),
+                               _records(updated))
+
+        return {'inserted': len(inserted), 'updated': len(updated), 'deleted': len(deleted)}
+
+    @classmethod
+    def _apply_names_diff(cls, cursor, table_class, deleted, inserted, updated):
+        """Apply the diff of `taxon_names` and keep its trigram index in step"""
+        fts_table = TaxonNames.trigram_table
+        table_name = TaxonNames.__tablename__
+        removed = [(int(tid),) for tid in deleted.append(updated.index)]
+        added = [(int(tid),) for tid in inserted.index.append(updated.index)]
+
+        if not _has_table(cursor, fts_table):
+            return cls._apply_taxon_diff(cursor, table_class, deleted, inserted, updated)
+
+        cursor.executemany("INSERT INTO {0}({0}, rowid, name_txt) SELECT 'delete', id, name_txt "
+                           "FROM {1} WHERE tax_id = ?".format(fts_table, table_name), removed)
+        stats = cls._apply_taxon_diff(cursor, table_class, deleted, inserted, updated)
+        cursor.executemany("INSERT INTO {0}(rowid, name_txt) SELECT id, name_txt FROM {1} "
+                           "WHERE tax_id = ?".format(fts_table, table_name), added)
+        return stats
+
+    def _create_nodes_data(self, fh=None):
+        if fh is None:
+            fh = self._open_taxon_file(self.nodes_file)
+        data_frames = self._read_taxon_data(self.nodes_file, fh)
+        if not self._compact:
+            self._write_taxon_data(data_frames, TaxonNodes)
+            return True
+
+        rank_codes = {}
+        self._write_taxon_data((self._compact_nodes_data(data_frame, rank_codes)
+                                for data_frame in data_frames), TaxonNodesCompact)
+        self._write_taxon_data(pd.DataFrame({'code': list(rank_codes.values()),
+                                             'rank': list(rank_codes)}), TaxonRanks)
+        self._create_compact_view(TaxonNodesCompact)
+        return True
+
+    @staticmethod
+    def _compact_nodes_data(data_frame, rank_codes: dict):
+        """Convert nodes to the columns of `taxon_nodes_compact`
+
+        Args:
+            data_frame: data frame of nodes
+            rank_codes: dictionary of rank to code, new ranks are added to it
+        """
+        ranks = data_frame['rank'].astype(object)
+        for rank in ranks.dropna().unique():
+            rank_codes.setdefault(rank, len(rank_codes))
+
+        df_compact = data_frame[['tax_id', 'parent_tax_id']].copy()
+        df_compact['rank_code'] = ranks.map(rank_codes)
+        # code columns are converted to integers by the column affinity
+        for col in ['embl_code', 'division_id', 'genetic_code_id', 'mito_genetic_code_id']:
+            df_compact[col] = data_frame[col]
+        flags = np.zeros(len(data_frame), dtype=np.int64)
+        for bit, col in enumerate(TaxonNodesCompact.flag_columns):
+            values = pd.to_numeric(data_frame[col], errors='coerce').fillna(0).to_numpy()
+            flags |= (values != 0).astype(np.int64) << bit
+        df_compact['flags'] = flags
+        return df_compact
+
+    def _create_compact_view(self, table_class):
+        """Create the view and triggers of the compact table, in place of the regular table"""
+        self._drop_schema_objects([table_class.view_name])
+        raw_conn = self.db_connector.get_engine().raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            for sql in self.compact_schema_sql[table_class.__tablename__]:
+                cursor.execute(sql)
+            raw_conn.commit()
+        finally:
+            raw_conn.close()
+        return True
+
+    def _drop_schema_objects(self, names: list):
+        """Drop tables and views of the names, whichever they are"""
+        engine = self.db_connector.get_engine()
+        for name in names:
+            for object_type, in engine.execute("SELECT type FROM sqlite_master "
+                                               "WHERE name = ? AND type IN ('table', 'view')",
+                                               name).fetchall():
+                engine.execute("DROP %s %s" % (object_type.upper(), name))
+
+    def _create_names_data(self, fh=None):
+        """Load every name class into `taxon_synonyms`, then copy the scientific names into
+        `taxon_names` inside the database and build the full text index of all names."""
+        if fh is None:
+            fh = self._open_taxon_file(self.names_file)
+        self._write_taxon_data(self._read_taxon_data(self.names_file, fh), TaxonSynonyms)
+        names_table = TaxonNamesCompact if self._compact else TaxonNames
+        self._write_taxon_data(None, names_table, from_select=(
+            "SELECT tax_id, name_txt, unique_name FROM %s WHERE name_class = '%s'"
+            % (TaxonSynonyms.__tablename__, self.scientific_name_class)))
+        if self._compact:
+            self._create_compact_view(TaxonNamesCompact)
+        self._create_name_index()
+        return True
+
+    def _supported_name_index_tables(self):
+        """Return the entries of `name_index_tables` that the linked SQLite library can build.
 
-    def _create_nodes_data(self):
-        self.db_connector.create_table(TaxonNodes)
-        df_nodes = self._download_taxon_data(self.nodes_file, self.nodes_columns)
-        df_nodes.drop('comments', 1, inplace=True)
-        self._write_taxon_data(df_nodes, TaxonNodes)
+        FTS5 is a compile time option and the trigram tokenizer needs SQLite 3.34, an index
+        that cannot be built is skipped with a warning and its lookups are unavailable.
+        """
+        supported = []
+        raw_conn = self.db_connector.get_engine().raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            for fts_table, content_table, tokenize in self.name_index_tables:
+                try:
+                    cursor.execute("CREATE VIRTUAL TABLE temp.taxondb_fts_probe "
+                                   "USING fts5(name_txt, tokenize='%s')" % tokenize)
+                    cursor.execute("DROP TABLE temp.taxondb_fts_probe")
+                except sqlite3.OperationalError as err:
+                    logging.warning("TaxonomyCreator: SQLite %s cannot build the FTS5 index %s "
+                                    "(%s), skipped." % (sqlite3.sqlite_version, fts_table, err))
+                    continue
+                supported.append((fts_table, content_table, tokenize))
+        finally:
+            raw_conn.close()
+        return supported
+
+    def _create_name_index(self, name_index_tables=None):
+        """(Re)build the FTS5 indexes of the names, as external content tables so that the
+        names are not stored twice:
+
+            - word index of all names in `taxon_synonyms`
+            - trigram index of the scientific names in `taxon_names` for fuzzy matching
+
+        Args:
+            name_index_tables: the indexes to build, defaults to those supported by SQLite
+        """
+        if name_index_tables is None:
+            name_index_tables = self._supported_name_index_tables()
+        logging.debug("TaxonomyCreator: creating full text index of taxonomy names...")
+        raw_conn = self.db_connector.get_engine().raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            for fts_table, content_table, tokenize in name_index_tables:
+                self._create_fts_table(cursor, fts_table, content_table, tokenize)
+                cursor.execute("INSERT INTO {0}({0}) VALUES('rebuild')".format(fts_table))
+            raw_conn.commit()
+        finally:
+            raw_conn.close()
         return True
 
-    def _create_names_data(self):
-        self.db_connector.create_table(TaxonNames)
-        df_names = self._download_taxon_data(self.names_file, self.names_columns)
-        df_names = df_names.loc[df_names['name_class'] == "scientific name", ]
-        df_names.drop('name_class', 1, inplace=True)
-        self._write_taxon_data(df_names, TaxonNames)
+    @staticmethod
+    def _create_fts_table(cursor, fts_table, content_table, tokenize):
+        cursor.execute("DROP TABLE IF EXISTS %s" % fts_table)
+        cursor.execute("CREATE VIRTUAL TABLE %s USING fts5(name_txt, content='%s', "
+                       "content_rowid='id', tokenize='%s')"
+                       % (fts_table, content_table, tokenize))
+
+    def _create_delnodes_data(self, fh=None):
+        if fh is None:
+            fh = self._open_taxon_file(self.delnodes_file)
+        self._write_taxon_data(self._read_taxon_data(self.delnodes_file, fh), TaxonDeleted)
         return True
 
-    def _download_taxon_data(self, filen, col_names):
-        logging.debug("TaxonomyCreator: downloading taxonomy file %s from NCBI..." % filen)
-        file_data = download_file(self.taxon_file)
-        fh = extract_file_from_tar(file_data, filen)
-        df_taxon = pd.read_csv(fh, sep=r'\t\|\t', header=None, index_col=None, engine='python')
-        df_taxon.columns = col_names
-        df_taxon = df_taxon.astype(object).where(pd.notnull(df_taxon), None)
-        # remove "\t|" from last column cause by using sep="\t\|\t" in pd.read_csv
-        df_taxon.iloc[:, -1] = [x.replace("\t|", "") for x in list(df_taxon.iloc[:, -1])]
-        logging.debug("Done!")
-        return df_taxon
-
-    def _write_taxon_data(self, data_frame, table_class):
-        logging.debug("TaxonomyCreator: writing taxonomy data to %s..." % table_class.__tablename__)
-        if self.db_connector.create_table(table_class, overwrite=True):
+    def _create_merged_data(self, fh=None):
+        if fh is None:
+            fh = self._open_taxon_file(self.merged_file)
+        self._write_taxon_data(self._read_taxon_data(self.merged_file, fh), TaxonMerged)
+        return True
+
+    def _read_taxon_data(self, filen, fh):
+        """Parse taxonomy dump file into data frame chunks with the columns of its table"""
+        if filen == self.nodes_file:
+            chunks = read_dump(fh, self.nodes_columns, dtype=self.nodes_dtype,
+                               chunksize=self.chunk_size)
+            return (chunk.drop(columns='comments') for chunk in chunks)
+        elif filen == self.names_file:
+            return read_dump(fh, self.names_columns, dtype=self.names_dtype,
+                             chunksize=self.chunk_size)
+        elif filen == self.delnodes_file:
+            return read_dump(fh, self.delnodes_columns, dtype=self.delnodes_dtype,
+                             chunksize=self.chunk_size)
+        elif filen == self.merged_file:
+            return read_dump(fh, self.merged_columns, dtype=self.merged_dtype,
+                             chunksize=self.chunk_size)
+        raise KeyError("Unknown taxonomy dump file %s" % filen)
+
+    def _create_lineage_data(self):
+        """Materialize the lineage of every node into `taxon_lineage`, one row per taxonomy id
+        with the ancestor id and name of each standard rank.
+        """
+        logging.debug("TaxonomyCreator: creating taxonomy lineage data...")
+        engine = self.db_connector.get_engine()
+        df_nodes = self._read_taxon_nodes()
+        names = pd.read_sql(
+            sa.select([TaxonNames.tax_id, TaxonNames.name_txt]), engine, index_col='tax_id')
+        names = names['name_txt']
+
+        df_lineage = self._build_lineage_data(df_nodes, names)
+        self._write_taxon_data(df_lineage, TaxonLineage)
+        return True
+
+    @staticmethod
+    def _build_lineage_data(df_nodes, names):
+        """Build the `taxon_lineage` rows
+
+        Args:
+            df_nodes: data frame of tax_id, parent_tax_id and rank
+            names: pd.Series of names indexed by tax_id
+        """
+        tax_ids = df_nodes['tax_id'].to_numpy()
+        tree = TaxonomyTree.from_nodes(tax_ids, df_nodes['parent_tax_id'], df_nodes['rank'])
+        rank_ids, _ = tree.lineage_matrix(tax_ids, TaxonLineage.ranks)
+
+        df_lineage = pd.DataFrame({'tax_id': tax_ids, 'depth': tree.depth[tax_ids]})
+        for j, rank in enumerate(TaxonLineage.ranks):
+            col_ids = pd.Series(rank_ids[:, j])
+            present = col_ids != 0
+            df_lineage[rank + '_id'] = col_ids.astype(object).where(present, None)
+            col_names = names.reindex(col_ids).reset_index(drop=True)
+            df_lineage[rank + '_name'] = col_names.astype(object).where(present, None)
+        return df_lineage
+
+    def _fetch_archive(self, archive: str = None, cache_dir: str = None):
+        if archive is not None:
+            if not os.path.isfile(archive):
+                raise FileNotFoundError("Cannot find taxonomy archive %s" % archive)
+            return archive
+
+        if cache_dir is None:
+            cache_dir = os.path.join(tempfile.gettempdir(), 'taxondb')
+        logging.debug("TaxonomyCreator: fetching taxonomy archive %s..." % self.taxon_file)
+        return fetch_cached_file(self.taxon_file, cache_dir, md5_url=self.taxon_file + '.md5')
+
+    def _open_taxon_file(self, filen):
+        """Open taxonomy dump file as a stream straight off the archive"""
+        if self._archive_path is None:
+            self._archive_path = self._fetch_archive()
+        logging.debug("TaxonomyCreator: reading taxonomy file %s..." % filen)
+        return extract_file_from_tar(self._archive_path, filen, out_type='stream')
+
+    def _write_taxon_data(self, data_frames, table_class, from_select: str = None):
+        """Bulk load data frame, or iterable of data frame chunks, into a newly created table.
+
+        Rows are streamed chunk by chunk through DBAPI `executemany` in a single transaction with
+        the SQLite bulk load settings applied, and the indexes are created after the data is
+        loaded. Loading statistics are kept in `load_stats`.
+
+        Args:
+            data_frames: data frame or iterable of data frames, ignored if `from_select` is given
+            table_class: model class of the table
+            from_select: SELECT statement, whose columns are the table columns without `id`,
+                to copy rows from another table inside the database
+        """
+        table_name = table_class.__tablename__
+        logging.debug("TaxonomyCreator: writing taxonomy data to %s..." % table_name)
+        if isinstance(data_frames, pd.DataFrame):
+            data_frames = [data_frames]
+
+        if not self.db_connector.create_table(table_class, overwrite=True, indexes=False):
+            return False
+
+        table_columns = [col.name for col in table_class.__table__.columns]
+        start_time = time.time()
+        n_rows = 0
+        raw_conn = self.db_connector.get_engine().raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            default_pragmas = self._set_pragmas(cursor, self.bulk_load_pragmas)
             try:
-                self.db_connector.get_engine().execute(table_class.__table__.insert(),
-                                                       data_frame.to_dict(orient='records'))
-                logging.debug("TaxonomyCreator: done!")
-                return True
+                if from_select is not None:
+                    columns = [col for col in table_columns if col != 'id']
+                    cursor.execute("INSERT INTO %s (%s) %s"
+                                   % (table_name, ", ".join(columns), from_select))
+                    n_rows = cursor.rowcount
+                    data_frames = []
+                for data_frame in data_frames:
+                    columns = [col for col in data_frame.columns if col in table_columns]
+                    if len(columns) < len(data_frame.columns):
+                        logging.warning("TaxonomyCreator: columns %s are not in table %s"
+                                        % (set(data_frame.columns) - set(columns), table_name))
+                    insert_sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+                        table_name, ", ".join(columns), ", ".join(["?"] * len(columns)))
+
+                    for start in range(0, len(data_frame), self.chunk_size):
+                        chunk = data_frame.iloc[start:start + self.chunk_size][columns]
+                        chunk = chunk.astype(object).where(chunk.notnull(), None)
+                        cursor.executemany(insert_sql, chunk.itertuples(index=False, name=None))
+                        n_rows += len(chunk)
+                raw_conn.commit()
             except Exception as e:
+                raw_conn.rollback()
                 logging.error("TaxonomyCreator: DB connection error: %s" % e)
                 raise e
-        return False
+            finally:
+                self._set_pragmas(cursor, default_pragmas)
+        finally:
+            raw_conn.close()
+        load_time = time.time() - start_time
+
+        self.db_connector.create_indexes(table_class)
+        total_time = time.time() - start_time
+
+        self.load_stats[table_name] = {
+            'rows': n_rows,
+            'load_seconds': load_time,
+            'total_seconds': total_time,
+            'rows_per_sec': n_rows / total_time if total_time > 0 else float('inf'),
+        }
+        logging.debug("TaxonomyCreator: wrote %s rows to %s in %.1fs (%.0f rows/sec)"
+                      % (n_rows, table_name, total_time,
+                         self.load_stats[table_name]['rows_per_sec']))
+        return True
+
+    @staticmethod
+    def _set_pragmas(cursor, pragmas: dict):
+        """Apply SQLite pragmas and return their previous values"""
+        previous = {}
+        for name, value in pragmas.items():
+            previous[name] = cursor.execute("PRAGMA %s" % name).fetchone()[0]
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        return previous
 
 
 class TaxonomyDBFinder(SqliteDBController):
@@ -188,12 +924,196 @@ class TaxonomyDBFinder(SqliteDBController):
 
     default_clades = ["superkingdom", "kingdom", "phylum", "class",
                       "order", "family", "genus", "species"]
+    name_cache_size = 1000000
+    lineage_cache_size = 100000
+    lineage_cache_ttl = None
+    name_query_chunk_size = 500
+    LINEAGE_MODES = ['tree', 'table', 'array', 'cte']
+    NAME_MATCH_MODES = ['exact', 'prefix', 'token']
+    fuzzy_candidates = 50
+    fuzzy_max_docs = 1000
+    trigram_cache_size = 100000
+    snapshot_suffix = '.snapshot'
+    # the walk stops at the root, `max_depth` guards against cycles in malformed data. Rows
+    # of the queried node itself come with tax_id 0 unless its rank is requested.
+    lineage_cte_sql = """
+        WITH RECURSIVE lineage(query_id, tax_id, parent_tax_id, rank, depth) AS (
+            SELECT tax_id, tax_id, parent_tax_id, rank, 0
+            FROM taxon_nodes WHERE tax_id IN (%s)
+            UNION ALL
+            SELECT l.query_id, n.tax_id, n.parent_tax_id, n.rank, l.depth + 1
+            FROM lineage l JOIN taxon_nodes n ON n.tax_id = l.parent_tax_id
+            WHERE l.tax_id != l.parent_tax_id AND l.depth < 256
+        ), hits AS (
+            SELECT query_id, tax_id, parent_tax_id, rank, depth,
+                   tax_id != parent_tax_id AND rank IN (%s) AS is_hit
+            FROM lineage
+        )
+        SELECT h.query_id, CASE WHEN h.is_hit THEN h.tax_id ELSE 0 END, h.rank, nm.name_txt
+        FROM hits h LEFT JOIN taxon_names nm ON nm.tax_id = h.tax_id AND h.is_hit
+        WHERE h.is_hit OR h.depth = 0
+        ORDER BY h.query_id, h.depth
+    """
 
     def __init__(self):
         super().__init__()
         self.phylo_tree = None
         self.rev_phylo_tree = None
         self.phylo_rank = None
+        self.tree = None
+        self._snapshot = None
+        self._name_cache = LRUCache(self.name_cache_size)
+        self._trigram_cache = LRUCache(self.trigram_cache_size)
+        self._lineage_cache = LRUCache(self.lineage_cache_size, self.lineage_cache_ttl)
+        self._lineage_mode = 'tree'
+        self.resolve_merged = True
+        self._merged_index = None
+        self._workers = None
+        self._build_lock = threading.RLock()
+
+    @property
+    def lineage_mode(self):
+        """How lineages are resolved
+
+            - tree: walk the in-memory reverse tree built from `taxon_nodes`
+            - table: read the precomputed `taxon_lineage` table, no tree is built
+            - array: walk the array based `TaxonomyTree`, memory-mapped from a snapshot file
+              when `connect_snapshot` is used, otherwise built from `taxon_nodes`
+            - cte: walk `taxon_nodes` inside the database with a recursive query per chunk of
+              ids, nothing is held in memory
+        """
+        return self._lineage_mode
+
+    @lineage_mode.setter
+    def lineage_mode(self, value):
+        if value not in self.LINEAGE_MODES:
+            raise ValueError("Unsupported lineage mode %s" % value)
+        self._lineage_mode = value
+
+    def export_snapshot(self, file_path: str = None):
+        """Write taxonomy tree and names into a binary snapshot file, which can be memory-mapped
+        by `connect_snapshot`. The snapshot records size, modification time and change counter
+        of the database file it is exported from.
+
+        Args:
+            file_path: path of the snapshot file, default to the database path with suffix
+                `.snapshot`
+
+        Return:
+            path of the snapshot file
+        """
+        if file_path is None:
+            file_path = self.db_path + self.snapshot_suffix
+
+        if self.tree is None:
+            self._build_tree()
+
+        logging.debug("TaxonomyFinder: writing taxonomy snapshot to %s..." % file_path)
+        df_names = pd.read_sql(sa.select([TaxonNames.tax_id, TaxonNames.name_txt]),
+                               self.db_connector.get_engine())
+        df_names = df_names.loc[df_names['tax_id'] < len(self.tree)]
+        names = SnapshotNames.from_names(df_names['tax_id'], df_names['name_txt'].to_numpy(),
+                                         len(self.tree))
+        Snapshot.write(file_path, self.tree, names, source_description(self.db_path))
+        return file_path
+
+    def connect_snapshot(self, file_path: str = None, rebuild: bool = False):
+        """Memory-map a snapshot file written by `export_snapshot`. The tree and names are used
+        in place from the page cache, and lineages are resolved without the database.
+
+        The snapshot is checked against the connected database, or when no database is
+        connected against the database it was exported from if that file exists. A snapshot
+        whose database file has changed size, modification time or change counter since the
+        export is stale. Note that every download of a S3 database is a new file.
+
+        Args:
+            file_path: path of the snapshot file, default to the database path with suffix
+                `.snapshot`
+            rebuild: export a stale snapshot again from the connected database instead of
+                rejecting it
+
+        Raises:
+            TaxonomyDataError: the snapshot is stale and is not rebuilt
+        """
+        if file_path is None:
+            file_path = self.db_path + self.snapshot_suffix
+
+        snapshot = Snapshot(file_path)
+        if not self._snapshot_matches(snapshot):
+            snapshot.close()
+            if not (rebuild and self.is_connected()):
+                raise exceptions.TaxonomyDataError(
+                    "Snapshot %s does not match its database, export it again" % file_path)
+            logging.info("TaxonomyFinder: snapshot %s is stale, exporting it again..."
+                         % file_path)
+            self.tree = None
+            self.export_snapshot(file_path)
+            snapshot = Snapshot(file_path)
+
+        self._snapshot = snapshot
+        self.tree = self._snapshot.tree
+        self._lineage_cache.clear()
+        self.lineage_mode = 'array'
+        return True
+
+    def _snapshot_matches(self, snapshot: Snapshot):
+        source = snapshot.meta.get('source')
+        if self.is_connected():
+            db_path = self.db_path
+        elif source is not None and os.path.isfile(source['path']):
+            db_path = source['path']
+        else:
+            # the snapshot is served on its own, there is no database to check it against
+            return True
+        current = source_description(db_path)
+        return source is not None and current is not None and \
+            all(current[key] == source[key] for key in ('size', 'mtime_ns', 'change_counter'))
+
+    def start_workers(self, processes: int = None, chunk_size: int = 100000):
+        """Resolve lineages of large batches in `get_db_taxonomy` on a process pool.
+
+        The array based tree is published once into shared memory and the pool is kept until
+        `stop_workers` or `close`. Lineage mode is switched to `array`, batches with no more than
+        `chunk_size` distinct taxonomy ids are still resolved in this process.
+
+        Args:
+            processes: number of worker processes, default to the number of CPUs
+            chunk_size: number of distinct taxonomy ids sent to a worker at a time
+
+        Requires python 3.8 or later.
+        """
+        # multiprocessing.shared_memory needs python 3.8
+        from .parallel import LineageWorkers
+
+        self.stop_workers()
+        if self.tree is None:
+            self._build_tree()
+        self._workers = LineageWorkers(self.tree, processes, chunk_size)
+        self.lineage_mode = 'array'
+        return True
+
+    def stop_workers(self):
+        if self._workers is not None:
+            self._workers.close()
+            self._workers = None
+        return True
+
+    def configure_lineage_cache(self, maxsize: int = None, ttl: float = None):
+        """Replace the lineage cache, which keeps the resolved lineage of each
+        (taxonomy id, clades) pair for `find_taxid_parents`, `find_taxid_parents_simple` and
+        `get_db_taxonomy`.
+
+        Args:
+            maxsize: maximum number of lineages, 0 disables the cache, `None` for unbounded cache
+            ttl: seconds a lineage stays valid, `None` for no expiry
+        """
+        self._lineage_cache = LRUCache(maxsize, ttl)
+        return True
+
+    def cache_info(self):
+        """Return dictionary of `CacheInfo` of the lineage and name caches, with hits, misses,
+        evictions, expired entries and sizes"""
+        return {'lineages': self._lineage_cache.info(), 'names': self._name_cache.info()}
 
     def find_taxid_parents(self, tid: int, clades: list = []):
         """return taxonomy parents of requested taxonomy id
@@ -214,37 +1134,277 @@ class TaxonomyDBFinder(SqliteDBController):
             Tuple of two dictionaries contain parent taxonomy ids and names
         """
 
-        if self.rev_phylo_tree is None:
-            self._build_rev_phylo_tree()
+        return self.find_taxid_parents_batch([tid], clades)[0]
 
-        phylo_tree = self.rev_phylo_tree
-        phylo_rank = self.phylo_rank
+    def find_taxid_parents_batch(self, tids, clades: list = []):
+        """Batch version of `find_taxid_parents`, the lineages of all distinct taxonomy ids are
+        resolved together.
+
+        Args:
+            tids: list(int), np.ndarray, pd.Series: taxonomy ids
+            clades: list of taxonomy ranks that need to be included in the result
+
+        Returns:
+            list of tuples of parent taxonomy ids and names dictionaries in input order,
+            (None, None) for unknown taxonomy ids
+        """
         if len(clades) < 1:
             clades = self.default_clades
+        tids = np.asarray(tids, dtype=np.int64)
+        if self.resolve_merged:
+            tids, _ = self.resolve_merged_taxids(tids)
 
-        routes = list()
+        codes, uniq_tids = pd.factorize(tids)
+        rank_ids, found, tid_names = self._resolve_lineages(uniq_tids, clades)
 
-        if tid not in phylo_tree:
-            return None, None
+        lineages = []
+        for i in range(len(uniq_tids)):
+            if not found[i]:
+                lineages.append((None, None))
+                continue
+            rank_tids = {clade: int(rank_id) for clade, rank_id in zip(clades, rank_ids[i])
+                         if rank_id != 0}
+            lineages.append((rank_tids, {rank_id: tid_names[rank_id]
+                                         for rank_id in rank_tids.values()
+                                         if rank_id in tid_names}))
+        return [lineages[code] for code in codes]
 
-        def _walk(tid):
-            if tid == phylo_tree[tid]:
-                return
-            routes.append([tid, phylo_rank[tid]])
-            _walk(phylo_tree[tid])
-        _walk(tid)
+    def _walk_rev_phylo_tree(self, tid: int, clades):
+        """Walk the reverse tree from `tid` up to the root
 
-        rank_tids = {}
-        tid_names = {}
+        Return:
+            dictionary of rank to ancestor taxonomy id, `None` if the id is not in the tree
+        """
+        phylo_tree = self.rev_phylo_tree
+        phylo_rank = self.phylo_rank
 
-        for tid, rank in routes:
+        if tid not in phylo_tree:
+            return None
+
+        rank_tids = {}
+        while tid != phylo_tree[tid]:
+            rank = phylo_rank[tid]
             if rank in clades:
                 rank_tids[rank] = tid
-                tid_name = self.db_connector.session.query(TaxonNames.name_txt).filter(
-                    TaxonNames.tax_id == tid).first()
-                tid_names[tid] = tid_name[0]
+            tid = phylo_tree[tid]
+        return rank_tids
 
-        return rank_tids, tid_names
+    def find_taxid_names(self, tids):
+        """Obtain scientific names of taxonomy ids.
+
+        Names are fetched with chunked `IN (...)` queries and kept in a bounded LRU cache, so the
+        number of queries depends on the number of distinct uncached ids only.
+
+        Args:
+            tids: iterable of taxonomy ids
+
+        Returns:
+            dictionary of taxonomy id to name, unknown ids are omitted
+        """
+        if self._snapshot is not None:
+            return self._snapshot.names.get_many(set(tids))
+
+        tid_names, missing = self._name_cache.get_many({int(tid) for tid in tids})
+
+        chunk_size = self.name_query_chunk_size
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            fetched = dict(self.db_connector.session.query(
+                TaxonNames.tax_id,
+                TaxonNames.name_txt)
+                .filter(TaxonNames.tax_id.in_(chunk))
+                .all())
+            self._name_cache.put_many(fetched)
+            tid_names.update(fetched)
+
+        return tid_names
+
+    def find_taxids_by_names(self, names, mode: str = 'exact', limit: int = None):
+        """Find taxonomy ids of names of any name class (scientific name, synonym, common name,
+        ...). Distinct names are resolved in bulk on the indexes of `taxon_synonyms`.
+
+        Example:
+            find_taxids_by_names(["human", "Escherichia"], mode='prefix')
+            return:
+                          name  tax_id          name_txt           name_class
+                0        human    9606             human  genbank common name
+                1  Escherichia     561       Escherichia      scientific name
+                2  Escherichia     562  Escherichia coli      scientific name
+
+        Args:
+            names: iterable of names
+            mode: how names are matched, case insensitive
+                - exact: the whole name
+                - prefix: names starting with the query
+                - token: names containing all the words of the query, in any order
+            limit: maximum number of matches of each name in prefix and token mode
+
+        Returns:
+            pd.DataFrame with columns name (the query), tax_id, name_txt (the matched name) and
+            name_class, names without any match are omitted
+        """
+        if mode not in self.NAME_MATCH_MODES:
+            raise ValueError("Unsupported name match mode %s" % mode)
+        if not self.is_connected():
+            raise exceptions.DBConnectionError("No database has been connected!")
+
+        engine = self.db_connector.get_engine()
+        required = TaxonSynonyms.fts_table if mode == 'token' else TaxonSynonyms.__tablename__
+        if not engine.dialect.has_table(engine, required):
+            raise exceptions.TaxonomyDataError(
+                "Table %s not found, the database needs to be rebuilt by TaxonomyDBCreator."
+                % required)
+
+        uniq_names = pd.unique(pd.Series(list(names), dtype=object).dropna())
+        logging.debug("TaxonomyFinder: looking up %s distinct names, mode %s"
+                      % (len(uniq_names), mode))
+
+        raw_conn = engine.raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            if mode == 'exact':
+                records = self._match_names_exact(cursor, uniq_names)
+            else:
+                records = self._match_names(cursor, uniq_names, mode, limit)
+        finally:
+            raw_conn.close()
+
+        return pd.DataFrame.from_records(records,
+                                         columns=['name', 'tax_id', 'name_txt', 'name_class'])
+
+    def find_taxids_by_fuzzy_names(self, names, limit: int = 1, min_score: float = 0.0):
+        """Find taxonomy ids of misspelled scientific names.
+
+        Candidates are taken from the trigram index of `taxon_names`, which is stored in the
+        database. Only the rarest trigrams of a name are looked up, as many as hit at most
+        `fuzzy_max_docs` names together, and names whose length cannot reach `min_score` are
+        skipped. The candidates sharing the most trigrams with the name are rescored by edit
+        distance.
+
+        Example:
+            find_taxids_by_fuzzy_names(["Escherichia colli", "Homo sapeins"])
+            return:
+                                name  tax_id          name_txt     score
+                0  Escherichia colli     562  Escherichia coli  0.941176
+                1       Homo sapeins    9606      Homo sapiens  0.833333
+
+        Args:
+            names: iterable of names
+            limit: maximum number of candidates of each name
+            min_score: minimum similarity, 1 - edit distance / length of the longer name
+
+        Returns:
+            pd.DataFrame with columns name (the query), tax_id, name_txt (the candidate name) and
+            score, best candidates first, names without any candidate are omitted
+        """
+        if not self.is_connected():
+            raise exceptions.DBConnectionError("No database has been connected!")
+        engine = self.db_connector.get_engine()
+        if not engine.dialect.has_table(engine, TaxonNames.trigram_table):
+            raise exceptions.TaxonomyDataError(
+                "Table %s not found, the database needs to be rebuilt by TaxonomyDBCreator."
+                % TaxonNames.trigram_table)
+
+        uniq_names = pd.unique(pd.Series(list(names), dtype=object).dropna())
+        logging.debug("TaxonomyFinder: fuzzy matching %s distinct names" % len(uniq_names))
+        name_grams = {name: trigrams(name) for name in uniq_names}
+        sql = ("SELECT n.tax_id, n.name_txt FROM {0} f JOIN {1} n ON n.id = f.rowid "
+               "WHERE {0} MATCH ? AND length(n.name_txt) BETWEEN ? AND ? LIMIT {2}"
+               .format(TaxonNames.trigram_table, TaxonNames.__tablename__,
+                       int(self.fuzzy_max_docs)))
+
+        records = []
+        raw_conn = engine.raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            doc_counts = self._trigram_doc_counts(
+                cursor, {gram for grams in name_grams.values() for gram in grams})
+            for name, grams in name_grams.items():
+                query = trigram_query(*select_trigrams(grams, doc_counts, self.fuzzy_max_docs))
+                if query is None:
+                    continue
+                rows = cursor.execute(sql, (query, *length_bounds(len(name), min_score)))
+                candidates = sorted(rows.fetchall(),
+                                    key=lambda row: -trigram_similarity(grams, row[1]))
+                candidates = candidates[:self.fuzzy_candidates]
+                scored = [(similarity(name, name_txt), tax_id, name_txt)
+                          for tax_id, name_txt in candidates]
+                scored.sort(key=lambda hit: -hit[0])
+                records.extend((name, tax_id, name_txt, score)
+                               for score, tax_id, name_txt in scored[:limit]
+                               if score >= min_score)
+        finally:
+            raw_conn.close()
+
+        return pd.DataFrame.from_records(records, columns=['name', 'tax_id', 'name_txt', 'score'])
+
+    def _trigram_doc_counts(self, cursor, grams):
+        """Number of scientific names containing each trigram, read from a `fts5vocab` table of
+        the trigram index in the temporary schema, so read-only databases work as well"""
+        cached, missing = self._trigram_cache.get_many(grams)
+        if not missing:
+            return cached
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.{0} USING fts5vocab(main, {1}, "
+                       "'row')".format(TaxonNames.trigram_vocab_table, TaxonNames.trigram_table))
+        fetched = dict.fromkeys(missing, 0)
+        chunk_size = self.name_query_chunk_size
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            cursor.execute("SELECT term, doc FROM temp.%s WHERE term IN (%s)"
+                           % (TaxonNames.trigram_vocab_table, ", ".join(["?"] * len(chunk))),
+                           chunk)
+            fetched.update(cursor.fetchall())
+        self._trigram_cache.put_many(fetched)
+        cached.update(fetched)
+        return cached
+
+    def _match_names_exact(self, cursor, names):
+        """Chunked `IN (...)` queries, the NOCASE index of `name_txt` makes them case insensitive.
+        Queries and hits are grouped by the same ASCII-only case folding as NOCASE."""
+        queries = {}
+        for name in names:
+            queries.setdefault(_nocase(name), name)
+
+        uniq_keys = list(queries.values())
+        hits = collections.defaultdict(list)
+        chunk_size = self.name_query_chunk_size
+        for start in range(0, len(uniq_keys), chunk_size):
+            chunk = uniq_keys[start:start + chunk_size]
+            cursor.execute("SELECT tax_id, name_txt, name_class FROM %s WHERE name_txt IN (%s) "
+                           "ORDER BY id" % (TaxonSynonyms.__tablename__,
+                                            ", ".join(["?"] * len(chunk))), chunk)
+            for tax_id, name_txt, name_class in cursor.fetchall():
+                hits[_nocase(name_txt)].append((tax_id, name_txt, name_class))
+
+        return [(name, *hit) for name in names for hit in hits.get(_nocase(name), [])]
+
+    @staticmethod
+    def _match_names(cursor, names, mode: str, limit: int = None):
+        """One indexed query per name: a range scan of the NOCASE index for prefixes, a FTS5
+        match for tokens"""
+        if mode == 'prefix':
+            sql = ("SELECT tax_id, name_txt, name_class FROM %s WHERE name_txt >= ? "
+                   "AND name_txt < ? ORDER BY name_txt, id" % TaxonSynonyms.__tablename__)
+        else:
+            sql = ("SELECT s.tax_id, s.name_txt, s.name_class FROM {0} f JOIN {1} s "
+                   "ON s.id = f.rowid WHERE {0} MATCH ? ORDER BY f.rank, s.id"
+                   .format(TaxonSynonyms.fts_table, TaxonSynonyms.__tablename__))
+        if limit is not None:
+            sql += " LIMIT %d" % limit
+
+        records = []
+        for name in names:
+            if mode == 'prefix':
+                if not name:
+                    continue
+                params = _nocase_prefix_range(name)
+            else:
+                tokens = name.split()
+                if not tokens:
+                    continue
+                params = (" ".join('"%s"' % token.replace('"', '""') for token in tokens),)
+            records.extend((name, *hit) for hit in cursor.execute(sql, params).fetchall())
+        return records
 
     def find_taxid_parents_simple(self, tid: int, clades: list = []):
         """
@@ -257,42 +1417,31 @@ class TaxonomyDBFinder(SqliteDBController):
         if len(clades) == 0:
             clades = ["superkingdom", "kingdom", "phylum", "class",
                       "order", "family", "genus", "species"]
-        rank_tids = {}
-        tid_names = {}
-        try:
-            res = self.db_connector.session.query(TaxonNodes).\
-                filter(TaxonNodes.tax_id == tid).first()
-            if res is None:
-                logging.warning("TaxonomyFinder: unknown taxonomy id: %s" % tid)
+        if self.resolve_merged:
+            tid = self._current_taxid(tid)
+
+        # the walk keeps the lowest ancestor of a rank and includes the root, unlike the
+        # lineages of `find_taxid_parents`, so its entries are keyed apart
+        key = ('simple', int(tid), tuple(clades))
+        cached, _ = self._lineage_cache.get_many([key])
+        if key in cached:
+            if cached[key] is None:
                 return None, None
-
-            if res.rank in clades:
-                rank_tids[res.rank] = res.tax_id
-                tid_name = self.db_connector.session.query(TaxonNames.name_txt).filter(
-                    TaxonNames.tax_id == res.tax_id).first()
-                tid_names[res.tax_id] = tid_name[0]
-
-        except Exception as e:
-            logging.error(e)
-            return None, None
-
-        # find all parents until child == parent (root)
-        while res.tax_id != res.parent_tax_id:
+            rank_tids = {clade: rank_id for clade, rank_id in zip(clades, cached[key])
+                         if rank_id != 0}
+        else:
             try:
-                res = self.db_connector.session.query(TaxonNodes).\
-                    filter(TaxonNodes.tax_id == res.parent_tax_id).first()
-                if res.rank in clades:
-                    rank_tids[res.rank] = res.tax_id
-                    tid_name = self.db_connector.session.query(TaxonNames.name_txt).\
-                        filter(TaxonNames.tax_id == res.tax_id).first()
-                    tid_names[res.tax_id] = tid_name[0]
-
-                if len(rank_tids) == len(clades):  # found all clade
-                    break
-
+                rank_tids = self._walk_taxon_nodes(tid, clades)
             except Exception as e:
                 logging.error("TaxonomyFinder: error: %s" % e)
                 return None, None
+            self._lineage_cache.put(key, None if rank_tids is None else
+                                    tuple(rank_tids.get(clade, 0) for clade in clades))
+            if rank_tids is None:
+                logging.warning("TaxonomyFinder: unknown taxonomy id: %s" % tid)
+                return None, None
+
+        tid_names = self.find_taxid_names(rank_tids.values())
 
         # add root information if required
         if 'root' in clades:
@@ -301,14 +1450,66 @@ class TaxonomyDBFinder(SqliteDBController):
 
         return rank_tids, tid_names
 
-    def get_db_taxonomy(self, tids: list, clades: list = [], match_input: bool = False):
+    def _walk_taxon_nodes(self, tid: int, clades):
+        """Walk `taxon_nodes` record by record from `tid` up to the root
+
+        Return:
+            dictionary of rank to ancestor taxonomy id, `None` if the id is not in the database
+        """
+        query = self.db_connector.session.query(TaxonNodes)
+        res = query.filter(TaxonNodes.tax_id == tid).first()
+        if res is None:
+            return None
+
+        rank_tids = {}
+        if res.rank in clades:
+            rank_tids[res.rank] = res.tax_id
+
+        # find all parents until child == parent (root)
+        while res.tax_id != res.parent_tax_id:
+            res = query.filter(TaxonNodes.tax_id == res.parent_tax_id).first()
+            if res.rank in clades:
+                rank_tids[res.rank] = res.tax_id
+
+            if len(rank_tids) == len(clades):  # found all clade
+                break
+        return rank_tids
+
+    def resolve_merged_taxids(self, tids):
+        """Replace taxonomy ids merged by NCBI (`merged.dmp`) by their current ids
+
+        Args:
+            tids: list(int), np.ndarray, pd.Series: taxonomy ids
+
+        Returns:
+            Tuple of np.ndarray(int64) of current taxonomy ids and np.ndarray(bool) of whether
+            each id was remapped
+        """
+        return remap_merged(self._get_merged_index(), tids)
+
+    def _current_taxid(self, tid: int):
+        current, remapped = remap_merged(self._get_merged_index(), [tid])
+        if remapped[0]:
+            logging.debug("TaxonomyFinder: taxonomy id %s was merged into %s"
+                          % (tid, current[0]))
+            return int(current[0])
+        return tid
+
+    def get_db_taxonomy(self, tids, clades: list = [], match_input: bool = False,
+                        report_merged: bool = False):
         """
         Obtain phylogenetic clades of giving taxonomy ids.
 
+        The input is deduplicated first, so the lineage of each distinct taxonomy id is only
+        resolved once and the result is broadcast back to the input order. Merged taxonomy
+        ids are resolved to their current ids unless `resolve_merged` is turned off.
+
         Args:
-            tids: list(int): list of taxonomy ids
+            tids: list(int), np.ndarray, pd.Series: taxonomy ids
             clades: list(str): clade names of phylogenetic tree
             match_input: bool: add missing data into the result to match the total number of queries
+            report_merged: bool: add column `current_tid` with the taxonomy id the lineage was
+                resolved from, which differs from `tid` for merged ids
 
         Returns:
             pd.dataframe: data frame of taxonomy information
@@ -318,59 +1519,278 @@ class TaxonomyDBFinder(SqliteDBController):
 
         if len(clades) < 1:
             clades = self.default_clades
+        clades = list(clades)
+
+        if isinstance(tids, np.ndarray):
+            tid_values = tids
+        else:
+            # an empty list would get the default dtype of empty series, which pandas warns about
+            tid_values = pd.Series(tids, dtype=object if len(tids) == 0 else None).to_numpy()
+
+        codes, uniq_tids = pd.factorize(tid_values)
+        logging.debug("TaxonomyFinder: total number of queried tids is %s (%s distinct)"
+                      % (len(tid_values), len(uniq_tids)))
+
+        current_tids = None
+        if self.resolve_merged:
+            current_tids, remapped = self.resolve_merged_taxids(uniq_tids)
+            logging.debug("TaxonomyFinder: %s merged tids remapped" % remapped.sum())
+            if remapped.any():
+                uniq_tids = current_tids
+        elif report_merged:
+            current_tids = np.asarray(uniq_tids, dtype=np.int64)
+
+        rank_ids, found, tid_names = self._resolve_lineages(uniq_tids, clades)
+        return self._build_taxonomy_frames(tid_values, codes, rank_ids, found, tid_names,
+                                           clades, match_input,
+                                           current_tids if report_merged else None)
+
+    def _use_lineage_table(self, clades):
+        if self.lineage_mode != 'table':
+            return False
+        if not set(clades).issubset(TaxonLineage.ranks):
+            logging.debug("TaxonomyFinder: non-standard ranks requested, walking the tree instead")
+            return False
+        return True
+
+    def _resolve_lineages(self, uniq_tids, clades: list):
+        """Resolve the lineage of every distinct taxonomy id, through the lineage cache.
+
+        Batches with more distinct ids than the cache holds bypass it, as they would only
+        evict each other.
+
+        Args:
+            uniq_tids: distinct taxonomy ids
+            clades: list of taxonomy ranks
 
-        taxon_names = []  # 2D array store all taxonomy names
-        taxon_ids = []  # 2D array store all taxonomy ids
+        Returns:
+            see `_resolve_lineages_uncached`
+        """
+        maxsize = self._lineage_cache.maxsize
+        if maxsize is not None and len(uniq_tids) > maxsize:
+            return self._resolve_lineages_uncached(uniq_tids, clades)
+
+        key_clades = tuple(clades)
+        keys = [(int(tid), key_clades) for tid in uniq_tids]
+        cached, missing = self._lineage_cache.get_many(keys)
+
+        rank_ids = np.zeros((len(keys), len(clades)), dtype=np.int64)
+        found = np.zeros(len(keys), dtype=bool)
+        for i, key in enumerate(keys):
+            row = cached.get(key)
+            if row is not None:
+                rank_ids[i] = row
+                found[i] = True
 
-        query_count = 0
-        logging.debug("TaxonomyFinder: total number of queried tids is %s" % len(tids))
-        for tid in tids:
+        tid_names = {}
+        if missing:
+            rows = np.array([i for i, key in enumerate(keys) if key not in cached],
+                            dtype=np.int64)
+            missing_ids, missing_found, tid_names = self._resolve_lineages_uncached(
+                np.array([key[0] for key in missing], dtype=np.int64), clades)
+            rank_ids[rows] = missing_ids
+            found[rows] = missing_found
+            # not found ids are cached as None
+            self._lineage_cache.put_many({
+                key: tuple(missing_ids[i].tolist()) if missing_found[i] else None
+                for i, key in enumerate(missing)})
+
+        if cached:
+            ancestors = rank_ids[[i for i, key in enumerate(keys) if key in cached]]
+            ancestors = set(np.unique(ancestors[ancestors != 0]).tolist()) - set(tid_names)
+            tid_names.update(self.find_taxid_names(ancestors))
+
+        return rank_ids, found, tid_names
+
+    def _resolve_lineages_uncached(self, uniq_tids, clades: list):
+        """Resolve the lineage of every distinct taxonomy id.
 
-            query_count += 1
-            # print("%s tids haven been processed!" % query_count)
-            if query_count % 1000 == 0:
-                logging.debug("TaxonomyFinder: %s tids have been processed!" % query_count)
+        Args:
+            uniq_tids: distinct taxonomy ids
+            clades: list of taxonomy ranks
 
-            rank_tids, tid_names = self.find_taxid_parents(int(tid), clades)
+        Returns:
+            Tuple of
+                - np.ndarray(int64) of shape (len(uniq_tids), len(clades)), ancestor id of each
+                  clade, 0 if the clade is not in the lineage
+                - np.ndarray(bool), whether the taxonomy id was found
+                - dict of ancestor taxonomy id to name
+        """
+        if self._use_lineage_table(clades):
+            return self._resolve_lineages_table(uniq_tids, clades)
+        if self.lineage_mode == 'array':
+            return self._resolve_lineages_array(uniq_tids, clades)
+        if self.lineage_mode == 'cte':
+            return self._resolve_lineages_cte(uniq_tids, clades)
+
+        if self.rev_phylo_tree is None:
+            self._build_rev_phylo_tree()
 
-            line_name = []
-            line_id = []
+        rank_ids = np.zeros((len(uniq_tids), len(clades)), dtype=np.int64)
+        found = np.zeros(len(uniq_tids), dtype=bool)
+        clade_set = set(clades)
+        ancestors = set()
 
-            line_name.append(tid)
-            line_id.append(tid)
+        for i, tid in enumerate(uniq_tids):
+            if (i + 1) % 100000 == 0:
+                logging.debug("TaxonomyFinder: %s tids have been processed!" % (i + 1))
 
+            rank_tids = self._walk_rev_phylo_tree(int(tid), clade_set)
             if rank_tids is None:
-                if match_input:
-                    line_name.extend([None] * len(clades))
-                    line_id.extend([None] * len(clades))
-                    taxon_names.append(line_name)
-                    taxon_ids.append(line_id)
                 continue
+            found[i] = True
+            rank_ids[i] = [rank_tids.get(clade, 0) for clade in clades]
+            ancestors.update(rank_tids.values())
+
+        # names of all distinct ancestors are resolved in bulk
+        tid_names = self.find_taxid_names(ancestors)
+
+        return rank_ids, found, tid_names
 
-            def_name = "NA"
-            def_id = 0  # for unclassified taxid
-            for clade in clades:
-                if clade in rank_tids:
-                    line_name.append(tid_names[rank_tids[clade]])
-                    line_id.append(rank_tids[clade])
-                    if clade == 'superkingdom':
-                        def_name = tid_names[rank_tids[clade]]
-                    else:
-                        def_name = "unclassified " + tid_names[rank_tids[clade]]
-                else:
-                    line_id.append(def_id)
-                    line_name.append(def_name)
-                    if clade == 'kingdom':
-                        def_name = 'unclassified ' + def_name
-            # print(line_name)
-            taxon_names.append(line_name)
-            taxon_ids.append(line_id)
-
-        df_taxon_names = pd.DataFrame(taxon_names)
-        df_taxon_ids = pd.DataFrame(taxon_ids)
-        clades.insert(0, 'tid')
-        df_taxon_names.columns = clades
-        df_taxon_ids.columns = clades
+    def _resolve_lineages_array(self, uniq_tids, clades: list):
+        """Resolve lineages of the whole batch at once on the array based tree"""
+        if self.tree is None:
+            self._build_tree()
+
+        uniq_tids = np.asarray(uniq_tids, dtype=np.int64)
+        if self._workers is not None and len(uniq_tids) > self._workers.chunk_size:
+            rank_ids, found = self._workers.lineage_matrix(uniq_tids, clades)
+        else:
+            rank_ids, found = self.tree.lineage_matrix(uniq_tids, clades)
+        tid_names = self.find_taxid_names(np.unique(rank_ids[rank_ids != 0]))
+        return rank_ids, found, tid_names
+
+    def _resolve_lineages_cte(self, uniq_tids, clades: list):
+        """Resolve lineages with one recursive query joined to `taxon_names` per chunk of ids.
+
+        Every row of the walk is kept for the queried node itself, so that found ids are known,
+        and for ancestors of the requested ranks. The root is not part of the lineage and, as
+        rows come ordered by depth, the highest ancestor wins when several share a rank.
+        """
+        uniq_tids = np.asarray(uniq_tids, dtype=np.int64)
+        rank_ids = np.zeros((len(uniq_tids), len(clades)), dtype=np.int64)
+        found = np.zeros(len(uniq_tids), dtype=bool)
+        tid_names = {}
+
+        clade_index = {clade: j for j, clade in enumerate(clades)}
+        row_index = pd.Index(uniq_tids)
+        rank_placeholders = ", ".join(["?"] * len(clades)) or "NULL"
+
+        raw_conn = self.db_connector.get_engine().raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            chunk_size = self.name_query_chunk_size
+            for start in range(0, len(uniq_tids), chunk_size):
+                chunk = uniq_tids[start:start + chunk_size].tolist()
+                sql = self.lineage_cte_sql % (", ".join(["?"] * len(chunk)), rank_placeholders)
+                for query_id, tax_id, rank, name_txt in cursor.execute(sql, chunk + list(clades)):
+                    i = row_index.get_loc(query_id)
+                    found[i] = True
+                    if tax_id != 0:
+                        rank_ids[i, clade_index[rank]] = tax_id
+                        tid_names[tax_id] = name_txt
+        finally:
+            raw_conn.close()
+
+        return rank_ids, found, tid_names
+
+    def _resolve_lineages_table(self, uniq_tids, clades: list):
+        """Resolve lineages with chunked indexed queries on the `taxon_lineage` table"""
+        engine = self.db_connector.get_engine()
+        if not engine.dialect.has_table(engine, TaxonLineage.__tablename__):
+            raise exceptions.TaxonomyDataError(
+                "Table %s not found, the database needs to be rebuilt by TaxonomyDBCreator."
+                % TaxonLineage.__tablename__)
+
+        uniq_tids = np.asarray(uniq_tids, dtype=np.int64)
+        rank_ids = np.zeros((len(uniq_tids), len(clades)), dtype=np.int64)
+        found = np.zeros(len(uniq_tids), dtype=bool)
+        tid_names = {}
+
+        columns = [TaxonLineage.tax_id]
+        for clade in clades:
+            columns.extend([getattr(TaxonLineage, clade + '_id'),
+                            getattr(TaxonLineage, clade + '_name')])
+
+        row_index = pd.Index(uniq_tids)
+        chunk_size = self.name_query_chunk_size
+        for start in range(0, len(uniq_tids), chunk_size):
+            chunk = uniq_tids[start:start + chunk_size].tolist()
+            records = self.db_connector.session.query(*columns)\
+                .filter(TaxonLineage.tax_id.in_(chunk))\
+                .all()
+            for rec in records:
+                i = row_index.get_loc(rec[0])
+                found[i] = True
+                for j in range(len(clades)):
+                    rank_id = rec[2 * j + 1]
+                    if rank_id is not None:
+                        rank_ids[i, j] = rank_id
+                        tid_names[rank_id] = rec[2 * j + 2]
+
+        return rank_ids, found, tid_names
+
+    @staticmethod
+    def _build_taxonomy_frames(tid_values, codes, rank_ids, found, tid_names, clades: list,
+                               match_input: bool, current_tids=None):
+        """Build the name and id data frames column by column from the distinct lineages.
+
+        Unclassified defaults are filled in on the distinct taxonomy ids and then broadcast to
+        the input rows through `codes`. Column `current_tid` is added after `tid` when
+        `current_tids` is given.
+        """
+        # one extra "not found" row at the end, so that code -1 (missing input) selects it
+        n_uniq = len(found)
+        rank_ids = np.vstack([rank_ids, np.zeros((1, len(clades)), dtype=np.int64)])
+        found = np.append(found, False)
+
+        ancestor_ids = np.unique(rank_ids[rank_ids != 0])
+        ancestor_names = np.array([tid_names.get(tid) for tid in ancestor_ids] + [None],
+                                  dtype=object)
+
+        row_found = found[codes]
+        if match_input:
+            rows = np.arange(len(codes))
+        else:
+            rows = np.flatnonzero(row_found)
+        row_codes = codes[rows]
+
+        name_columns = {'tid': tid_values[rows]}
+        id_columns = {'tid': tid_values[rows]}
+        leading = ['tid']
+        if current_tids is not None:
+            current_tids = np.append(np.asarray(current_tids, dtype=np.int64), 0)
+            if (row_codes < 0).any():
+                current_col = np.where(row_codes >= 0, current_tids[row_codes], np.nan)
+            else:
+                current_col = current_tids[row_codes]
+            name_columns['current_tid'] = current_col
+            id_columns['current_tid'] = current_col
+            leading.append('current_tid')
+
+        def_name = np.full(n_uniq + 1, "NA", dtype=object)
+        for j, clade in enumerate(clades):
+            col_ids = rank_ids[:, j]
+            present = col_ids != 0
+            idx = np.where(present, np.searchsorted(ancestor_ids, col_ids), len(ancestor_ids))
+            col_names = np.where(present, ancestor_names[idx], def_name)
+
+            if clade == 'superkingdom':
+                def_name = np.where(present, col_names, def_name)
+            else:
+                def_name = np.where(present, "unclassified " + col_names, def_name)
+            if clade == 'kingdom':
+                def_name = np.where(present, def_name, "unclassified " + def_name)
+
+            col_names[~found] = None
+            name_columns[clade] = col_names[row_codes]
+            if row_found[rows].all():
+                id_columns[clade] = col_ids[row_codes]
+            else:
+                id_columns[clade] = np.where(found[row_codes], col_ids[row_codes], np.nan)
+
+        df_taxon_names = pd.DataFrame(name_columns, columns=leading + clades)
+        df_taxon_ids = pd.DataFrame(id_columns, columns=leading + clades)
 
         return df_taxon_names, df_taxon_ids
 
@@ -398,7 +1818,79 @@ class TaxonomyDBFinder(SqliteDBController):
         nodes = _walk(self.phylo_tree[tid])
         return nodes
 
+    def lca(self, tids):
+        """
+        Find the lowest common ancestor of taxonomy IDs. Unknown IDs are ignored.
+
+        Args:
+            tids: list of taxonomy IDs
+
+        Return:
+            taxonomy ID of the lowest common ancestor, None if none of the IDs is known
+        """
+        tid = int(self.lca_many([tids])[0])
+        return tid if tid != 0 else None
+
+    def lca_many(self, groups):
+        """
+        Batched lowest common ancestor queries on the binary lifting table of the array based
+        tree, e.g. the LCA of the hit set of every read.
+
+        Args:
+            groups: iterable of lists of taxonomy IDs
+
+        Return:
+            np.ndarray(int64) of the lowest common ancestor of each group, 0 for groups without
+            any known ID
+        """
+        if self.tree is None:
+            self._build_tree()
+
+        groups = [np.asarray(group, dtype=np.int64).ravel() for group in groups]
+        lengths = [len(group) for group in groups]
+        tids = np.concatenate(groups) if groups else np.zeros(0, dtype=np.int64)
+        group_ids = np.repeat(np.arange(len(groups)), lengths)
+        return self.tree.lca_grouped(tids, group_ids, len(groups))
+
+    def is_descendant(self, tid: int, clade_tid: int, include_self: bool = True):
+        """
+        Check whether a taxonomy ID lies under a clade. It uses the nested set index of the array
+        based tree, so no descendant set is materialized.
+
+        Args:
+            tid: taxonomy ID
+            clade_tid: taxonomy ID of the clade
+            include_self: whether `tid == clade_tid` counts as a descendant
+
+        Return:
+            bool
+        """
+        return bool(self.filter_by_clade([tid], clade_tid, include_self)[0])
+
+    def filter_by_clade(self, tids, clade_tid: int, include_self: bool = True):
+        """
+        Vectorized clade membership test, e.g. `df[finder.filter_by_clade(df['tid'], 2)]` keeps
+        the bacterial rows of a classification table.
+
+        Args:
+            tids: list(int), np.ndarray, pd.Series: taxonomy IDs
+            clade_tid: taxonomy ID of the clade
+            include_self: whether the clade itself counts as a member
+
+        Return:
+            np.ndarray(bool) of whether each taxonomy ID lies under the clade
+        """
+        if self.tree is None:
+            self._build_tree()
+
+        return self.tree.in_clade(np.asarray(tids, dtype=np.int64), clade_tid, include_self)
+
     def _build_phylo_tree(self):
+        with self._build_lock:
+            if self.phylo_tree is None:
+                self._build_phylo_tree_locked()
+
+    def _build_phylo_tree_locked(self):
 
         if not self.is_connected():
             logging.error('TaxonomyFinder: no database has been connected!')
@@ -413,6 +1905,11 @@ class TaxonomyDBFinder(SqliteDBController):
         self.phylo_tree = phylo_tree
 
     def _build_rev_phylo_tree(self):
+        with self._build_lock:
+            if self.rev_phylo_tree is None:
+                self._build_rev_phylo_tree_locked()
+
+    def _build_rev_phylo_tree_locked(self):
 
         if not self.is_connected():
             logging.error('TaxonomyFinder: no database has been connected!')
@@ -432,6 +1929,69 @@ class TaxonomyDBFinder(SqliteDBController):
             phylo_tree[rec.tax_id] = rec.parent_tax_id
             phylo_rank[rec.tax_id] = rec.rank
 
-        self.rev_phylo_tree = phylo_tree
+        # readers check `rev_phylo_tree`, so it is published last
         self.phylo_rank = phylo_rank
+        self.rev_phylo_tree = phylo_tree
+
+    def _build_tree(self):
+        with self._build_lock:
+            if self.tree is None:
+                self._build_tree_locked()
+
+    def _build_tree_locked(self):
+
+        if not self.is_connected():
+            logging.error('TaxonomyFinder: no database has been connected!')
+            raise exceptions.DBConnectionError("No database has been connected!")
+
+        logging.debug("Creating array based taxonomy tree...")
+        df_nodes = self._read_taxon_nodes()
+
+        tree = TaxonomyTree.from_nodes(df_nodes['tax_id'], df_nodes['parent_tax_id'],
+                                       df_nodes['rank'])
+        # kept with the tree so that snapshots carry the merged ids as well
+        tree.merged = self._get_merged_index()
+        self.tree = tree
+
+    def _get_merged_index(self):
+        """Dense index of merged taxonomy ids, taken from the tree when it carries one
+        (snapshot), otherwise read from `taxon_merged`. Databases built before `taxon_merged`
+        was added get an empty index."""
+        if self.tree is not None and self.tree.merged is not None:
+            return self.tree.merged
+        if self._merged_index is not None:
+            return self._merged_index
+        with self._build_lock:
+            if self._merged_index is None:
+                self._merged_index = self._load_merged_index()
+        return self._merged_index
+
+    def _load_merged_index(self):
+
+        old_tax_ids, new_tax_ids = [], []
+        if self.is_connected():
+            engine = self.db_connector.get_engine()
+            if engine.dialect.has_table(engine, TaxonMerged.__tablename__):
+                df_merged = pd.read_sql(
+                    sa.select([TaxonMerged.old_tax_id, TaxonMerged.new_tax_id]), engine)
+                old_tax_ids, new_tax_ids = df_merged['old_tax_id'], df_merged['new_tax_id']
+            else:
+                logging.debug("TaxonomyFinder: table %s not found, merged ids are not remapped"
+                              % TaxonMerged.__tablename__)
+
+        merged_index = build_merged_index(old_tax_ids, new_tax_ids)
+        merged_index.flags.writeable = False
+        return merged_index
+
+    def close(self):
+        self.stop_workers()
+        if self._snapshot is not None:
+            self.tree = None
+            self._snapshot.close()
+            self._snapshot = None
+        self._merged_index = None
+        self._lineage_cache.clear()
+        self._trigram_cache.clear()
+        if self.db_connector is not None:
+            super().close()
 
@@ -4,13 +4,25 @@
 # Copyright (C) Aperiomics, Inc., 2019
 # Written by Alvin Chen <ychen@aperiomics.com>
 # ==============================================================================
-import urllib
+import urllib.request
 import tarfile
 import os
-from io import BytesIO, StringIO
+import socket
+import shutil
+import hashlib
+import logging
+import zlib
+from io import BytesIO, StringIO, BufferedReader, RawIOBase
 from tempfile import mkstemp
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where S3Cache cannot be used
+    fcntl = None
 
 s3 = boto3.resource('s3')
 
@@ -32,14 +44,39 @@ class S3File:
                   exists, temporary file will copy from S3 target first.
         s3_bucket: S3 bucket name. If not provided, it will use environment variable
                    AWS_STORAGE_BUCKET_NAME
+        cache_dir: local cache directory of existing files, see `S3Cache`. If not provided, it
+                   will use environment variable TAXONDB_S3_CACHE_DIR, files are downloaded
+                   without caching if neither is set.
+        cache_size: disk budget of the cache directory in bytes
+        read_only: the file is not modified. A cached file is then used in place instead of
+                   being copied to a temporary file.
+        compression: upload the file compressed, only 'gzip' is supported. Compressed objects
+                   are marked in their metadata and decompressed while they are downloaded,
+                   whatever this setting is.
+        multipart_chunksize: size in bytes of the parts of multipart transfers
+        max_concurrency: number of threads transferring parts in parallel
+        hash_check: compare the md5 checksum of the content as well before uploading a file
+                   whose size, modification time or SQLite change counter differ from when it
+                   was opened
 
     Attributes:
         file (str): full path for local temporary file.
         is_save (boolean): label `True` if the file has been changed in local. The updated file
-                           will be saved to S3 bucket when the object destroyed.
+                           will be saved to S3 bucket when the object destroyed. Changes made
+                           to the local file directly, e.g. by SQLite, are detected by
+                           `is_modified` as well.
     """
 
-    def __init__(self, s3_file: str, is_new_db: bool = False, s3_bucket: str = ''):
+    COMPRESSIONS = ['gzip']
+    compression_metadata_key = 'taxondb-compression'
+    compression_level = 6
+    multipart_chunksize = 64 * 1024 ** 2
+    max_concurrency = 10
+
+    def __init__(self, s3_file: str, is_new_db: bool = False, s3_bucket: str = '',
+                 cache_dir: str = None, cache_size: int = None, read_only: bool = False,
+                 compression: str = None, multipart_chunksize: int = None,
+                 max_concurrency: int = None, hash_check: bool = False):
         self._s3_bucket = s3_bucket
 
         if not s3_bucket:
@@ -53,14 +90,48 @@ class S3File:
         self._is_new_db = is_new_db
         self._is_cleaned = False
         self._is_saved = True
-        handle, self.file = mkstemp()
+        self._cache_lock = None
         self.is_closed = False
+        self.read_only = read_only
+        self.hash_check = hash_check
+        self._saved_fingerprint = None
+        self._saved_md5 = None
+
+        if compression is not None and compression not in self.COMPRESSIONS:
+            raise ValueError("Unsupported compression %s" % compression)
+        self.compression = compression
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_chunksize or self.multipart_chunksize,
+            multipart_chunksize=multipart_chunksize or self.multipart_chunksize,
+            max_concurrency=max_concurrency or self.max_concurrency)
+
+        if cache_dir is None:
+            cache_dir = os.getenv('TAXONDB_S3_CACHE_DIR', None)
+        self.cache = S3Cache(cache_dir, cache_size) if cache_dir and not is_new_db else None
 
         if is_new_db:
             self._is_saved = False
 
-        if not is_new_db:
-            s3.meta.client.download_file(self._s3_bucket, self._s3_file, self.file)
+        if self.cache is not None:
+            head = s3.meta.client.head_object(Bucket=self._s3_bucket, Key=self._s3_file)
+            cached_file, self._cache_lock = self.cache.fetch(
+                self._s3_bucket, self._s3_file, head['ETag'],
+                lambda path: self._download(path, head))
+            if read_only:
+                # the cached copy is shared, it is used in place and never modified
+                self.file = cached_file
+            else:
+                handle, self.file = mkstemp()
+                os.close(handle)
+                shutil.copyfile(cached_file, self.file)
+                self._release_cache()
+        else:
+            handle, self.file = mkstemp()
+            os.close(handle)
+            if not is_new_db:
+                self._download(self.file)
+
+        self._mark_unmodified()
 
     def __del__(self):
         """
@@ -81,8 +152,10 @@ class S3File:
         """
         Close the file writing process and upload file to online storage.
         """
-        if not self._is_saved:
-            s3.meta.client.upload_file(self.file, self._s3_bucket, self._s3_file)
+        if self.is_modified():
+            self._upload()
+        else:
+            logging.debug("S3 file %s is not modified, skip upload" % self._s3_file)
         self.clean()
         self.is_closed = True
         self._is_saved = True
@@ -101,14 +174,19 @@ class S3File:
         Args:
             data: content write to the local file.
         """
+        if self.read_only:
+            raise PermissionError("S3 file %s is opened read-only" % self._s3_file)
         with open(self.file, 'ab') as fh:
             fh.write(data)
         self._is_saved = False
 
     def clean(self):
         """
-        Remove local temporary file.
+        Remove local temporary file. Shared cached copies are kept in the cache.
         """
+        if self._cache_lock is not None:
+            self._release_cache()
+            return
         try:
             os.remove(self.file)
             self._is_cleaned = True
@@ -127,9 +205,319 @@ class S3File:
             return True
 
     def save(self):
-        if not self._is_saved:
-            s3.meta.client.upload_file(self.file, self._s3_bucket, self._s3_file)
+        if self.is_modified():
+            self._upload()
             self._is_saved = True
+            self._mark_unmodified()
+
+    def is_modified(self):
+        """
+        Whether the local file differs from the S3 object, either written by `write` or changed
+        directly since it was downloaded or last saved. Read-only files are never modified.
+
+        Return: boolean
+        """
+        if self.read_only:
+            return False
+        if not self._is_saved:
+            return True
+        if self._saved_fingerprint is None:
+            # the file has not been downloaded
+            return False
+        if self._fingerprint() == self._saved_fingerprint:
+            return False
+        if self._saved_md5 is not None:
+            return file_md5(self.file) != self._saved_md5
+        return True
+
+    def _fingerprint(self):
+        """Size, modification time and SQLite file change counter of the local file"""
+        return sqlite_fingerprint(self.file)
+
+    def _mark_unmodified(self):
+        self._saved_fingerprint = None if self.read_only else self._fingerprint()
+        self._saved_md5 = None
+        if self.hash_check and not self.read_only and self._is_saved:
+            self._saved_md5 = file_md5(self.file)
+
+    def _download(self, file_path: str, head: dict = None):
+        """Download the object to the file. Given the `head` of the object, the download is
+        pinned to that version, so that the content always matches its ETag."""
+        pinned = head is not None
+        if head is None:
+            head = s3.meta.client.head_object(Bucket=self._s3_bucket, Key=self._s3_file)
+        # the version id pins every (ranged) request to the object version, without bucket
+        # versioning the ETag is checked instead
+        version = {'VersionId': head['VersionId']} if pinned and head.get('VersionId') else {}
+        compression = head.get('Metadata', {}).get(self.compression_metadata_key)
+        if compression is None:
+            s3.meta.client.download_file(self._s3_bucket, self._s3_file, file_path,
+                                         ExtraArgs=version, Config=self.transfer_config)
+            if pinned and not version:
+                etag = s3.meta.client.head_object(Bucket=self._s3_bucket,
+                                                  Key=self._s3_file)['ETag']
+                if etag != head['ETag']:
+                    raise ValueError("S3 file s3://%s/%s changed during download"
+                                     % (self._s3_bucket, self._s3_file))
+            return
+
+        if compression not in self.COMPRESSIONS:
+            raise ValueError("Unsupported compression %s of s3://%s/%s"
+                             % (compression, self._s3_bucket, self._s3_file))
+        # a file which was compressed is saved compressed again
+        if self.compression is None:
+            self.compression = compression
+        if pinned:
+            version['IfMatch'] = head['ETag']
+        body = s3.meta.client.get_object(Bucket=self._s3_bucket, Key=self._s3_file,
+                                         **version)['Body']
+        with open(file_path, 'wb') as fh:
+            with BufferedReader(GzipDecompressReader(body)) as reader:
+                shutil.copyfileobj(reader, fh, 1 << 20)
+
+    def _upload(self):
+        if self.compression is None:
+            s3.meta.client.upload_file(self.file, self._s3_bucket, self._s3_file,
+                                       Config=self.transfer_config)
+            return
+
+        extra_args = {'Metadata': {self.compression_metadata_key: self.compression}}
+        with open(self.file, 'rb') as fh:
+            reader = BufferedReader(GzipCompressReader(fh, self.compression_level))
+            s3.meta.client.upload_fileobj(reader, self._s3_bucket, self._s3_file,
+                                          ExtraArgs=extra_args, Config=self.transfer_config)
+
+    def _release_cache(self):
+        self._cache_lock.close()
+        self._cache_lock = None
+
+
+class GzipCompressReader(RawIOBase):
+    """
+    Raw reader returning the gzip compressed content of a file object, compressed as it is read.
+
+    Args:
+        fh: file object of the uncompressed content
+        level: compression level
+        block_size: size of the uncompressed blocks read at a time
+    """
+
+    def __init__(self, fh, level: int = 6, block_size: int = 1 << 20):
+        self._fh = fh
+        self._block_size = block_size
+        # wbits 16 + 15: gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._buffer = b''
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer and not self._eof:
+            block = self._fh.read(self._block_size)
+            if block:
+                self._buffer = self._compressor.compress(block)
+            else:
+                self._buffer = self._compressor.flush()
+                self._eof = True
+        data = self._buffer[:len(buffer)]
+        self._buffer = self._buffer[len(data):]
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class GzipDecompressReader(RawIOBase):
+    """
+    Raw reader returning the decompressed content of a gzip stream, decompressed as it is read.
+
+    Args:
+        stream: file object of the gzip compressed content, e.g. S3 response body
+        block_size: size of the compressed blocks read at a time
+    """
+
+    def __init__(self, stream, block_size: int = 1 << 20):
+        self._stream = stream
+        self._block_size = block_size
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = b''
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer and not self._eof:
+            if self._decompressor.unconsumed_tail:
+                block = self._decompressor.unconsumed_tail
+            else:
+                block = self._stream.read(self._block_size)
+            if block:
+                self._buffer = self._decompressor.decompress(block, self._block_size)
+            else:
+                self._buffer = self._decompressor.flush()
+                if not self._decompressor.eof:
+                    raise EOFError("Compressed stream ended before the end of the data")
+                self._eof = True
+        data = self._buffer[:len(buffer)]
+        self._buffer = self._buffer[len(data):]
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class S3Cache:
+    """
+    Local cache directory of S3 objects shared by the processes of a host. Entries are keyed by
+    bucket, key and ETag, so a changed object is downloaded again while an unchanged one is
+    reused. Each entry has a lock file: a download holds it exclusively, readers of the cached
+    copy hold it shared, and entries in use are never evicted. The locks are `fcntl` file locks,
+    so the cache is not available on Windows.
+
+    Args:
+        cache_dir: cache directory
+        max_size: disk budget of the cache in bytes, least recently used entries are evicted
+            when it is exceeded. `None` for unbounded cache.
+    """
+
+    lock_suffix = '.lock'
+
+    def __init__(self, cache_dir: str, max_size: int = None):
+        if fcntl is None:
+            raise NotImplementedError("S3Cache needs fcntl file locks, which are not available "
+                                      "on this platform")
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, bucket: str, key: str, etag: str):
+        """Path of the cached copy of the object version"""
+        key_hash = hashlib.sha1(('%s/%s' % (bucket, key)).encode('utf-8')).hexdigest()
+        etag = etag.strip('"').replace('/', '_')
+        return os.path.join(self.cache_dir, '%s-%s' % (key_hash, etag))
+
+    def fetch(self, bucket: str, key: str, etag: str, download):
+        """Return the cached copy of the object version, downloading it first if it is missing
+
+        Args:
+            bucket: S3 bucket name
+            key: S3 key
+            etag: ETag of the current object version
+            download: function downloading the object to the path given to it
+
+        Return:
+            Tuple of the path of the cached copy and the open lock file, which holds a shared
+            lock on the entry until it is closed
+        """
+        file_path = self.entry_path(bucket, key, etag)
+        lock_fh = None
+        try:
+            while True:
+                lock_fh = self._lock(lock_fh, file_path + self.lock_suffix, fcntl.LOCK_SH)
+                if os.path.isfile(file_path):
+                    logging.debug("Use cached file %s of s3://%s/%s" % (file_path, bucket, key))
+                    os.utime(file_path)
+                    break
+                # only downloads wait for the exclusive lock, readers of a cached copy never
+                # hold it
+                lock_fh = self._lock(lock_fh, file_path + self.lock_suffix, fcntl.LOCK_EX)
+                if not os.path.isfile(file_path):
+                    logging.debug("Downloading s3://%s/%s to %s..." % (bucket, key, file_path))
+                    self._download(file_path, download)
+                # the lock is released while it is converted, the entry is checked again
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
+        except Exception:
+            if lock_fh is not None:
+                lock_fh.close()
+            raise
+
+        self.evict()
+        return file_path, lock_fh
+
+    @staticmethod
+    def _lock(lock_fh, lock_path: str, operation: int):
+        """Lock the lock file, reopened if eviction removed it while the lock was waited for"""
+        while True:
+            if lock_fh is None:
+                lock_fh = open(lock_path, 'a+b')
+            fcntl.flock(lock_fh, operation)
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(lock_fh.fileno()).st_ino:
+                    return lock_fh
+            except FileNotFoundError:
+                pass
+            lock_fh.close()
+            lock_fh = None
+
+    def _download(self, file_path: str, download):
+        handle, temp_path = mkstemp(dir=self.cache_dir)
+        os.close(handle)
+        try:
+            download(temp_path)
+            os.replace(temp_path, file_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def entries(self):
+        """Return list of tuples of path, size and last use time of the cached copies"""
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            file_path = os.path.join(self.cache_dir, file_name)
+            if not os.path.isfile(file_path + self.lock_suffix):
+                continue
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            entries.append((file_path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries which are not in use until the cache fits in
+        `max_size`
+
+        Return:
+            number of removed entries
+        """
+        if self.max_size is None:
+            return 0
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total_size = sum(size for _, size, _ in entries)
+        n_removed = 0
+        for file_path, size, _ in entries:
+            if total_size <= self.max_size:
+                break
+            with open(file_path + self.lock_suffix, 'a+b') as lock_fh:
+                try:
+                    fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                os.remove(file_path)
+                # waiting fetches notice the removed lock file and lock a new one
+                os.remove(file_path + self.lock_suffix)
+            total_size -= size
+            n_removed += 1
+            logging.debug("Evicted cached file %s" % file_path)
+        return n_removed
+
+
+def sqlite_fingerprint(file_path):
+    """
+    Fingerprint of a SQLite database file, which changes whenever the file is written
+
+    :param file_path: str: path of the database file
+    :return: tuple: size, modification time in ns and the SQLite file change counter, `None`
+        if the file does not exist
+    """
+    try:
+        stat = os.stat(file_path)
+        with open(file_path, 'rb') as fh:
+            # header bytes 24-27, incremented by SQLite on each committed write transaction
+            fh.seek(24)
+            change_counter = int.from_bytes(fh.read(4), 'big')
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns, change_counter
 
 
 def download_file(url, timeout=20, retry=0):
@@ -151,6 +539,7 @@ def download_file(url, timeout=20, retry=0):
     count = 0
 
     while count <= retry:
+        count += 1
         try:
             res = down_task(url, timeout)
             return res
@@ -159,38 +548,111 @@ def download_file(url, timeout=20, retry=0):
         except:
             raise
 
+    raise ConnectionError('Connection Timeout, exit after tried %s times' % count)
+
+
+def fetch_cached_file(url, cache_dir, md5_url=None, timeout=20, retry=0):
+    """
+    Download file from the given url into a local cache directory. The download is skipped when
+    the cached copy matches the md5 checksum published at `md5_url`, or when no checksum is
+    available and the file has been cached before.
+
+    :param url: str: url for the target file
+    :param cache_dir: str: local cache directory
+    :param md5_url: str: url of the md5 checksum file, e.g. NCBI `.md5` sidecar files
+    :param timeout: int: waiting time for download time
+    :param retry: int: number of time retry after connection timeout
+    :return: str: path of the cached file
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    file_path = os.path.join(cache_dir, os.path.basename(urllib.parse.urlparse(url).path))
+
+    expected_md5 = None
+    if md5_url:
+        try:
+            expected_md5 = download_file(md5_url, timeout, retry).read().decode().split()[0]
+        except Exception as e:
+            if not os.path.isfile(file_path):
+                raise
+            logging.warning("Cannot fetch checksum %s: %s, using cached file %s"
+                            % (md5_url, e, file_path))
+
+    if os.path.isfile(file_path):
+        if expected_md5 is None or file_md5(file_path) == expected_md5:
+            logging.debug("Use cached file %s" % file_path)
+            return file_path
+
+    logging.debug("Downloading %s to %s..." % (url, file_path))
+    handle, temp_path = mkstemp(dir=cache_dir)
+    try:
+        with os.fdopen(handle, 'wb') as fh:
+            _download_to_file(url, fh, timeout, retry)
+        if expected_md5 is not None and file_md5(temp_path) != expected_md5:
+            raise ValueError("Checksum mismatch for downloaded file %s" % url)
+        os.replace(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return file_path
+
+
+def _download_to_file(url, fh, timeout=20, retry=0):
+    count = 0
+    while count <= retry:
         count += 1
+        try:
+            fh.seek(0)
+            fh.truncate()
+            with urllib.request.urlopen(urllib.request.Request(url), timeout=timeout) as data:
+                shutil.copyfileobj(data, fh)
+            return True
+        except socket.timeout:
+            continue
 
     raise ConnectionError('Connection Timeout, exit after tried %s times' % count)
 
 
+def file_md5(file_path, block_size=1 << 20):
+    """
+    Calculate md5 checksum of a local file
+
+    :param file_path: str: path of the file
+    :param block_size: int: size of the blocks read at a time
+    :return: str: hex digest of the checksum
+    """
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
 def extract_file_from_tar(content, target_fn, out_type='BytesIO'):
     """
     extract target file from tar content
 
+    The archive is read sequentially as a stream until the target is found. With
+    `out_type='stream'` a file-like object reading straight off the (compressed) tar stream is
+    returned, so the member is never held in memory as a whole.
+
     :param content: BytesIO, str: file name or BytesIO content
     :param target_fn: str: target file name
     :param out_type: str: output type of the result
     :return: value type based on out_type
     """
 
-    if not isinstance(content, BytesIO) and not isinstance(content, str):
-        raise TypeError("Unsupported data type")
-
-    support_types = ['bytes', 'str', 'StringIO', 'BytesIO']
+    support_types = ['bytes', 'str', 'StringIO', 'BytesIO', 'stream']
     if out_type not in support_types:
         raise TypeError("Unsupported output data type: ", out_type)
 
-    if isinstance(content, BytesIO):
-        tar_data = tarfile.open(fileobj=content)
-    else:
-        tar_data = tarfile.open(content)
-
-    if target_fn not in tar_data.getnames():
-        raise KeyError("Cannot find target %s in tar file" % target_fn)
+    members = iter_tar_members(content, [target_fn])
+    _, tar_handle = next(members)
+    if out_type == 'stream':
+        # the reader keeps the tar stream open until it is closed
+        tar_handle.raw.members = members
+        return tar_handle
 
-    tar_info = tar_data.getmember(target_fn)
-    tar_handle = tar_data.extractfile(tar_info)
     if out_type == 'str':
         content = tar_handle.read().decode("utf-8")
     elif out_type == 'bytes':
@@ -200,5 +662,67 @@ def extract_file_from_tar(content, target_fn, out_type='BytesIO'):
     else:
         content = BytesIO(tar_handle.read())
 
-    tar_data.close()
+    members.close()
     return content
+
+
+def iter_tar_members(content, target_fns, missing_ok=False):
+    """
+    Yield target files of a (compressed) tar archive in one sequential pass over the stream.
+
+    Each yielded file object reads straight from the archive stream. It is only valid until the
+    next member is requested, so it has to be consumed before the iteration continues.
+
+    :param content: BytesIO, str: file name or BytesIO content
+    :param target_fns: list: target file names
+    :param missing_ok: bool: skip targets not in the archive instead of raising KeyError
+    :return: generator of tuple (file name, file object), in archive order
+    """
+
+    if not isinstance(content, BytesIO) and not isinstance(content, str):
+        raise TypeError("Unsupported data type")
+
+    if isinstance(content, BytesIO):
+        tar_data = tarfile.open(fileobj=content, mode='r|*')
+    else:
+        tar_data = tarfile.open(content, mode='r|*')
+
+    targets = set(target_fns)
+    with tar_data:
+        for tar_info in tar_data:
+            if tar_info.name in targets:
+                targets.discard(tar_info.name)
+                yield tar_info.name, BufferedReader(TarMemberReader(tar_data.extractfile(tar_info)))
+                if not targets:
+                    return
+
+    if not missing_ok:
+        raise KeyError("Cannot find target %s in tar file" % ", ".join(sorted(targets)))
+
+
+class TarMemberReader(RawIOBase):
+    """
+    Raw reader of a tar member read from a tar stream.
+
+    Args:
+        tar_handle: file object of the tar member
+        members: generator of `iter_tar_members` holding the tar stream, it is closed together
+            with the reader
+    """
+
+    def __init__(self, tar_handle, members=None):
+        self._tar_handle = tar_handle
+        self.members = members
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._tar_handle.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed and self.members is not None:
+            self.members.close()
+        super().close()
@@ -0,0 +1,108 @@
+# =============================================================================
+# Confidential and Proprietary
+# Unauthorized copying of this file via any medium is strictly prohibited
+# Copyright (C) Aperiomics, Inc., 2019
+# Written by Alvin Chen <ychen@aperiomics.com>
+# ==============================================================================
+
+import math
+
+# upper length bound when the lengths are not limited
+MAX_NAME_LENGTH = 2 ** 31 - 1
+
+
+def trigrams(text: str):
+    """Return the distinct trigrams of the lower-cased text, in order of appearance"""
+    text = text.lower()
+    return list(dict.fromkeys(text[i:i + 3] for i in range(len(text) - 2)))
+
+
+def trigram_similarity(grams: list, text: str):
+    """Dice coefficient of the distinct trigrams of a query and of the text"""
+    text_grams = trigrams(text)
+    if not grams and not text_grams:
+        return 1.0
+    return 2.0 * len(set(grams).intersection(text_grams)) / (len(grams) + len(text_grams))
+
+
+def trigram_query(grams: list, operator: str = 'OR'):
+    """FTS5 query matching the trigrams joined by the operator, `None` if there is none"""
+    if not grams:
+        return None
+    return (" %s " % operator).join('"%s"' % gram.replace('"', '""') for gram in grams)
+
+
+def select_trigrams(grams: list, doc_counts: dict, max_docs: int):
+    """Select the rarest trigrams of a query, so that the query hits few names
+
+    The rarest trigrams are matched by any of them while their names add up to at most
+    `max_docs`. If even the rarest trigram is more common, names have to contain both of the
+    two rarest ones.
+
+    Args:
+        grams: trigrams of the query
+        doc_counts: dictionary of trigram to number of indexed names containing it
+        max_docs: maximum number of names hit by the selected trigrams
+
+    Return:
+        Tuple of list of trigrams, empty if no trigram is indexed, and the FTS5 operator
+        joining them
+    """
+    # trigrams not in the index, e.g. of a misspelled part of the query, are left out
+    indexed = sorted((doc_counts[gram], gram) for gram in grams if doc_counts.get(gram, 0))
+    if indexed and indexed[0][0] > max_docs:
+        return [gram for _, gram in indexed[:2]], 'AND'
+
+    selected = []
+    total = 0
+    for count, gram in indexed:
+        if selected and total + count > max_docs:
+            break
+        selected.append(gram)
+        total += count
+    return selected, 'OR'
+
+
+def length_bounds(length: int, min_score: float):
+    """Range of lengths of names whose `similarity` to a query of the length can reach
+    `min_score`, as tuple of the inclusive lower and upper bounds"""
+    if min_score <= 0:
+        return 0, MAX_NAME_LENGTH
+    return math.ceil(length * min_score), math.floor(length / min_score)
+
+
+def edit_distance(a: str, b: str, max_distance: int = None):
+    """Levenshtein distance between two strings
+
+    Args:
+        a, b: strings to compare
+        max_distance: stop early and return `max_distance + 1` once the distance is known to
+            be larger
+
+    Return:
+        number of single character insertions, deletions and substitutions
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if max_distance is not None and len(a) - len(b) > max_distance:
+        return max_distance + 1
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+def similarity(a: str, b: str):
+    """Case insensitive edit distance similarity between 0 and 1, 1 for identical strings"""
+    length = max(len(a), len(b))
+    if length == 0:
+        return 1.0
+    return 1.0 - edit_distance(a.lower(), b.lower()) / length
@@ -29,8 +29,90 @@ class TaxonNodes(Base):
 
 class TaxonNames(Base):
     __tablename__ = 'taxon_names'
+    trigram_table = 'taxon_names_trigram'
+    trigram_vocab_table = 'taxon_names_trigram_vocab'
     id = Column(INTEGER, primary_key=True)
     tax_id = Column(INTEGER, nullable=False, index=True, unique=True)
     name_txt = Column(VARCHAR(128))
     unique_name = Column(VARCHAR(128))
 
+
+class TaxonRanks(Base):
+    __tablename__ = 'taxon_ranks'
+    code = Column(INTEGER, primary_key=True)
+    rank = Column(VARCHAR(32), nullable=False, unique=True)
+
+
+class TaxonNodesCompact(Base):
+    """Compact storage of `taxon_nodes`, read and written through the view of that name.
+    `tax_id` is the rowid of the table, ranks are codes of `taxon_ranks` and the flags are bits
+    of `flags` in the order of `flag_columns`."""
+    __tablename__ = 'taxon_nodes_compact'
+    view_name = 'taxon_nodes'
+    flag_columns = ['inherited_div_flag', 'inherited_GC_flag', 'inherited_MGC_flag',
+                    'GenBank_hidden_flag', 'hidden_subtree_root_flag']
+    tax_id = Column(INTEGER, primary_key=True, autoincrement=False)
+    parent_tax_id = Column(INTEGER, nullable=False, index=True)
+    rank_code = Column(SMALLINT)
+    embl_code = Column(VARCHAR(16))
+    division_id = Column(SMALLINT)
+    genetic_code_id = Column(SMALLINT)
+    mito_genetic_code_id = Column(SMALLINT)
+    flags = Column(SMALLINT)
+
+
+class TaxonNamesCompact(Base):
+    """Compact storage of `taxon_names`, read and written through the view of that name"""
+    __tablename__ = 'taxon_names_compact'
+    view_name = 'taxon_names'
+    tax_id = Column(INTEGER, primary_key=True, autoincrement=False)
+    name_txt = Column(VARCHAR(128))
+    unique_name = Column(VARCHAR(128))
+
+
+class TaxonLineage(Base):
+    __tablename__ = 'taxon_lineage'
+    ranks = ["superkingdom", "kingdom", "phylum", "class",
+             "order", "family", "genus", "species"]
+    id = Column(INTEGER, primary_key=True)
+    tax_id = Column(INTEGER, nullable=False, index=True, unique=True)
+    depth = Column(SMALLINT)
+    superkingdom_id = Column(INTEGER)
+    superkingdom_name = Column(VARCHAR(128))
+    kingdom_id = Column(INTEGER)
+    kingdom_name = Column(VARCHAR(128))
+    phylum_id = Column(INTEGER)
+    phylum_name = Column(VARCHAR(128))
+    class_id = Column(INTEGER)
+    class_name = Column(VARCHAR(128))
+    order_id = Column(INTEGER)
+    order_name = Column(VARCHAR(128))
+    family_id = Column(INTEGER)
+    family_name = Column(VARCHAR(128))
+    genus_id = Column(INTEGER)
+    genus_name = Column(VARCHAR(128))
+    species_id = Column(INTEGER)
+    species_name = Column(VARCHAR(128))
+
+
+class TaxonMerged(Base):
+    __tablename__ = 'taxon_merged'
+    id = Column(INTEGER, primary_key=True)
+    old_tax_id = Column(INTEGER, nullable=False, index=True, unique=True)
+    new_tax_id = Column(INTEGER, nullable=False)
+
+
+class TaxonDeleted(Base):
+    __tablename__ = 'taxon_deleted'
+    id = Column(INTEGER, primary_key=True)
+    tax_id = Column(INTEGER, nullable=False, index=True, unique=True)
+
+
+class TaxonSynonyms(Base):
+    __tablename__ = 'taxon_synonyms'
+    fts_table = 'taxon_synonyms_fts'
+    id = Column(INTEGER, primary_key=True)
+    tax_id = Column(INTEGER, nullable=False, index=True)
+    name_txt = Column(VARCHAR(256, collation='NOCASE'), nullable=False, index=True)
+    unique_name = Column(VARCHAR(256))
+    name_class = Column(VARCHAR(32))
@@ -0,0 +1,102 @@
+# =============================================================================
+# Confidential and Proprietary
+# Unauthorized copying of this file via any medium is strictly prohibited
+# Copyright (C) Aperiomics, Inc., 2019
+# Written by Alvin Chen <ychen@aperiomics.com>
+# ==============================================================================
+
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .tree import TaxonomyTree
+
+# arrays needed by `TaxonomyTree.lineage_matrix`
+SHARED_ARRAYS = ['parent', 'rank_code']
+
+_worker_state = {}
+
+
+class LineageWorkers:
+    """
+    Process pool resolving lineages on a `TaxonomyTree` published once in shared memory.
+    Workers attach to the shared arrays read-only, so the tree is neither rebuilt nor pickled
+    per worker or per batch.
+
+    Args:
+        tree: taxonomy tree
+        processes: number of worker processes, default to the number of CPUs
+        chunk_size: number of taxonomy ids sent to a worker at a time
+    """
+
+    def __init__(self, tree: TaxonomyTree, processes: int = None, chunk_size: int = 100000):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self._shms = []
+        self._pool = None
+
+        spec = {'ranks': tree.ranks, 'arrays': {}}
+        try:
+            for name in SHARED_ARRAYS:
+                array = getattr(tree, name)
+                shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                self._shms.append(shm)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+                spec['arrays'][name] = (shm.name, array.dtype.str, array.shape)
+
+            self._pool = multiprocessing.Pool(self.processes, initializer=_init_worker,
+                                              initargs=(spec,))
+        except Exception:
+            self.close()
+            raise
+        logging.debug("TaxonomyFinder: started %s lineage workers" % self.processes)
+
+    def lineage_matrix(self, tids, clades: list):
+        """Same as `TaxonomyTree.lineage_matrix`, with the ids split into chunks across the
+        workers. Results are concatenated back in input order."""
+        tids = np.asarray(tids, dtype=np.int64)
+        chunks = [(tids[start:start + self.chunk_size], list(clades))
+                  for start in range(0, len(tids), self.chunk_size)]
+        if not chunks:
+            return np.zeros((0, len(clades)), dtype=np.int64), np.zeros(0, dtype=bool)
+
+        results = self._pool.map(_lineage_chunk, chunks)
+        return (np.concatenate([rank_ids for rank_ids, _ in results]),
+                np.concatenate([found for _, found in results]))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+        self._shms = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _init_worker(spec):
+    arrays = {}
+    shms = []
+    for name, (shm_name, dtype, shape) in spec['arrays'].items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        array.flags.writeable = False
+        arrays[name] = array
+        shms.append(shm)
+
+    _worker_state['shms'] = shms
+    _worker_state['tree'] = TaxonomyTree.from_arrays(arrays, spec['ranks'])
+
+
+def _lineage_chunk(args):
+    tids, clades = args
+    return _worker_state['tree'].lineage_matrix(tids, clades)
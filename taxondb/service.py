@@ -0,0 +1,270 @@
+# =============================================================================
+# Confidential and Proprietary
+# Unauthorized copying of this file via any medium is strictly prohibited
+# Copyright (C) Aperiomics, Inc., 2019
+# Written by Alvin Chen <ychen@aperiomics.com>
+# ==============================================================================
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .db_controller import TaxonomyDBFinder
+
+
+class AsyncTaxonomyFinder:
+    """
+    Asyncio front end of `TaxonomyDBFinder`. Concurrent `lineage` calls are collected over a
+    short window and resolved as one batch in a worker thread, so the event loop never blocks
+    on the database.
+
+    Example:
+        finder = TaxonomyDBFinder()
+        finder.connect(db_file, thread_safe=True)
+        service = AsyncTaxonomyFinder(finder)
+        rank_tids, tid_names = await service.lineage(9606)
+
+    Args:
+        finder: connected taxonomy finder, connected with `thread_safe=True` if it is used by
+            other threads as well
+        window: seconds to wait for more requests after the first one of a batch
+        max_batch: number of pending requests which triggers a batch immediately
+        latency_samples: number of recent request latencies kept for `stats`
+    """
+
+    def __init__(self, finder: TaxonomyDBFinder, window: float = 0.002, max_batch: int = 10000,
+                 latency_samples: int = 100000):
+        self.finder = finder
+        self.window = window
+        self.max_batch = max_batch
+        # a single worker keeps the finder on one thread, batches run one after another
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = collections.defaultdict(list)
+        self._timers = {}
+        # the event loop only keeps weak references to tasks, running batches are kept here
+        self._tasks = set()
+        self._latencies = collections.deque(maxlen=latency_samples)
+        self._start_time = time.monotonic()
+        self.requests = 0
+        self.batches = 0
+
+    async def lineage(self, tid: int, clades: list = None):
+        """Same as `TaxonomyDBFinder.find_taxid_parents`
+
+        Return:
+            Tuple of two dictionaries contain parent taxonomy ids and names
+        """
+        loop = asyncio.get_event_loop()
+        key = tuple(clades) if clades else tuple(self.finder.default_clades)
+        future = loop.create_future()
+        self._pending[key].append((int(tid), future, time.monotonic()))
+
+        if len(self._pending[key]) >= self.max_batch:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    async def lineages(self, tids, clades: list = None):
+        """Resolve many taxonomy ids, batched together with concurrent requests"""
+        return await asyncio.gather(*[self.lineage(tid, clades) for tid in tids])
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        requests = self._pending.pop(key, [])
+        if requests:
+            task = asyncio.ensure_future(self._resolve(key, requests))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _resolve(self, key, requests):
+        loop = asyncio.get_event_loop()
+        tids = [tid for tid, _, _ in requests]
+        try:
+            results = await loop.run_in_executor(self._executor,
+                                                 self.finder.find_taxid_parents_batch,
+                                                 tids, list(key))
+        except asyncio.CancelledError:
+            for _, future, _ in requests:
+                future.cancel()
+            raise
+        except Exception as e:
+            logging.error("TaxonomyService: batch of %s failed: %s" % (len(tids), e))
+            for _, future, _ in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        now = time.monotonic()
+        self.batches += 1
+        self.requests += len(requests)
+        for (_, future, start), result in zip(requests, results):
+            self._latencies.append(now - start)
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        """Return dictionary of request and batch counts, throughput and latency percentiles in
+        seconds of the recent requests"""
+        elapsed = time.monotonic() - self._start_time
+        latencies = np.array(self._latencies)
+        stats = {
+            'requests': self.requests,
+            'batches': self.batches,
+            'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+            'throughput': self.requests / elapsed if elapsed > 0 else 0.0,
+        }
+        for name, q in [('p50', 50), ('p90', 90), ('p99', 99)]:
+            stats['latency_' + name] = float(np.percentile(latencies, q)) if len(latencies) \
+                else 0.0
+        return stats
+
+    def close(self):
+        """Cancel pending requests and running batches, then stop the worker thread"""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers = {}
+        for requests in self._pending.values():
+            for _, future, _ in requests:
+                future.cancel()
+        self._pending.clear()
+        for task in list(self._tasks):
+            task.cancel()
+        self._executor.shutdown(wait=True)
+
+
+async def start_server(service: AsyncTaxonomyFinder, path: str = None, host: str = '127.0.0.1',
+                       port: int = 0):
+    """Serve lineage lookups on a Unix socket, or on TCP if no path is given, so that many
+    processes share one warm index.
+
+    The protocol is one JSON object per line, answered by one JSON line:
+
+        {"tids": [9606, 562], "clades": ["genus", "species"]}
+            -> {"lineages": [[rank_tids, tid_names], ...]}
+        {"stats": true}
+            -> {"stats": {...}}
+
+    Return:
+        asyncio server
+    """
+    async def handle(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if request.get('stats'):
+                        response = {'stats': service.stats()}
+                    else:
+                        response = {'lineages': await service.lineages(
+                            request['tids'], request.get('clades'))}
+                except Exception as e:
+                    response = {'error': str(e)}
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    # requests of large batches are long lines
+    limit = 2 ** 26
+    if path is not None:
+        server = await asyncio.start_unix_server(handle, path=path, limit=limit)
+    else:
+        server = await asyncio.start_server(handle, host=host, port=port, limit=limit)
+    logging.debug("TaxonomyService: serving on %s"
+                  % (path or "%s:%s" % server.sockets[0].getsockname()[:2]))
+    return server
+
+
+class TaxonomyClient:
+    """
+    Blocking client of `start_server`
+
+    Args:
+        path: Unix socket path of the server
+        host, port: TCP address of the server, used when no path is given
+        timeout: socket timeout in seconds
+    """
+
+    def __init__(self, path: str = None, host: str = '127.0.0.1', port: int = None,
+                 timeout: float = 60):
+        if path is not None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(timeout)
+            self._sock.connect(path)
+        else:
+            self._sock = socket.create_connection((host, port), timeout=timeout)
+        self._file = self._sock.makefile('rb')
+
+    def _request(self, request: dict):
+        self._sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        response = json.loads(self._file.readline())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def find_taxid_parents_batch(self, tids, clades: list = None):
+        """Same as `TaxonomyDBFinder.find_taxid_parents_batch`"""
+        lineages = self._request({'tids': [int(tid) for tid in tids], 'clades': clades})
+        # JSON object keys are strings, taxonomy ids are turned back into int
+        return [(rank_tids, {int(tid): name for tid, name in tid_names.items()})
+                if rank_tids is not None else (None, None)
+                for rank_tids, tid_names in lineages['lineages']]
+
+    def find_taxid_parents(self, tid: int, clades: list = None):
+        return self.find_taxid_parents_batch([tid], clades)[0]
+
+    def stats(self):
+        return self._request({'stats': True})['stats']
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve taxonomy lineage lookups")
+    parser.add_argument('db', help="taxonomy database file")
+    parser.add_argument('--socket', help="Unix socket path, TCP is used if not given")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--snapshot', help="memory-map this taxonomy snapshot file")
+    parser.add_argument('--window', type=float, default=0.002)
+    args = parser.parse_args()
+
+    finder = TaxonomyDBFinder()
+    finder.connect(args.db, thread_safe=True)
+    if args.snapshot:
+        finder.connect_snapshot(args.snapshot)
+    else:
+        finder.lineage_mode = 'array'
+    service = AsyncTaxonomyFinder(finder, window=args.window)
+
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(start_server(service, path=args.socket, host=args.host,
+                                                  port=args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        service.close()
+        finder.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# =============================================================================
+# Confidential and Proprietary
+# Unauthorized copying of this file via any medium is strictly prohibited
+# Copyright (C) Aperiomics, Inc., 2019
+# Written by Alvin Chen <ychen@aperiomics.com>
+# ==============================================================================
+
+import json
+import mmap
+import os
+import struct
+from tempfile import mkstemp
+
+import numpy as np
+
+from . import exceptions
+from .file import sqlite_fingerprint
+from .tree import TaxonomyTree
+
+MAGIC = b'TAXSNAP1'
+VERSION = 1
+ALIGNMENT = 64
+
+
+class SnapshotNames:
+    """
+    Taxonomy name table of a snapshot. Names are stored as one utf-8 blob in taxonomy id order,
+    `offsets[tid]:offsets[tid + 1]` is the slice of the name of `tid`.
+    """
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray):
+        self.offsets = offsets
+        self.data = data
+
+    def get(self, tid: int):
+        if tid < 0 or tid + 1 >= len(self.offsets):
+            return None
+        start, end = self.offsets[tid], self.offsets[tid + 1]
+        if start == end:
+            return None
+        return self.data[start:end].tobytes().decode('utf-8')
+
+    def get_many(self, tids):
+        """Return dictionary of taxonomy id to name, unknown ids are omitted"""
+        tid_names = {}
+        for tid in tids:
+            name = self.get(int(tid))
+            if name is not None:
+                tid_names[int(tid)] = name
+        return tid_names
+
+    @classmethod
+    def from_names(cls, tax_ids, names, size: int):
+        """Build the name table from taxonomy ids and names"""
+        tax_ids = np.asarray(tax_ids, dtype=np.int64)
+        order = np.argsort(tax_ids, kind='stable')
+        encoded = [names[i].encode('utf-8') for i in order]
+
+        lengths = np.zeros(size, dtype=np.int64)
+        lengths[tax_ids[order]] = [len(name) for name in encoded]
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(offsets, data)
+
+
+class Snapshot:
+    """
+    Memory-mapped binary taxonomy snapshot.
+
+    File layout:
+        8 bytes magic, 8 bytes header length, json header, then every array section aligned
+        to 64 bytes. The header records dtype, length and offset (relative to the end of the
+        header) of each section, so the arrays are used in place on top of the memory map
+        without being copied. It also records the source database as path, size, modification
+        time and SQLite file change counter, so that a stale snapshot can be detected.
+
+    Attributes:
+        tree (TaxonomyTree): taxonomy tree with arrays on the memory map
+        names (SnapshotNames): taxonomy names with arrays on the memory map
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        with open(file_path, 'rb') as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            header, start, header_len = self._read_header()
+        except Exception:
+            self._mmap.close()
+            raise
+
+        data_start = _align(start + header_len)
+        arrays = {}
+        for name, section in header['arrays'].items():
+            arrays[name] = np.frombuffer(self._mmap, dtype=np.dtype(section['dtype']),
+                                         count=section['length'],
+                                         offset=data_start + section['offset'])
+
+        self.meta = header['meta']
+        self.names = SnapshotNames(arrays.pop('name_offsets'), arrays.pop('name_data'))
+        self.tree = TaxonomyTree.from_arrays(arrays, self.meta['ranks'])
+
+    def _read_header(self):
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise exceptions.TaxonomyDataError("%s is not a taxonomy snapshot file"
+                                               % self.file_path)
+        header_len, = struct.unpack_from('<Q', self._mmap, len(MAGIC))
+        start = len(MAGIC) + 8
+        header = json.loads(self._mmap[start:start + header_len].decode('utf-8'))
+        if header['version'] != VERSION:
+            raise exceptions.TaxonomyDataError("Unsupported snapshot version %s"
+                                               % header['version'])
+        return header, start, header_len
+
+    def close(self):
+        self.tree = None
+        self.names = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # arrays handed out to callers are still alive, the map is released with them
+            pass
+
+    @staticmethod
+    def write(file_path: str, tree: TaxonomyTree, names: SnapshotNames, source: dict = None):
+        """Write taxonomy tree and names to a snapshot file
+
+        Args:
+            file_path: path of the snapshot file
+            tree: taxonomy tree
+            names: taxonomy names
+            source: description of the source database, see `source_description`
+        """
+        arrays = tree.to_arrays()
+        arrays['name_offsets'] = names.offsets
+        arrays['name_data'] = names.data
+
+        header = {'version': VERSION, 'meta': {'ranks': tree.ranks, 'source': source},
+                  'arrays': {}}
+        offset = 0
+        for name, array in arrays.items():
+            header['arrays'][name] = {'dtype': array.dtype.str, 'length': len(array),
+                                      'offset': offset}
+            offset = _align(offset + array.nbytes)
+        header_bytes = json.dumps(header).encode('utf-8')
+
+        # the file is replaced rather than rewritten in place, processes which have the old
+        # snapshot mapped keep reading its inode
+        handle, temp_path = mkstemp(dir=os.path.dirname(os.path.abspath(file_path)))
+        try:
+            with os.fdopen(handle, 'wb') as fh:
+                fh.write(MAGIC)
+                fh.write(struct.pack('<Q', len(header_bytes)))
+                fh.write(header_bytes)
+                data_start = _align(fh.tell())
+                for name, array in arrays.items():
+                    fh.write(b'\0' * (data_start + header['arrays'][name]['offset'] - fh.tell()))
+                    fh.write(np.ascontiguousarray(array).tobytes())
+            os.replace(temp_path, file_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return True
+
+
+def source_description(db_path: str):
+    """Describe the database file a snapshot is exported from
+
+    Return:
+        dictionary of the absolute path, size, modification time in ns and SQLite file change
+        counter of the database file, `None` if the file does not exist
+    """
+    fingerprint = sqlite_fingerprint(db_path)
+    if fingerprint is None:
+        return None
+    size, mtime_ns, change_counter = fingerprint
+    return {'path': os.path.abspath(db_path), 'size': size, 'mtime_ns': mtime_ns,
+            'change_counter': change_counter}
+
+
+def _align(offset: int):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
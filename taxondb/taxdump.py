@@ -0,0 +1,49 @@
+# =============================================================================
+# Confidential and Proprietary
+# Unauthorized copying of this file via any medium is strictly prohibited
+# Copyright (C) Aperiomics, Inc., 2019
+# Written by Alvin Chen <ychen@aperiomics.com>
+# ==============================================================================
+import csv
+
+import pandas as pd
+
+DEFAULT_CHUNK_SIZE = 500000
+
+
+def read_dump(fh, columns: list, dtype: dict = None, chunksize: int = DEFAULT_CHUNK_SIZE):
+    """
+    Stream records of an NCBI taxonomy dump file, e.g. nodes.dmp or names.dmp.
+
+    Fields of the dump files are separated by "\\t|\\t" and every line ends with "\\t|". The file
+    is split on tabs by the C parser of pandas, so the "|" separators land in odd positions and
+    only the even positions are kept. Extra trailing fields of newer dump versions are ignored.
+
+    Example:
+        for chunk in read_dump(fh, ['tax_id', 'name_txt', 'unique_name', 'name_class'],
+                               dtype={'tax_id': 'int64', 'name_class': 'category'}):
+            ...
+
+    Args:
+        fh: file path or file object of the dump file
+        columns: names of the leading fields
+        dtype: dictionary of column name to data type, other columns are kept as strings
+        chunksize: number of lines parsed per chunk
+
+    Returns:
+        generator of pd.DataFrame chunks, empty fields are NaN
+    """
+    dtype = dtype or {}
+    try:
+        reader = pd.read_csv(fh, sep='\t', header=None, index_col=False, engine='c',
+                             usecols=[2 * i for i in range(len(columns))],
+                             dtype={2 * i: dtype.get(col, object)
+                                    for i, col in enumerate(columns)},
+                             quoting=csv.QUOTE_NONE, keep_default_na=False, na_values=[''],
+                             chunksize=chunksize)
+    except pd.errors.EmptyDataError:
+        return
+
+    for chunk in reader:
+        chunk.columns = columns
+        yield chunk
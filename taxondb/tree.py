@@ -0,0 +1,359 @@
+# =============================================================================
+# Confidential and Proprietary
+# Unauthorized copying of this file via any medium is strictly prohibited
+# Copyright (C) Aperiomics, Inc., 2019
+# Written by Alvin Chen <ychen@aperiomics.com>
+# ==============================================================================
+
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+class TaxonomyTree:
+    """
+    Array based taxonomy tree. All arrays are indexed by taxonomy id, ids not in the taxonomy
+    have parent 0 and rank code -1.
+
+    Args:
+        parent: np.ndarray of parent taxonomy id, the root is its own parent
+        rank_code: np.ndarray of rank codes, index into `ranks`
+        ranks: list of rank names
+
+    Attributes:
+        merged (np.ndarray): current taxonomy id of each merged taxonomy id, 0 if the id was not
+            merged, see `build_merged_index`
+        depth (np.ndarray): number of edges between each node and the root
+        pre (np.ndarray): pre-order number of each node, -1 if not in the tree
+        subtree_size (np.ndarray): number of nodes in the subtree of each node, itself included.
+            Together with `pre` they form a nested set index, the subtree of a node `y` is
+            exactly the nodes numbered `pre[y] <= pre[x] < pre[y] + subtree_size[y]`.
+
+    All arrays are read-only and the indexes above are built lazily once under a lock, so a
+    tree can be shared between threads.
+    """
+
+    def __init__(self, parent: np.ndarray, rank_code: np.ndarray, ranks: list):
+        self.parent = _read_only(parent)
+        self.rank_code = _read_only(rank_code)
+        self.ranks = list(ranks)
+        self.merged = None
+        self._lock = threading.RLock()
+        self._depth = None
+        self._pre = None
+        self._subtree_size = None
+        self._ancestor_table = None
+
+    def __len__(self):
+        return len(self.parent)
+
+    @classmethod
+    def from_nodes(cls, tax_ids, parent_tax_ids, ranks):
+        """Build the tree from node records
+
+        Args:
+            tax_ids: taxonomy ids
+            parent_tax_ids: parent taxonomy ids
+            ranks: rank names, categorical ranks are not converted to strings
+        """
+        tax_ids = np.asarray(tax_ids, dtype=np.int64)
+        parent_tax_ids = np.asarray(parent_tax_ids, dtype=np.int64)
+        if isinstance(getattr(ranks, 'dtype', None), pd.CategoricalDtype):
+            codes, rank_names = pd.factorize(ranks)
+        else:
+            codes, rank_names = pd.factorize(np.asarray(ranks, dtype=object))
+
+        size = max(tax_ids.max(initial=0), parent_tax_ids.max(initial=0)) + 1
+        parent = np.zeros(size, dtype=np.int32)
+        parent[tax_ids] = parent_tax_ids
+        rank_code = np.full(size, -1, dtype=np.int8)
+        rank_code[tax_ids] = codes
+
+        return cls(parent, rank_code, list(rank_names))
+
+    @classmethod
+    def from_arrays(cls, arrays: dict, ranks: list):
+        """Build the tree from the arrays returned by `to_arrays`"""
+        tree = cls(arrays['parent'], arrays['rank_code'], ranks)
+        tree.merged = _read_only(arrays.get('merged'))
+        tree._depth = _read_only(arrays.get('depth'))
+        tree._pre = _read_only(arrays.get('pre'))
+        tree._subtree_size = _read_only(arrays.get('subtree_size'))
+        return tree
+
+    def to_arrays(self):
+        """Return dictionary of the arrays to be persisted"""
+        arrays = {'parent': self.parent, 'rank_code': self.rank_code, 'depth': self.depth,
+                  'pre': self.pre, 'subtree_size': self.subtree_size}
+        if self.merged is not None:
+            arrays['merged'] = self.merged
+        return arrays
+
+    @property
+    def depth(self):
+        if self._depth is None:
+            with self._lock:
+                if self._depth is None:
+                    self._depth = _read_only(self._compute_depth())
+        return self._depth
+
+    def _compute_depth(self):
+        # pointer doubling: `dist` is the distance from each node to its `anc` ancestor
+        nodes = np.arange(len(self.parent))
+        anc = self.parent.astype(np.int64)
+        dist = (anc != nodes).astype(np.int32)
+        while True:
+            next_anc = anc[anc]
+            if np.array_equal(next_anc, anc):
+                break
+            dist = dist + dist[anc]
+            anc = next_anc
+        return dist
+
+    @property
+    def pre(self):
+        if self._pre is None:
+            self._build_nested_set()
+        return self._pre
+
+    @property
+    def subtree_size(self):
+        if self._subtree_size is None:
+            self._build_nested_set()
+        return self._subtree_size
+
+    def _build_nested_set(self):
+        with self._lock:
+            if self._pre is None or self._subtree_size is None:
+                self._pre, self._subtree_size = self._compute_nested_set()
+
+    def _compute_nested_set(self):
+        nodes = np.flatnonzero(self.parent)
+        parent = self.parent[nodes].astype(np.int64)
+        is_root = (parent == nodes) | (self.parent[parent] == 0)
+        depth = self.depth[nodes]
+
+        # subtree sizes, accumulated from the deepest level up
+        size = np.zeros(len(self.parent), dtype=np.int64)
+        size[nodes] = 1
+        by_depth = np.argsort(-depth, kind='stable')
+        level_bounds = np.flatnonzero(np.diff(depth[by_depth])) + 1
+        for level in np.split(by_depth, level_bounds):
+            level = level[~is_root[level]]
+            np.add.at(size, parent[level], size[nodes[level]])
+
+        # offset of each node among its siblings ordered by taxonomy id
+        group = np.where(is_root, 0, parent)
+        order = np.lexsort((nodes, group))
+        sizes = size[nodes[order]]
+        before = np.cumsum(sizes) - sizes
+        group_start = np.r_[True, group[order][1:] != group[order][:-1]]
+        before -= np.maximum.accumulate(np.where(group_start, before, 0))
+        offset = np.empty(len(nodes), dtype=np.int64)
+        offset[order] = before
+
+        # pre-order numbers, assigned from the root level down
+        pre = np.full(len(self.parent), -1, dtype=np.int64)
+        pre[nodes[is_root]] = offset[is_root]
+        for level in reversed(np.split(by_depth, level_bounds)):
+            level = level[~is_root[level]]
+            pre[nodes[level]] = pre[parent[level]] + 1 + offset[level]
+
+        return _read_only(pre), _read_only(size)
+
+    @property
+    def ancestor_table(self):
+        """Binary lifting table, `ancestor_table[k][x]` is the 2^k-th ancestor of `x`"""
+        if self._ancestor_table is None:
+            with self._lock:
+                if self._ancestor_table is None:
+                    levels = max(1, int(self.depth.max(initial=0)).bit_length())
+                    table = [self.parent]
+                    for _ in range(1, levels):
+                        table.append(table[-1][table[-1]])
+                    self._ancestor_table = _read_only(np.stack(table))
+        return self._ancestor_table
+
+    def lca_pairs(self, tids_a, tids_b):
+        """Lowest common ancestors of pairs of taxonomy ids, O(log(depth)) per pair
+
+        Return:
+            np.ndarray(int64), 0 if either id of the pair is not in the tree
+        """
+        tids_a = np.asarray(tids_a, dtype=np.int64)
+        tids_b = np.asarray(tids_b, dtype=np.int64)
+        result = np.zeros(len(tids_a), dtype=np.int64)
+        valid = self.contains(tids_a) & self.contains(tids_b)
+
+        a, b = tids_a[valid], tids_b[valid]
+        swap = self.depth[a] < self.depth[b]
+        a, b = np.where(swap, b, a), np.where(swap, a, b)
+
+        # lift the deeper node to the depth of the other one
+        table = self.ancestor_table
+        diff = self.depth[a] - self.depth[b]
+        for k in range(len(table)):
+            lift = (diff >> k) & 1 == 1
+            a[lift] = table[k][a[lift]]
+
+        # then lift both to just below their lowest common ancestor
+        for k in reversed(range(len(table))):
+            up_a, up_b = table[k][a], table[k][b]
+            move = up_a != up_b
+            a[move] = up_a[move]
+            b[move] = up_b[move]
+
+        result[valid] = np.where(a == b, a, self.parent[a])
+        return result
+
+    def lca_grouped(self, tids, group_ids, n_groups: int):
+        """Lowest common ancestor of each group of taxonomy ids
+
+        Groups are reduced pairwise in rounds, so the number of rounds is logarithmic in the
+        largest group size. Ids not in the tree are ignored.
+
+        Args:
+            tids: taxonomy ids
+            group_ids: group index of each taxonomy id, in range [0, n_groups)
+            n_groups: number of groups
+
+        Return:
+            np.ndarray(int64) of length `n_groups`, 0 for groups without any known id
+        """
+        tids = np.asarray(tids, dtype=np.int64)
+        group_ids = np.asarray(group_ids, dtype=np.int64)
+        known = self.contains(tids)
+        order = np.argsort(group_ids[known], kind='stable')
+        tids = tids[known][order]
+        group_ids = group_ids[known][order]
+
+        while len(tids):
+            start = np.r_[True, group_ids[1:] != group_ids[:-1]]
+            if start.all():
+                break
+            idx = np.arange(len(tids))
+            pos = idx - np.maximum.accumulate(np.where(start, idx, 0))
+            left = pos % 2 == 0
+            paired = np.flatnonzero(left & np.r_[~start[1:], False])
+            tids[paired] = self.lca_pairs(tids[paired], tids[paired + 1])
+            tids, group_ids = tids[left], group_ids[left]
+
+        result = np.zeros(n_groups, dtype=np.int64)
+        result[group_ids] = tids
+        return result
+
+    def in_clade(self, tids, clade_tid: int, include_self: bool = True):
+        """Return boolean array of whether each taxonomy id lies under the clade
+
+        Args:
+            tids: taxonomy ids
+            clade_tid: taxonomy id of the clade
+            include_self: whether the clade itself counts as a member
+        """
+        tids = np.asarray(tids, dtype=np.int64)
+        result = self.contains(tids)
+        if not self.contains([clade_tid])[0]:
+            return np.zeros(len(tids), dtype=bool)
+
+        start = self.pre[clade_tid]
+        end = start + self.subtree_size[clade_tid]
+        if not include_self:
+            start += 1
+        pre = self.pre[tids[result]]
+        result[result] = (pre >= start) & (pre < end)
+        return result
+
+    def contains(self, tids):
+        """Return boolean array of whether each taxonomy id is in the tree"""
+        tids = np.asarray(tids, dtype=np.int64)
+        valid = (tids > 0) & (tids < len(self.parent))
+        result = np.zeros(len(tids), dtype=bool)
+        result[valid] = self.parent[tids[valid]] != 0
+        return result
+
+    def lineage_matrix(self, tids, clades: list):
+        """Find the ancestors of the given ranks for a batch of taxonomy ids
+
+        All ids are walked up to the root together, one level per step. As with
+        `TaxonomyDBFinder.find_taxid_parents`, the root itself is not part of the lineage and
+        the highest ancestor wins when several share a rank.
+
+        Args:
+            tids: taxonomy ids
+            clades: list of taxonomy ranks
+
+        Returns:
+            Tuple of
+                - np.ndarray(int64) of shape (len(tids), len(clades)), 0 if the clade is not found
+                - np.ndarray(bool), whether the taxonomy id is in the tree
+        """
+        tids = np.asarray(tids, dtype=np.int64)
+        codes = [self.ranks.index(clade) if clade in self.ranks else -2 for clade in clades]
+
+        rank_ids = np.zeros((len(tids), len(clades)), dtype=np.int64)
+        found = self.contains(tids)
+
+        rows = np.flatnonzero(found)
+        cur = tids[rows]
+        while len(rows):
+            parent = self.parent[cur]
+            step = cur != parent
+            rows, cur, parent = rows[step], cur[step], parent[step]
+
+            rank = self.rank_code[cur]
+            for j, code in enumerate(codes):
+                hit = rank == code
+                rank_ids[rows[hit], j] = cur[hit]
+            cur = parent
+
+        return rank_ids, found
+
+
+def _read_only(array):
+    if array is not None:
+        array.flags.writeable = False
+    return array
+
+
+def build_merged_index(old_tax_ids, new_tax_ids, max_merge_chain: int = 32):
+    """Build dense array mapping merged taxonomy ids to their current ids, so that a merged id
+    is resolved by a single array lookup. Chains of merges are followed to the final id.
+
+    Args:
+        old_tax_ids: merged taxonomy ids
+        new_tax_ids: taxonomy ids they were merged into
+
+    Return:
+        np.ndarray(int32) indexed by taxonomy id, 0 for ids which were not merged
+    """
+    old_tax_ids = np.asarray(old_tax_ids, dtype=np.int64)
+    current = np.asarray(new_tax_ids, dtype=np.int64).copy()
+    index = np.zeros(old_tax_ids.max(initial=0) + 1, dtype=np.int32)
+    index[old_tax_ids] = current
+
+    for _ in range(max_merge_chain):
+        in_range = current < len(index)
+        step = np.zeros(len(current), dtype=bool)
+        step[in_range] = index[current[in_range]] != 0
+        if not step.any():
+            break
+        current[step] = index[current[step]]
+    index[old_tax_ids] = current
+    return index
+
+
+def remap_merged(merged_index: np.ndarray, tids):
+    """Replace merged taxonomy ids by their current ids
+
+    Return:
+        Tuple of np.ndarray(int64) of current taxonomy ids and np.ndarray(bool) of whether each
+        id was remapped
+    """
+    tids = np.asarray(tids, dtype=np.int64)
+    remapped = np.zeros(len(tids), dtype=bool)
+    in_range = (tids > 0) & (tids < len(merged_index))
+    remapped[in_range] = merged_index[tids[in_range]] != 0
+    current = tids.copy()
+    current[remapped] = merged_index[tids[remapped]]
+    return current, remapped
@@ -0,0 +1,90 @@
+# =============================================================================
+# Confidential and Proprietary
+# Unauthorized copying of this file via any medium is strictly prohibited
+# Copyright (C) Aperiomics, Inc., 2019
+# Written by Alvin Chen <ychen@aperiomics.com>
+# ==============================================================================
+
+import io
+import tarfile
+
+import pytest
+
+from taxondb import SqliteDBController
+from taxondb.models import TaxonNodes, TaxonNames
+
+# (tax_id, parent_tax_id, rank, name)
+TAXON_RECORDS = [
+    (1, 1, 'no rank', 'root'),
+    (131567, 1, 'no rank', 'cellular organisms'),
+    (2759, 131567, 'superkingdom', 'Eukaryota'),
+    (33208, 2759, 'kingdom', 'Metazoa'),
+    (7711, 33208, 'phylum', 'Chordata'),
+    (40674, 7711, 'class', 'Mammalia'),
+    (9443, 40674, 'order', 'Primates'),
+    (9604, 9443, 'family', 'Hominidae'),
+    (9605, 9604, 'genus', 'Homo'),
+    (9606, 9605, 'species', 'Homo sapiens'),
+    (63221, 9606, 'subspecies', 'Homo sapiens neanderthalensis'),
+    (741158, 9606, 'subspecies', "Homo sapiens subsp. 'Denisova'"),
+    (1425170, 9605, 'species', 'Homo heidelbergensis'),
+    (2, 131567, 'superkingdom', 'Bacteria'),
+    (1224, 2, 'phylum', 'Proteobacteria'),
+    (1236, 1224, 'class', 'Gammaproteobacteria'),
+    (91347, 1236, 'order', 'Enterobacterales'),
+    (543, 91347, 'family', 'Enterobacteriaceae'),
+    (561, 543, 'genus', 'Escherichia'),
+    (562, 561, 'species', 'Escherichia coli'),
+    (10239, 1, 'superkingdom', 'Viruses'),
+    (12908, 1, 'no rank', 'unclassified sequences'),
+]
+
+
+def make_taxon_db(db_file):
+    """Create a small taxonomy database covering the human and E. coli lineages."""
+    controller = SqliteDBController()
+    controller.connect(db_file, is_new_db=True)
+    controller.db_connector.create_table(TaxonNodes)
+    controller.db_connector.create_table(TaxonNames)
+    engine = controller.db_connector.get_engine()
+    engine.execute(TaxonNodes.__table__.insert(),
+                   [{'tax_id': tid, 'parent_tax_id': parent, 'rank': rank}
+                    for tid, parent, rank, _ in TAXON_RECORDS])
+    engine.execute(TaxonNames.__table__.insert(),
+                   [{'tax_id': tid, 'name_txt': name} for tid, _, _, name in TAXON_RECORDS])
+    controller.close()
+    return db_file
+
+
+def _dump_lines(records):
+    return ''.join('\t|\t'.join(str(field) for field in rec) + '\t|\n' for rec in records)
+
+
+def make_taxdump(archive_path, records=TAXON_RECORDS, merged=(), delnodes=()):
+    """Create a taxdump.tar.gz archive in the NCBI dump format"""
+    nodes = [(tid, parent, rank, '', 0, 1, 1, 1, 0, 1, 0, 0, '')
+             for tid, parent, rank, _ in records]
+    names = [(tid, name, '', 'scientific name') for tid, _, _, name in records]
+    names.append((9606, 'human', '', 'genbank common name'))
+    names.append((562, 'Bacillus coli', '', 'synonym'))
+
+    with tarfile.open(archive_path, 'w:gz') as tar:
+        for file_name, content in [('delnodes.dmp', _dump_lines((tid,) for tid in delnodes)),
+                                   ('merged.dmp', _dump_lines(merged)),
+                                   ('names.dmp', _dump_lines(names)),
+                                   ('nodes.dmp', _dump_lines(nodes))]:
+            data = content.encode('utf-8')
+            info = tarfile.TarInfo(file_name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return archive_path
+
+
+@pytest.fixture
+def taxdump_archive(tmp_path):
+    return make_taxdump(str(tmp_path / 'taxdump.tar.gz'))
+
+
+@pytest.fixture
+def taxon_db(tmp_path):
+    return make_taxon_db(str(tmp_path / 'taxon.sqlite'))
@@ -5,8 +5,12 @@
 # Written by Alvin Chen <ychen@aperiomics.com>
 # ==============================================================================
 
+import gc
 import os
+
+import pytest
 from taxondb import SqliteDBController
+from taxondb import file as taxondb_file
 from taxondb.file import S3File
 
 current_dir = os.path.dirname(__file__)
@@ -36,3 +40,77 @@ def test_dbcontroller_local():
 
     os.unlink(test_file)
 
+
+@pytest.mark.parametrize('native', [True, False])
+def test_dbcontroller_copy_table(tmp_path, native):
+    controller1 = SqliteDBController()
+    controller1.connect(os.path.join(current_dir, 'data/testdb.sqlite'))
+    expected = controller1.db_connector.get_engine().execute(
+        "SELECT * FROM test ORDER BY id").fetchall()
+
+    controller2 = SqliteDBController()
+    controller2.connect(str(tmp_path / 'copy.sqlite'), is_new_db=True)
+    controller2.copy_table(controller1.db_connector, 'test', native=native, chunk_size=1)
+    # copying again replaces the table
+    controller2.copy_table(controller1.db_connector, 'test', native=native, chunk_size=1)
+
+    engine = controller2.db_connector.get_engine()
+    assert engine.execute("SELECT * FROM test ORDER BY id").fetchall() == expected
+    assert engine.execute("PRAGMA database_list").fetchall()[-1][1] == 'main'
+
+    controller1.close()
+    controller2.close()
+
+
+def test_dbcontroller_s3_dirty_tracking(tmp_path, monkeypatch):
+    moto = pytest.importorskip('moto')
+    import boto3
+    mock_aws = getattr(moto, 'mock_aws', None) or moto.mock_s3
+
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+        monkeypatch.setenv(name, 'testing')
+    # S3 files leaked by other tests may be uploaded when they are garbage collected, only the
+    # uploads of this test's database are recorded
+    gc.collect()
+    uploads = []
+    upload = S3File._upload
+
+    def recording_upload(self):
+        if (self._s3_bucket, self._s3_file) == ('taxondb-test', 'testdb.sqlite'):
+            uploads.append(self)
+        return upload(self)
+
+    monkeypatch.setattr(S3File, '_upload', recording_upload)
+
+    with mock_aws():
+        s3 = boto3.resource('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='taxondb-test')
+        monkeypatch.setattr(taxondb_file, 's3', s3)
+        s3.meta.client.upload_file(os.path.join(current_dir, 'data/testdb.sqlite'),
+                                   'taxondb-test', 'testdb.sqlite')
+
+        # reading does not change the file, nothing is uploaded
+        controller = SqliteDBController()
+        controller.connect('testdb.sqlite', is_s3=True, s3_bucket='taxondb-test')
+        assert controller.db_connector.get_engine().execute(
+            "SELECT count(*) FROM test").scalar() == 2
+        controller.close()
+        assert uploads == []
+
+        # writes through the connector are detected and uploaded
+        source = SqliteDBController()
+        source.connect(os.path.join(current_dir, 'data/testdb.sqlite'))
+        controller = SqliteDBController()
+        controller.connect('testdb.sqlite', is_s3=True, s3_bucket='taxondb-test')
+        controller.copy_table(source.db_connector, 'test')
+        controller.db_connector.get_engine().execute("DELETE FROM test WHERE id = 1")
+        controller.close()
+        source.close()
+        assert len(uploads) == 1
+
+        controller = SqliteDBController()
+        controller.connect('testdb.sqlite', is_s3=True, s3_bucket='taxondb-test', read_only=True)
+        assert controller.db_connector.get_engine().execute(
+            "SELECT count(*) FROM test").scalar() == 1
+        controller.close()
+        assert len(uploads) == 1
@@ -0,0 +1,160 @@
+# =============================================================================
+# Confidential and Proprietary
+# Unauthorized copying of this file via any medium is strictly prohibited
+# Copyright (C) Aperiomics, Inc., 2019
+# Written by Alvin Chen <ychen@aperiomics.com>
+# ==============================================================================
+
+import gzip
+import os
+import threading
+import time
+from io import BufferedReader, BytesIO
+
+import pytest
+
+from taxondb import file as taxondb_file
+from taxondb.file import (GzipCompressReader, GzipDecompressReader, S3Cache, S3File,
+                          extract_file_from_tar, fetch_cached_file, file_md5, iter_tar_members)
+
+
+def test_fetch_cached_file(tmp_path, taxdump_archive):
+    url = 'file://' + taxdump_archive
+    md5_file = tmp_path / 'taxdump.tar.gz.md5'
+    md5_file.write_text('%s  taxdump.tar.gz\n' % file_md5(taxdump_archive))
+    cache_dir = str(tmp_path / 'cache')
+
+    cached_file = fetch_cached_file(url, cache_dir, md5_url='file://' + str(md5_file))
+    assert file_md5(cached_file) == file_md5(taxdump_archive)
+
+    # unchanged checksum, the cached copy is reused
+    os.utime(cached_file, (0, 0))
+    assert fetch_cached_file(url, cache_dir, md5_url='file://' + str(md5_file)) == cached_file
+    assert os.stat(cached_file).st_mtime == 0
+
+    # changed checksum, the archive is downloaded again and verified
+    md5_file.write_text('0' * 32 + '  taxdump.tar.gz\n')
+    with pytest.raises(ValueError):
+        fetch_cached_file(url, cache_dir, md5_url='file://' + str(md5_file))
+    assert os.listdir(cache_dir) == ['taxdump.tar.gz']
+
+
+def test_extract_tar_stream(taxdump_archive):
+    members = [(name, fh.readline()) for name, fh in
+               iter_tar_members(taxdump_archive, ['nodes.dmp', 'names.dmp'])]
+    assert members == [('names.dmp', b'1\t|\troot\t|\t\t|\tscientific name\t|\n'),
+                       ('nodes.dmp', b'1\t|\t1\t|\tno rank\t|\t\t|\t0\t|\t1\t|\t1\t|\t1\t|\t0\t|'
+                                     b'\t1\t|\t0\t|\t0\t|\t\t|\n')]
+
+    with extract_file_from_tar(taxdump_archive, 'nodes.dmp', out_type='stream') as fh:
+        assert len(fh.readlines()) == 22
+
+    with pytest.raises(KeyError):
+        extract_file_from_tar(taxdump_archive, 'citations.dmp', out_type='stream')
+
+
+def test_s3_cache(tmp_path):
+    cache = S3Cache(str(tmp_path / 's3cache'), max_size=12)
+    downloads = []
+
+    def download(content):
+        def _download(path):
+            time.sleep(0.01)
+            downloads.append(content)
+            with open(path, 'wb') as fh:
+                fh.write(content)
+        return _download
+
+    # concurrent fetches of one object version share a single download
+    results = []
+
+    def fetch():
+        results.append(cache.fetch('bucket', 'taxon.sqlite', '"etag1"', download(b'version 1')))
+
+    threads = [threading.Thread(target=fetch) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert downloads == [b'version 1']
+    assert len({file_path for file_path, _ in results}) == 1
+    file_path, lock_fh = results[0]
+    with open(file_path, 'rb') as fh:
+        assert fh.read() == b'version 1'
+    for _, fh in results:
+        fh.close()
+
+    # a changed ETag is downloaded again, the old version is evicted to fit the budget
+    os.utime(file_path, (0, 0))
+    new_path, new_lock = cache.fetch('bucket', 'taxon.sqlite', '"etag2"', download(b'version 2'))
+    assert downloads == [b'version 1', b'version 2']
+    assert not os.path.exists(file_path)
+    assert not os.path.exists(file_path + S3Cache.lock_suffix)
+
+    # entries in use are kept even over budget
+    other_path, other_lock = cache.fetch('bucket', 'other.sqlite', '"etag1"', download(b'other'))
+    assert os.path.exists(new_path) and os.path.exists(other_path)
+    new_lock.close()
+    assert cache.evict() == 1
+    assert [entry[0] for entry in cache.entries()] == [other_path]
+    other_lock.close()
+
+
+def test_gzip_readers():
+    content = os.urandom(3000) + b'taxonomy ' * 100000
+    compressed = BufferedReader(GzipCompressReader(BytesIO(content), block_size=4096)).read()
+    assert len(compressed) < len(content) // 10
+    assert gzip.decompress(compressed) == content
+
+    reader = BufferedReader(GzipDecompressReader(BytesIO(compressed), block_size=100))
+    assert reader.read() == content
+
+    with pytest.raises(EOFError):
+        BufferedReader(GzipDecompressReader(BytesIO(compressed[:-100]))).read()
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_s3file_transfer(tmp_path, monkeypatch, compression):
+    moto = pytest.importorskip('moto')
+    import boto3
+    import botocore
+    mock_aws = getattr(moto, 'mock_aws', None) or moto.mock_s3
+
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+        monkeypatch.setenv(name, 'testing')
+    with mock_aws():
+        s3 = boto3.resource('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='taxondb-test')
+        monkeypatch.setattr(taxondb_file, 's3', s3)
+
+        content = b'SQLite format 3\x00' + b'taxonomy ' * 2000000
+        s3_file = S3File('taxon.sqlite', is_new_db=True, s3_bucket='taxondb-test',
+                         compression=compression, multipart_chunksize=5 * 1024 ** 2,
+                         max_concurrency=4)
+        s3_file.write(content)
+        s3_file.close()
+
+        head = s3.meta.client.head_object(Bucket='taxondb-test', Key='taxon.sqlite')
+        if compression:
+            assert head['Metadata'][S3File.compression_metadata_key] == 'gzip'
+            assert head['ContentLength'] < len(content) // 10
+        else:
+            assert head['ContentLength'] == len(content)
+
+        cache_dir = str(tmp_path / 'cache')
+        for _ in range(2):
+            s3_file = S3File('taxon.sqlite', s3_bucket='taxondb-test', cache_dir=cache_dir,
+                             read_only=True)
+            with open(s3_file.file, 'rb') as fh:
+                assert fh.read() == content
+            s3_file.close()
+        assert len(S3Cache(cache_dir).entries()) == 1
+
+        # a download is pinned to the version of the object seen by HEAD
+        s3_file = S3File('taxon.sqlite', s3_bucket='taxondb-test', read_only=True)
+        s3.Object('taxondb-test', 'taxon.sqlite').put(Body=b'SQLite format 3\x00changed',
+                                                      Metadata=head['Metadata'])
+        error = botocore.exceptions.ClientError if compression else ValueError
+        with pytest.raises(error, match='PreconditionFailed' if compression else 'changed'):
+            s3_file._download(str(tmp_path / 'pinned.sqlite'), head)
+        s3_file.close()
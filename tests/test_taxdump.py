@@ -0,0 +1,34 @@
+# =============================================================================
+# Confidential and Proprietary
+# Unauthorized copying of this file via any medium is strictly prohibited
+# Copyright (C) Aperiomics, Inc., 2019
+# Written by Alvin Chen <ychen@aperiomics.com>
+# ==============================================================================
+
+from io import BytesIO
+
+from taxondb.taxdump import read_dump
+
+NAMES_DUMP = (b"1\t|\tall\t|\t\t|\tsynonym\t|\n"
+              b"1\t|\troot\t|\t\t|\tscientific name\t|\n"
+              b"2\t|\tNA\t|\tNA <bacteria>\t|\tscientific name\t|\n"
+              b"3\t|\t\"quoted\" name\t|\t\t|\tscientific name\t|\n")
+
+
+def test_read_dump():
+    columns = ['tax_id', 'name_txt', 'unique_name', 'name_class']
+    chunks = list(read_dump(BytesIO(NAMES_DUMP), columns,
+                            dtype={'tax_id': 'int64', 'name_class': 'category'}, chunksize=2))
+    assert len(chunks) == 2
+
+    records = [chunk.astype(object).where(chunk.notnull(), None) for chunk in chunks]
+    records = [rec for chunk in records for rec in chunk.to_dict(orient='records')]
+    assert records == [
+        {'tax_id': 1, 'name_txt': 'all', 'unique_name': None, 'name_class': 'synonym'},
+        {'tax_id': 1, 'name_txt': 'root', 'unique_name': None, 'name_class': 'scientific name'},
+        {'tax_id': 2, 'name_txt': 'NA', 'unique_name': 'NA <bacteria>',
+         'name_class': 'scientific name'},
+        {'tax_id': 3, 'name_txt': '"quoted" name', 'unique_name': None,
+         'name_class': 'scientific name'},
+    ]
+    assert str(chunks[0]['tax_id'].dtype) == 'int64'
@@ -7,6 +7,19 @@
 
 from taxondb import TaxonomyDBCreator, TaxonomyDBFinder
 import os
+import sqlite3
+import threading
+import warnings
+import pytest
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+from taxondb.exceptions import TaxonomyDataError
+from taxondb.models import TaxonNodes, TaxonNames, TaxonSynonyms
+from taxondb.snapshot import Snapshot
+from taxondb.fuzzy import edit_distance, select_trigrams, length_bounds
+from .conftest import TAXON_RECORDS, make_taxdump
 
 current_dir = os.path.dirname(__file__)
 
@@ -32,3 +45,579 @@ def test_taxondb():
     assert taxon_finder.find_taxid_childrens(9605) == {741158, 1425170, 63221, 9606}
 
     os.unlink(temp_file)
+
+
+def test_get_db_taxonomy(taxon_db):
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(taxon_db)
+
+    tids = np.array([562, 9606, 999999, 562, 10239])
+    df_names, df_ids = taxon_finder.get_db_taxonomy(tids)
+    assert list(df_names['tid']) == [562, 9606, 562, 10239]
+    assert list(df_names['kingdom']) == ['Bacteria', 'Metazoa', 'Bacteria', 'Viruses']
+    assert list(df_names['phylum']) == ['Proteobacteria', 'Chordata', 'Proteobacteria',
+                                        'unclassified Viruses']
+    assert list(df_names.loc[3, 'class':]) == ['unclassified Viruses'] * 5
+    assert list(df_ids.loc[1]) == [9606, 2759, 33208, 7711, 40674, 9443, 9604, 9605, 9606]
+
+    df_names, df_ids = taxon_finder.get_db_taxonomy(pd.Series(tids), ['genus', 'species'],
+                                                    match_input=True)
+    assert list(df_names.columns) == ['tid', 'genus', 'species']
+    assert list(df_names['species']) == ['Escherichia coli', 'Homo sapiens', None,
+                                         'Escherichia coli', 'NA']
+    assert df_ids['genus'].isnull().tolist() == [False, False, True, False, False]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        df_names, df_ids = taxon_finder.get_db_taxonomy([], match_input=True)
+    assert df_names.empty and df_ids.empty
+    taxon_finder.close()
+
+
+def test_bulk_name_resolution(taxon_db):
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(taxon_db)
+
+    statements = []
+    sa.event.listen(taxon_finder.db_connector.get_engine(), 'before_cursor_execute',
+                    lambda conn, cursor, statement, *args: statements.append(statement))
+
+    taxon_finder.get_db_taxonomy([562, 9606, 63221, 1425170] * 100)
+    assert len([s for s in statements if 'taxon_names' in s]) == 1
+
+    assert taxon_finder.find_taxid_parents(562)[1][543] == 'Enterobacteriaceae'
+    assert len([s for s in statements if 'taxon_names' in s]) == 1
+    taxon_finder.close()
+
+
+def test_lineage_table(taxon_db):
+    taxon_creator = TaxonomyDBCreator()
+    taxon_creator.connect(taxon_db)
+    taxon_creator._create_lineage_data()
+    taxon_creator.close()
+
+    tids = [562, 9606, 63221, 999999, 10239, 1]
+    tree_finder = TaxonomyDBFinder()
+    tree_finder.connect(taxon_db)
+    table_finder = TaxonomyDBFinder()
+    table_finder.connect(taxon_db)
+    table_finder.lineage_mode = 'table'
+
+    for expected, result in zip(tree_finder.get_db_taxonomy(tids, match_input=True),
+                                table_finder.get_db_taxonomy(tids, match_input=True)):
+        pd.testing.assert_frame_equal(expected, result)
+    assert table_finder.find_taxid_parents(63221) == tree_finder.find_taxid_parents(63221)
+    assert table_finder.rev_phylo_tree is None
+
+    tree_finder.close()
+    table_finder.close()
+
+
+def test_cte_lineages(taxon_db):
+    tids = [562, 9606, 63221, 999999, 10239, 1, 0, 562]
+    clades = ['superkingdom', 'no rank', 'genus', 'species', 'subspecies']
+    tree_finder = TaxonomyDBFinder()
+    tree_finder.connect(taxon_db)
+    cte_finder = TaxonomyDBFinder()
+    cte_finder.connect(taxon_db)
+    cte_finder.lineage_mode = 'cte'
+    cte_finder.name_query_chunk_size = 3
+
+    for selected in [[], clades]:
+        for expected, result in zip(tree_finder.get_db_taxonomy(tids, selected, True),
+                                    cte_finder.get_db_taxonomy(tids, selected, True)):
+            pd.testing.assert_frame_equal(expected, result)
+    for tid in [63221, 1, 999999]:
+        assert cte_finder.find_taxid_parents(tid) == tree_finder.find_taxid_parents(tid)
+    assert cte_finder.rev_phylo_tree is None and cte_finder.tree is None
+
+    tree_finder.close()
+    cte_finder.close()
+
+
+def test_read_only_serving(taxon_db):
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(taxon_db)
+    tids = [562, 9606, 63221, 999999, 10239, 1]
+    expected = taxon_finder.get_db_taxonomy(tids, match_input=True)
+    taxon_finder.close()
+
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(taxon_db, read_only=True, prewarm=True)
+    engine = taxon_finder.db_connector.get_engine()
+    assert 'mode=ro' in str(engine.url) and 'immutable=1' in str(engine.url)
+    assert engine.execute("PRAGMA mmap_size").scalar() > 0
+    assert engine.execute("PRAGMA cache_size").scalar() == \
+        taxon_finder.db_connector.read_only_pragmas['cache_size']
+
+    for mode in ['tree', 'cte']:
+        taxon_finder.lineage_mode = mode
+        taxon_finder.configure_lineage_cache(0)
+        for expected_df, result_df in zip(expected,
+                                          taxon_finder.get_db_taxonomy(tids, match_input=True)):
+            pd.testing.assert_frame_equal(expected_df, result_df)
+    with pytest.raises(sa.exc.OperationalError):
+        engine.execute("CREATE TABLE read_only_check (id INTEGER)")
+    taxon_finder.close()
+
+
+def test_snapshot(taxon_db):
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(taxon_db)
+    snapshot_file = taxon_finder.export_snapshot()
+    assert snapshot_file == taxon_db + '.snapshot'
+
+    snapshot_finder = TaxonomyDBFinder()
+    snapshot_finder.connect_snapshot(snapshot_file)
+    assert snapshot_finder.db_connector is None
+
+    tids = [562, 9606, 63221, 999999, 10239, 1, 0]
+    for expected, result in zip(taxon_finder.get_db_taxonomy(tids, match_input=True),
+                                snapshot_finder.get_db_taxonomy(tids, match_input=True)):
+        pd.testing.assert_frame_equal(expected, result)
+    assert snapshot_finder.find_taxid_parents(9606) == taxon_finder.find_taxid_parents(9606)
+    assert snapshot_finder.find_taxid_parents(999999) == (None, None)
+    snapshot_finder.close()
+
+    # a snapshot of a database that was written since the export is stale, exporting it again
+    # replaces the file, so a mapping of the old snapshot stays readable
+    old_snapshot = Snapshot(snapshot_file)
+    with sqlite3.connect(taxon_db) as conn:
+        conn.execute("DELETE FROM taxon_nodes WHERE tax_id = 63221")
+    with pytest.raises(TaxonomyDataError):
+        TaxonomyDBFinder().connect_snapshot(snapshot_file)
+    with pytest.raises(TaxonomyDataError):
+        taxon_finder.connect_snapshot()
+    taxon_finder.connect_snapshot(rebuild=True)
+    assert taxon_finder.find_taxid_parents(63221) == (None, None)
+    assert old_snapshot.names.get(63221) is not None
+    old_snapshot.close()
+    snapshot_finder = TaxonomyDBFinder()
+    snapshot_finder.connect_snapshot(snapshot_file)
+    assert snapshot_finder.find_taxid_parents(9606) == taxon_finder.find_taxid_parents(9606)
+
+    taxon_finder.close()
+    snapshot_finder.close()
+
+    with pytest.raises(TaxonomyDataError):
+        Snapshot(taxon_db)
+
+
+def test_filter_by_clade(taxon_db):
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(taxon_db)
+
+    assert taxon_finder.is_descendant(63221, 9605)
+    assert taxon_finder.is_descendant(9605, 9605)
+    assert not taxon_finder.is_descendant(9605, 9605, include_self=False)
+    assert not taxon_finder.is_descendant(562, 2759)
+
+    tids = np.array([r[0] for r in TAXON_RECORDS] + [999999])
+    assert taxon_finder.filter_by_clade(tids, 1).tolist() == [True] * len(TAXON_RECORDS) + [False]
+    for clade_tid in [2, 9605, 9606, 131567, 10239]:
+        children = taxon_finder.find_taxid_childrens(clade_tid)
+        mask = taxon_finder.filter_by_clade(tids, clade_tid, include_self=False)
+        assert set(tids[mask]) == children
+    taxon_finder.close()
+
+
+def test_lca(taxon_db):
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(taxon_db)
+
+    assert taxon_finder.lca([63221, 741158]) == 9606
+    assert taxon_finder.lca([63221, 1425170, 9605]) == 9605
+    assert taxon_finder.lca([562, 9606, 999999]) == 131567
+    assert taxon_finder.lca([999999]) is None
+
+    groups = [[562], [562, 543, 561], [9606, 10239], [], [741158, 63221, 1425170, 562, 2]]
+    assert taxon_finder.lca_many(groups).tolist() == [562, 543, 1, 0, 131567]
+    taxon_finder.close()
+
+
+def test_bulk_load(tmp_path):
+    taxon_creator = TaxonomyDBCreator()
+    taxon_creator.connect(str(tmp_path / 'taxon.sqlite'), is_new_db=True)
+    taxon_creator.chunk_size = 7
+
+    df_nodes = pd.DataFrame([(tid, parent, rank) for tid, parent, rank, _ in TAXON_RECORDS],
+                            columns=['tax_id', 'parent_tax_id', 'rank'])
+    taxon_creator._write_taxon_data([df_nodes.iloc[:10], df_nodes.iloc[10:]], TaxonNodes)
+
+    engine = taxon_creator.db_connector.get_engine()
+    assert engine.execute("SELECT COUNT(*) FROM taxon_nodes").scalar() == len(TAXON_RECORDS)
+    assert engine.execute("SELECT rank FROM taxon_nodes WHERE tax_id = 9606").scalar() == 'species'
+    assert {index['name'] for index in sa.inspect(engine).get_indexes('taxon_nodes')} == \
+        {'ix_taxon_nodes_tax_id', 'ix_taxon_nodes_parent_tax_id'}
+    assert engine.execute("PRAGMA journal_mode").scalar() == 'delete'
+    assert taxon_creator.load_stats['taxon_nodes']['rows'] == len(TAXON_RECORDS)
+    taxon_creator.close()
+
+
+def test_create_from_archive(tmp_path, taxdump_archive):
+    db_file = str(tmp_path / 'archive.sqlite')
+    taxon_creator = TaxonomyDBCreator()
+    taxon_creator.connect(db_file, is_new_db=True)
+    taxon_creator.create(archive=taxdump_archive)
+    taxon_creator.close()
+
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(db_file)
+    assert taxon_finder.find_taxid_parents_simple(9606) == taxon_finder.find_taxid_parents(9606)
+    assert taxon_finder.find_taxid_parents(562)[1][562] == 'Escherichia coli'
+    taxon_finder.lineage_mode = 'table'
+    assert taxon_finder.find_taxid_parents(63221)[0]['species'] == 9606
+    taxon_finder.close()
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_update(tmp_path, taxdump_archive, compact):
+    db_file = str(tmp_path / 'update.sqlite')
+    taxon_creator = TaxonomyDBCreator()
+    taxon_creator.connect(db_file, is_new_db=True)
+    taxon_creator.create(archive=taxdump_archive, compact=compact)
+    assert taxon_creator.is_compact() == compact
+
+    records = [rec for rec in TAXON_RECORDS if rec[0] not in (741158, 1425170)]
+    records = [(tid, parent, rank, 'Homo sapiens sapiens' if tid == 9606 else name)
+               for tid, parent, rank, name in records]
+    records.append((2697049, 10239, 'no rank', 'Severe acute respiratory syndrome coronavirus 2'))
+    new_archive = make_taxdump(str(tmp_path / 'new_taxdump.tar.gz'), records,
+                               merged=[(741158, 63221)], delnodes=[1425170])
+
+    stats = taxon_creator.update(archive=new_archive)
+    assert stats['taxon_nodes'] == {'inserted': 1, 'updated': 0, 'deleted': 2}
+    assert stats['taxon_names'] == {'inserted': 1, 'updated': 1, 'deleted': 2}
+    assert stats['taxon_lineage'] == {'inserted': 1, 'updated': 2, 'deleted': 2}
+    assert stats['taxon_merged'] == {'inserted': 1, 'updated': 0, 'deleted': 0}
+    assert stats['taxon_deleted'] == {'inserted': 1, 'updated': 0, 'deleted': 0}
+    assert stats['taxon_synonyms'] == {'inserted': 2, 'updated': 0, 'deleted': 3}
+    taxon_creator.close()
+
+    expected_file = str(tmp_path / 'expected.sqlite')
+    taxon_creator = TaxonomyDBCreator()
+    taxon_creator.connect(expected_file, is_new_db=True)
+    taxon_creator.create(archive=new_archive)
+    assert taxon_creator.update(archive=new_archive)['taxon_nodes']['updated'] == 0
+    taxon_creator.close()
+
+    for table in ['taxon_nodes', 'taxon_names', 'taxon_lineage', 'taxon_deleted',
+                  'taxon_synonyms']:
+        query = "SELECT * FROM %s ORDER BY tax_id, name_txt" % table \
+            if table == 'taxon_synonyms' else "SELECT * FROM %s ORDER BY tax_id" % table
+        df_updated = pd.read_sql(query, 'sqlite:///' + db_file).drop(columns='id')
+        df_expected = pd.read_sql(query, 'sqlite:///' + expected_file).drop(columns='id')
+        pd.testing.assert_frame_equal(df_updated, df_expected)
+
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(db_file)
+    df_hits = taxon_finder.find_taxids_by_names(['coronavirus', 'sapiens'], mode='token')
+    assert df_hits['tax_id'].tolist() == [2697049, 9606, 63221]
+    df_hits = taxon_finder.find_taxids_by_fuzzy_names(['Homo sapiens sapeins',
+                                                       "Homo sapiens subsp. 'Denisova'"])
+    assert df_hits['tax_id'].tolist() == [9606, 9606]
+    taxon_finder.close()
+
+
+def test_merged_taxids(tmp_path):
+    records = [rec for rec in TAXON_RECORDS if rec[0] not in (741158, 1425170)]
+    archive = make_taxdump(str(tmp_path / 'taxdump.tar.gz'), records,
+                           merged=[(741158, 63221), (99999901, 741158)], delnodes=[1425170])
+    db_file = str(tmp_path / 'merged.sqlite')
+    taxon_creator = TaxonomyDBCreator()
+    taxon_creator.connect(db_file, is_new_db=True)
+    taxon_creator.create(archive=archive)
+    taxon_creator.close()
+
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(db_file)
+    current, remapped = taxon_finder.resolve_merged_taxids([741158, 99999901, 9606, 1425170])
+    assert current.tolist() == [63221, 63221, 9606, 1425170]
+    assert remapped.tolist() == [True, True, False, False]
+
+    assert taxon_finder.find_taxid_parents(741158) == taxon_finder.find_taxid_parents(63221)
+    assert taxon_finder.find_taxid_parents(1425170) == (None, None)
+
+    tids = [741158, 9606, 1425170, 741158]
+    df_names, df_ids = taxon_finder.get_db_taxonomy(tids, match_input=True, report_merged=True)
+    assert list(df_ids.columns[:2]) == ['tid', 'current_tid']
+    assert df_ids['tid'].tolist() == tids
+    assert df_ids['current_tid'].tolist() == [63221, 9606, 1425170, 63221]
+    assert df_names['species'].tolist() == ['Homo sapiens', 'Homo sapiens', None, 'Homo sapiens']
+
+    taxon_finder.lineage_mode = 'array'
+    snapshot_file = taxon_finder.export_snapshot()
+    snapshot_finder = TaxonomyDBFinder()
+    snapshot_finder.connect_snapshot(snapshot_file)
+    for expected, result in zip(taxon_finder.get_db_taxonomy(tids, match_input=True),
+                                snapshot_finder.get_db_taxonomy(tids, match_input=True)):
+        pd.testing.assert_frame_equal(expected, result)
+
+    taxon_finder.resolve_merged = False
+    _, df_ids = taxon_finder.get_db_taxonomy(tids)
+    assert df_ids['tid'].tolist() == [9606]
+
+    taxon_finder.close()
+    snapshot_finder.close()
+
+
+def test_find_taxids_by_names(tmp_path, taxdump_archive):
+    db_file = str(tmp_path / 'names.sqlite')
+    taxon_creator = TaxonomyDBCreator()
+    taxon_creator.connect(db_file, is_new_db=True)
+    taxon_creator.create(archive=taxdump_archive)
+    taxon_creator.db_connector.get_engine().execute(
+        TaxonSynonyms.__table__.insert(),
+        [{'tax_id': 10239, 'name_txt': '\u00d6tzi virus', 'name_class': 'synonym'},
+         {'tax_id': 9606, 'name_txt': 'Homo@test', 'name_class': 'synonym'},
+         {'tax_id': 9605, 'name_txt': 'Homo_test', 'name_class': 'synonym'}])
+    taxon_creator.close()
+
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(db_file)
+    assert taxon_finder.find_taxid_names([9606]) == {9606: 'Homo sapiens'}
+
+    # NOCASE folds ASCII letters only, other letters match as they are
+    df_hits = taxon_finder.find_taxids_by_names(['\u00d6TZI VIRUS', '\u00d6tzi virus'])
+    assert df_hits['tax_id'].tolist() == [10239, 10239]
+    df_hits = taxon_finder.find_taxids_by_names(['\u00d6tzi', 'homo@'], mode='prefix')
+    assert df_hits['name_txt'].tolist() == ['\u00d6tzi virus', 'Homo@test']
+
+    df_hits = taxon_finder.find_taxids_by_names(['human', 'HOMO SAPIENS', 'Bacillus coli',
+                                                 'unknown taxon', 'human'])
+    assert df_hits['name'].tolist() == ['human', 'HOMO SAPIENS', 'Bacillus coli']
+    assert df_hits['tax_id'].tolist() == [9606, 9606, 562]
+    assert df_hits['name_class'].tolist()[2] == 'synonym'
+
+    df_hits = taxon_finder.find_taxids_by_names(['escherichia', 'Homo s'], mode='prefix')
+    assert df_hits['tax_id'].tolist() == [561, 562, 9606, 63221, 741158]
+    df_hits = taxon_finder.find_taxids_by_names(['Homo'], mode='prefix', limit=2)
+    assert df_hits['name_txt'].tolist() == ['Homo', 'Homo heidelbergensis']
+
+    df_hits = taxon_finder.find_taxids_by_names(['coli', 'sapiens homo'], mode='token')
+    assert set(df_hits.loc[df_hits['name'] == 'coli', 'tax_id']) == {562}
+    assert df_hits.loc[df_hits['name'] == 'sapiens homo', 'tax_id'].tolist()[0] == 9606
+
+    with pytest.raises(ValueError):
+        taxon_finder.find_taxids_by_names(['human'], mode='fuzzy')
+    taxon_finder.close()
+
+
+def test_find_taxids_by_fuzzy_names(tmp_path, taxdump_archive):
+    assert edit_distance('kitten', 'sitting') == 3
+    assert edit_distance('', 'abc') == 3
+    assert edit_distance('abcdef', 'a', max_distance=2) == 3
+    doc_counts = {'abc': 5, 'bcd': 2, 'cde': 40}
+    assert select_trigrams(['abc', 'bcd', 'cde', 'xyz'], doc_counts, 10) == (['bcd', 'abc'], 'OR')
+    assert select_trigrams(['abc', 'bcd', 'cde'], doc_counts, 1) == (['bcd', 'abc'], 'AND')
+    assert select_trigrams(['xyz'], doc_counts, 10) == ([], 'OR')
+    assert length_bounds(10, 0.8) == (8, 12)
+    assert length_bounds(10, 0.0)[0] == 0
+
+    db_file = str(tmp_path / 'fuzzy.sqlite')
+    taxon_creator = TaxonomyDBCreator()
+    taxon_creator.connect(db_file, is_new_db=True)
+    taxon_creator.create(archive=taxdump_archive)
+    taxon_creator.close()
+
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(db_file)
+    df_hits = taxon_finder.find_taxids_by_fuzzy_names(['Escherichia colli', 'homo sapeins',
+                                                       'Homo sapiens', 'xy'])
+    assert df_hits['tax_id'].tolist() == [562, 9606, 9606]
+    assert df_hits['score'].tolist()[2] == 1.0
+    assert (df_hits['score'] < 1.0).tolist()[:2] == [True, True]
+
+    df_hits = taxon_finder.find_taxids_by_fuzzy_names(['Escherichia colli'], limit=2)
+    assert df_hits['tax_id'].tolist() == [562, 561]
+    df_hits = taxon_finder.find_taxids_by_fuzzy_names(['Escherichia colli'], limit=2,
+                                                      min_score=0.9)
+    assert df_hits['tax_id'].tolist() == [562]
+    taxon_finder.close()
+
+
+def test_unsupported_name_index(tmp_path, taxdump_archive, caplog):
+    db_file = str(tmp_path / 'no_trigram.sqlite')
+    taxon_creator = TaxonomyDBCreator()
+    taxon_creator.name_index_tables = [
+        taxon_creator.name_index_tables[0],
+        (TaxonNames.trigram_table, TaxonNames.__tablename__, 'no_such_tokenizer')]
+    taxon_creator.connect(db_file, is_new_db=True)
+    taxon_creator.create(archive=taxdump_archive)
+    assert 'cannot build the FTS5 index %s' % TaxonNames.trigram_table in caplog.text
+    assert taxon_creator.update(archive=taxdump_archive)['taxon_names']['updated'] == 0
+    taxon_creator.close()
+
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(db_file)
+    assert 562 in taxon_finder.find_taxids_by_names(['coli'], mode='token')['tax_id'].tolist()
+    with pytest.raises(TaxonomyDataError):
+        taxon_finder.find_taxids_by_fuzzy_names(['Escherichia colli'])
+    taxon_finder.close()
+
+
+def test_parallel_lineages(taxon_db):
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(taxon_db)
+    tids = np.array([562, 9606, 63221, 999999, 10239, 1, 0, 9606] * 50)
+    expected = taxon_finder.get_db_taxonomy(tids, match_input=True)
+
+    taxon_finder.start_workers(processes=2, chunk_size=2)
+    assert taxon_finder.lineage_mode == 'array'
+    for expected_df, result_df in zip(expected,
+                                      taxon_finder.get_db_taxonomy(tids, match_input=True)):
+        pd.testing.assert_frame_equal(expected_df, result_df)
+    taxon_finder.close()
+    assert taxon_finder._workers is None
+
+
+def test_lineage_cache(taxon_db):
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(taxon_db)
+    expected = taxon_finder.find_taxid_parents(9606)
+    assert taxon_finder.find_taxid_parents(9606) == expected
+    assert taxon_finder.find_taxid_parents_simple(9606) == expected
+    info = taxon_finder.cache_info()['lineages']
+    assert (info.hits, info.misses, info.currsize) == (1, 2, 2)
+
+    df_names, _ = taxon_finder.get_db_taxonomy([9606, 562, 999999, 9606])
+    assert df_names['species'].tolist() == ['Homo sapiens', 'Escherichia coli', 'Homo sapiens']
+    info = taxon_finder.cache_info()['lineages']
+    assert (info.hits, info.misses, info.currsize) == (2, 4, 4)
+    cached_names, _ = taxon_finder.get_db_taxonomy([9606, 562, 999999, 9606])
+    pd.testing.assert_frame_equal(df_names, cached_names)
+    assert taxon_finder.cache_info()['lineages'].hits == 5
+
+    taxon_finder.configure_lineage_cache(maxsize=1, ttl=0)
+    taxon_finder.find_taxid_parents(9606)
+    taxon_finder.find_taxid_parents(562)
+    assert taxon_finder.find_taxid_parents(562) == taxon_finder.find_taxid_parents(562, [])
+    info = taxon_finder.cache_info()['lineages']
+    assert info.hits == 0
+    assert info.evictions == 1
+    assert info.expired == 2
+    taxon_finder.close()
+
+
+@pytest.mark.parametrize('simple_first', [False, True])
+def test_lineage_cache_methods(taxon_db, simple_first):
+    clades = ['no rank', 'species']
+    expected = {}
+    for method in ['find_taxid_parents', 'find_taxid_parents_simple']:
+        taxon_finder = TaxonomyDBFinder()
+        taxon_finder.connect(taxon_db)
+        taxon_finder.configure_lineage_cache(maxsize=0)
+        expected[method] = getattr(taxon_finder, method)(10239, clades)
+        taxon_finder.close()
+    assert expected['find_taxid_parents'] != expected['find_taxid_parents_simple']
+
+    # the cached lineage of one method is not returned by the other
+    methods = sorted(expected, reverse=simple_first)
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(taxon_db)
+    for method in methods + methods:
+        assert getattr(taxon_finder, method)(10239, clades) == expected[method]
+    taxon_finder.close()
+
+
+def test_thread_safe_finder(taxon_db):
+    from concurrent.futures import ThreadPoolExecutor
+
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(taxon_db)
+    tids = [562, 9606, 63221, 999999, 10239, 1, 0, 9606]
+    expected = [taxon_finder.find_taxid_parents(tid) for tid in tids]
+    expected_names = taxon_finder.get_db_taxonomy(tids, match_input=True)[0]
+    taxon_finder.close()
+
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(taxon_db, thread_safe=True)
+    taxon_finder.configure_lineage_cache(maxsize=0)
+    builds = []
+    build_tree = taxon_finder._build_rev_phylo_tree_locked
+    taxon_finder._build_rev_phylo_tree_locked = lambda: builds.append(1) or build_tree()
+
+    # all workers run at once, each one with its own session
+    barrier = threading.Barrier(4)
+
+    def lookup(i):
+        barrier.wait()
+        session = taxon_finder.db_connector.session
+        simple_results = [taxon_finder.find_taxid_parents_simple(tid) for tid in tids[i % 4:]]
+        results = [taxon_finder.find_taxid_parents(tid) for tid in tids]
+        df_names = taxon_finder.get_db_taxonomy(tids, match_input=True)[0]
+        return session, simple_results, results, df_names
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        outputs = list(pool.map(lookup, range(16)))
+    assert len(builds) == 1
+    assert len({id(session) for session, _, _, _ in outputs}) == 4
+    for i, (_, simple_results, results, df_names) in enumerate(outputs):
+        assert simple_results == expected[i % 4:]
+        assert results == expected
+        pd.testing.assert_frame_equal(df_names, expected_names)
+    taxon_finder.close()
+
+
+def test_async_service(tmp_path, taxon_db):
+    import asyncio
+    from taxondb.service import AsyncTaxonomyFinder, TaxonomyClient, start_server
+
+    taxon_finder = TaxonomyDBFinder()
+    taxon_finder.connect(taxon_db, thread_safe=True)
+    taxon_finder.lineage_mode = 'array'
+    tids = [562, 9606, 63221, 999999, 10239, 1, 9606] * 30
+    expected = [taxon_finder.find_taxid_parents(tid) for tid in tids]
+    assert taxon_finder.find_taxid_parents_batch(tids) == expected
+
+    service = AsyncTaxonomyFinder(taxon_finder, window=0.05)
+
+    async def lookup():
+        return await asyncio.gather(*[service.lineage(tid) for tid in tids])
+
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(lookup()) == expected
+    stats = service.stats()
+    assert (stats['requests'], stats['batches']) == (len(tids), 1)
+    assert stats['latency_p99'] >= stats['latency_p50'] > 0
+
+    # server on a Unix socket with its event loop in a background thread
+    socket_path = str(tmp_path / 'taxondb.sock')
+    server = loop.run_until_complete(start_server(service, path=socket_path))
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        client = TaxonomyClient(path=socket_path)
+        assert client.find_taxid_parents_batch(tids) == expected
+        assert client.find_taxid_parents(9606, ['genus']) == \
+            taxon_finder.find_taxid_parents(9606, ['genus'])
+        assert client.stats()['requests'] == 2 * len(tids) + 1
+        client.close()
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+    service.close()
+
+    # running batches are referenced by the service, close cancels waiting requests
+    service = AsyncTaxonomyFinder(taxon_finder, window=10, max_batch=2)
+
+    async def cancel():
+        batch = [asyncio.ensure_future(service.lineage(tid)) for tid in [562, 9606]]
+        await asyncio.sleep(0)
+        tasks = set(service._tasks)
+        assert len(tasks) == 1
+        waiting = asyncio.ensure_future(service.lineage(562))
+        assert await asyncio.gather(*batch) == expected[:2]
+        await asyncio.wait(tasks)
+        assert not service._tasks
+        service.close()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(cancel())
+    loop.close()
+    taxon_finder.close()